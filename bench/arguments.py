@@ -0,0 +1,43 @@
+import redis
+import sys
+import time
+
+sys.path.insert(0, '.')
+from locomotor import redis_server
+
+
+@redis_server(redis_objs=['client'])
+def count_items(client, items):
+    return len(items)
+
+
+def measure(func, iterations):
+    """Get the client CPU time in microseconds for each call"""
+
+    func()
+    start = time.clock()
+    for _ in range(iterations):
+        func()
+    end = time.clock()
+
+    return (end - start) / iterations * 1e6
+
+
+def bench():
+    client = redis.StrictRedis()
+
+    # Large collections are where encoding arguments costs the most
+    for size in (10, 1000, 100000):
+        iterations = max(10, 100000 // size)
+        values = [
+            ('list', list(range(size))),
+            ('dict', dict(('key%d' % i, i) for i in range(size))),
+        ]
+
+        for name, value in values:
+            func = lambda: count_items(client, value)
+            print('%s,%d,%f' % (name, size, measure(func, iterations)))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,40 @@
+import redis
+import time
+
+#: A loop as generated with the scaffolding for break and continue
+SCAFFOLDED = """
+local __TOTAL = 0
+local __BREAK1 = false
+for i = 1, tonumber(ARGV[1]) do
+  if __BREAK1 then break end
+  repeat
+    __TOTAL = __TOTAL + i
+  until true
+end
+return __TOTAL
+"""
+
+#: The same loop without any scaffolding
+PLAIN = """
+local __TOTAL = 0
+for i = 1, tonumber(ARGV[1]) do
+  __TOTAL = __TOTAL + i
+end
+return __TOTAL
+"""
+
+def bench():
+    client = redis.StrictRedis()
+    iterations = 10000000
+
+    for name, code in [('scaffolded', SCAFFOLDED), ('plain', PLAIN)]:
+        script = client.register_script(code)
+        script(args=[1])
+
+        start = time.time()
+        script(args=[iterations])
+        end = time.time()
+        print('%s,%f' % (name, (end - start) / iterations * 1e9))
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,29 @@
+redis.replicate_commands()
+local __RETVAL = function(value, retval)
+local __RESULT = {}
+__RESULT["__value"] = value
+__RESULT["__return"] = retval
+return cmsgpack.pack(__RESULT)
+end
+local __SCALAR = function(value)
+local __TYPE = type(value)
+if __TYPE == "number" then
+return value == math.floor(value) and math.abs(value) < 2^53
+else
+return __TYPE == "string"
+end
+end
+local __REPLY_NUMBER = function(value)
+if type(value) == "number" and __SCALAR(value) then
+return value
+else
+return __RETVAL(value, true)
+end
+end
+local n = tonumber(ARGV[1]);
+local values;
+values = {};
+for i = 0, n - 1 do
+table.insert(values, redis.call('get', ('micro:' .. tostring(i)) .. ':value'));
+end
+return __REPLY_NUMBER(#values);
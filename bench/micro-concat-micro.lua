@@ -0,0 +1,31 @@
+redis.replicate_commands()
+local __RETVAL = function(value, retval)
+local __RESULT = {}
+__RESULT["__value"] = value
+__RESULT["__return"] = retval
+return cmsgpack.pack(__RESULT)
+end
+local __SCALAR = function(value)
+local __TYPE = type(value)
+if __TYPE == "number" then
+return value == math.floor(value) and math.abs(value) < 2^53
+else
+return __TYPE == "string"
+end
+end
+local __REPLY_NUMBER = function(value)
+if type(value) == "number" and __SCALAR(value) then
+return value
+else
+return __RETVAL(value, true)
+end
+end
+local __TOSTRING = tostring;
+local n = tonumber(ARGV[1]);
+local total, value;
+total = 0;
+for i = 0, n - 1 do
+value = 'a' .. __TOSTRING(i) .. 'b' .. __TOSTRING(i) .. 'c';
+total = total + #value;
+end
+return __REPLY_NUMBER(total);
@@ -0,0 +1,99 @@
+import argparse
+import redis
+import sys
+import time
+
+sys.path.insert(0, '.')
+from locomotor import ScriptRegistry, redis_server
+from locomotor.passes import DEFAULT_PASSES
+
+#: Passes used to compare against the Lua micro-optimizations
+MICRO_PASSES = DEFAULT_PASSES + ['micro_optimize']
+
+#: The file holding the Lua generated for a function with each pass list
+LUA_FILE = 'bench/micro-%s-%s.lua'
+
+
+def append_get(client, n):
+    values = []
+    for i in range(n):
+        values.append(client.get('micro:' + str(i) + ':value'))
+    return len(values)
+
+
+def concat(client, n):
+    total = 0
+    for i in range(n):
+        value = 'a' + str(i) + 'b' + str(i) + 'c'
+        total += len(value)
+    return total
+
+
+def hset_loop(client, n):
+    for i in range(n):
+        client.hset('micro:hash', 'field' + str(i), i)
+    return n
+
+
+def measure(client, call, iterations):
+    """Get the time in nanoseconds for each iteration of a loop in a
+    script"""
+
+    call(10)
+
+    # The fastest run is the least disturbed by other processes
+    times = []
+    for _ in range(30):
+        client.delete('micro:hash')
+        start = time.time()
+        call(iterations)
+        times.append(time.time() - start)
+
+    return min(times) / iterations * 1e9
+
+
+def bench(lua=False, dump=False):
+    """Time loops in scripts with and without the micro-optimization pass
+
+    With `lua`, the code generated for each function is read from the
+    files written with `dump` and run directly.
+    """
+
+    client = redis.StrictRedis()
+    iterations = 100000
+
+    for func in (append_get, concat, hset_loop):
+        for name, passes in [('default', DEFAULT_PASSES),
+                             ('micro', MICRO_PASSES)]:
+            filename = LUA_FILE % (func.__name__, name)
+            if lua:
+                sha = client.script_load(open(filename).read())
+                call = lambda n: client.evalsha(sha, 0, n)
+            else:
+                script = redis_server(redis_objs=['client'],
+                                      passes=passes)(func)
+                call = lambda n: script(client, n)
+
+            print('%s,%s,%f' % (func.__name__, name,
+                                measure(client, call, iterations)))
+
+            if dump:
+                script_id = list(script.variants.values())[0]
+                with open(filename, 'w') as lua_file:
+                    lua_file.write(ScriptRegistry.SCRIPTS[script_id].script)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark of Lua micro-optimizations')
+    parser.add_argument('--lua', dest='lua', action='store_true',
+                        default=False,
+                        help='run the generated Lua saved with --dump')
+    parser.add_argument('--dump', dest='dump', action='store_true',
+                        default=False,
+                        help='save the Lua generated for each function')
+
+    args = parser.parse_args()
+    if args.lua and args.dump:
+        parser.error('--dump needs the scripts to be generated')
+    bench(args.lua, args.dump)
@@ -0,0 +1,52 @@
+import redis
+import sys
+import time
+
+sys.path.insert(0, '.')
+from locomotor import redis_server
+
+
+@redis_server(redis_objs=['client'])
+def get_key(client, key):
+    return client.get(key)
+
+
+class Store(object):
+    @redis_server(redis_objs=['client'])
+    def get_key(self, client, key):
+        return client.get(key)
+
+
+def measure(func, iterations):
+    """Get the client CPU time in microseconds for each call"""
+
+    func()
+    start = time.clock()
+    for _ in range(iterations):
+        func()
+    end = time.clock()
+
+    return (end - start) / iterations * 1e6
+
+
+def bench():
+    client = redis.StrictRedis()
+    client.set('overhead:key', 'value')
+    iterations = 100000
+
+    # A bare call of a script doing the same work is the baseline
+    sha = client.script_load("return redis.call('get', ARGV[1])")
+    store = Store()
+    calls = [
+        ('evalsha', lambda: client.execute_command('EVALSHA', sha, 0,
+                                                   'overhead:key')),
+        ('function', lambda: get_key(client, 'overhead:key')),
+        ('method', lambda: store.get_key(client, 'overhead:key')),
+    ]
+
+    for name, func in calls:
+        print('%s,%f' % (name, measure(func, iterations)))
+
+
+if __name__ == '__main__':
+    bench()
@@ -0,0 +1,36 @@
+import redis
+import resource
+import sys
+
+sys.path.insert(0, '.')
+from locomotor import redis_server
+
+
+@redis_server(redis_objs=['client'])
+def members(client, key):
+    return client.lrange(key, 0, -1)
+
+
+@redis_server(redis_objs=['client'], stream_size=1000)
+def stream_members(client, key):
+    return client.lrange(key, 0, -1)
+
+
+def bench():
+    """Get the peak memory of the client in kilobytes after reading a
+    large list with or without streaming"""
+
+    client = redis.StrictRedis()
+    client.delete('stream:key')
+    for start in range(0, 1000000, 10000):
+        client.rpush('stream:key', *range(start, start + 10000))
+
+    # Peak memory only grows so each run measures one way of reading
+    func = stream_members if 'stream' in sys.argv[1:] else members
+    total = sum(len(item) for item in func(client, 'stream:key'))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print('%s,%d,%d' % (func.__name__, total, peak))
+
+
+if __name__ == '__main__':
+    bench()
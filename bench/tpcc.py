@@ -4,6 +4,7 @@ import time
 
 sys.path.insert(0, '.')
 from locomotor import redis_server
+from locomotor.passes import DEFAULT_PASSES, PassManager
 
 sys.path.insert(0, 'vendor/pytpcc')
 sys.path.insert(0, 'vendor/pytpcc/pytpcc')
@@ -219,9 +220,18 @@ class PartitionedDriver(redisdriver.RedisDriver):
     # End doDelivery()
 
 def bench(host='127.0.0.1', port=6379, partition=False, load=True, execute=True,
-          scale_factor=50, iterations=10000):
+          scale_factor=50, iterations=10000, micro_optimize=False):
     global nurand
 
+    # Optionally compare against the Lua micro-optimizations which only
+    # apply to the partitioned driver since the other runs no scripts
+    if micro_optimize and not partition:
+        raise ValueError('Micro-optimization requires partitioning')
+    elif micro_optimize:
+        delivery = PartitionedDriver.__dict__['_doDelivery']
+        delivery.pass_manager = PassManager(DEFAULT_PASSES +
+                                            ['micro_optimize'])
+
     # Construct a Redis driver object
     if partition:
         driver = PartitionedDriver(ddl=None)
@@ -292,9 +302,15 @@ if __name__ == '__main__':
     parser.add_argument('--port', dest='port', action='store',
                         default=6379,
                         help='Redis server port number')
+    parser.add_argument('--micro-optimize', dest='micro_optimize',
+                        action='store_true', default=False,
+                        help='run the optional Lua micro-optimization pass '
+                             '(only with partition)')
     parser.add_argument('partition', nargs='?', default='')
 
     args = parser.parse_args()
+    if args.micro_optimize and args.partition != 'partition':
+        parser.error('--micro-optimize requires partition')
     bench(args.host, args.port, args.partition == 'partition',
           args.load, args.execute,
-          args.scale_factor, args.iterations)
+          args.scale_factor, args.iterations, args.micro_optimize)
@@ -1,4 +1,5 @@
 import ast
+import bisect
 import byteplay
 import collections
 import copy
@@ -7,16 +8,19 @@ import functools
 import hashlib
 import inspect
 import msgpack
+import multiprocessing.pool
 import os
 import re
 import redis
 import sully
+import threading
 import time
 
 from .identify import *
-
-#: The string literal to use for tabs in generated Lua code
-TAB = '  '
+from . import commands
+from . import infer
+from . import ir
+from .passes import NameReplacer, PassManager, only_reads
 
 #: Types which should be serialized via msgpack
 PACKED_TYPES = (list, dict, types.NoneType, datetime.datetime)
@@ -32,6 +36,20 @@ UNPIPELINED_CODE = """
 local __PIPE_ADD = function(key, value) return value end
 """
 
+#: A loop which executes the body of a script for many sets of arguments
+VECTORIZED_CODE = open(os.path.dirname(__file__) +
+                       '/lua/vectorized.lua').read()
+
+#: Return values from vectorized scripts are collected before packing
+VECTORIZED_RETVAL = """
+local __RETVAL = function(value, retval)
+  return {["__value"] = value, ["__return"] = retval}
+end
+"""
+
+#: The maximum number of type-specialized scripts kept for a fragment
+MAX_SCRIPT_VARIANTS = 8
+
 #: Function names which we assume are builtins
 FUNC_BUILTINS = ('append', 'insert', 'join', 'replace')
 
@@ -47,6 +65,30 @@ LUA_DEBUG = False
 # This was updated in v3 of the Redis Python library
 PIPELINE_CLASS = getattr(redis.client, 'BasePipeline', redis.client.Pipeline)
 
+#: The class used for clients of a Redis Cluster
+# This was added in v4.1 of the Redis Python library
+CLUSTER_CLASS = getattr(redis, 'RedisCluster', None)
+
+#: Classes of clients which are passed to functions running on the server
+CLIENT_CLASSES = tuple(cls for cls in (redis.StrictRedis, CLUSTER_CLASS)
+                       if cls is not None)
+
+#: The error given when a node of a cluster no longer serves a slot
+MOVED_ERROR = getattr(redis.exceptions, 'MovedError', ())
+
+#: A use of a key by a Redis command in a fragment which may be computed
+#: before the script runs and has a hash tag with the given parts
+KeyUse = collections.namedtuple('KeyUse', ['node', 'code', 'computable',
+                                           'tag'])
+
+#: Types of values which scripts may return as native Redis replies
+#: instead of packing them (dicts need a client using RESP3)
+NATIVE_REPLY_TYPES = (infer.BOOLEAN, infer.DICT, infer.LIST, infer.NUMBER,
+                      infer.STRING)
+
+#: The reply type of scripts which store lists they return in a key
+STREAM_REPLY = 'stream'
+
 
 def decode_msgpack(obj):
     # TODO: Convert datetime objects back
@@ -59,135 +101,533 @@ def encode_msgpack(obj):
     return obj
 
 
-# A block of Lua code consisting of LuaLine objects
-class LuaBlock(object):
-    def __init__(self, lines=None):
-        if lines is None:
-            lines = []
+def uses_resp3(client):
+    """Check if a client is connected with RESP3 (redis-py 5+)"""
 
-        self.lines = []
-        self.names = set()
-        for line in lines:
-            self.append(line)
+    pool = getattr(client, 'connection_pool', None)
+    return pool is not None and \
+        str(pool.connection_kwargs.get('protocol')) == '3'
 
-    @property
-    def code(self):
-        return ''.join(line.code for line in self.lines)
 
-    def append(self, line):
-        if not line:
-            return
+def arg_type(arg):
+    """Get the type used to generate code for an argument to a script"""
+
+    if isinstance(arg, (int, long, float)):
+        return 'number'
+    elif isinstance(arg, dict):
+        return 'dict'
+    elif isinstance(arg, list):
+        return 'list'
+    elif isinstance(arg, PACKED_TYPES):
+        return 'packed'
+    else:
+        return 'string'
 
-        self.lines.append(line)
-        self.names.update(line.names)
-        line.names = set()
 
-    def extend(self, block):
-        for line in block.lines:
-            if not line:
+def lua_definitions(*sources):
+    """Split Lua code into the local variables it defines
+
+    This returns any code before the first definition and a dictionary
+    mapping each name to the code which defines it. Comments before a
+    definition are kept with it. Later definitions of the same name
+    replace earlier ones.
+    """
+
+    preamble = ''
+    definitions = collections.OrderedDict()
+    for source in sources:
+        name = None
+        pending = ''
+        for line in source.splitlines(True):
+            match = re.match(r'^local ([A-Za-z_][A-Za-z0-9_]*)', line)
+            if line.strip() == '' or line.startswith('--'):
+                pending += line
                 continue
+            elif match:
+                name = match.group(1)
+                definitions[name] = ''
+
+            if name is None:
+                preamble += pending + line
+            else:
+                definitions[name] += pending + line
+            pending = ''
+
+        if name is None:
+            preamble += pending
+        else:
+            definitions[name] += pending
+
+    return preamble, definitions
+
+
+def used_definitions(preamble, definitions, names):
+    """Get the code for the definitions needed by code using some names"""
+
+    needed = set()
+    todo = [name for name in names if name in definitions]
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(other for other in ir.raw_names(definitions[name])
+                        if other in definitions)
+
+    return preamble + ''.join(code for name, code in definitions.items()
+                              if name in needed)
+
 
-            self.append(line)
+def strip_comment(line):
+    """Remove a comment from the end of a line of Lua code"""
 
-        self.names.update(block.names)
+    quote = None
+    i = 0
+    while i < len(line):
+        char = line[i]
+        if quote:
+            if char == '\\':
+                i += 1
+            elif char == quote:
+                quote = None
+        elif char in ('"', "'"):
+            quote = char
+        elif line.startswith('--', i):
+            return line[:i]
+        i += 1
 
-    def __getitem__(self, *args):
-        return self.lines.__getitem__(*args)
+    return line
 
-    def __len__(self):
-        return len(self.lines)
 
-    def __iter__(self):
-        return iter(self.lines)
+def minify_lua(code):
+    """Remove indentation, comments, and blank lines from Lua code
 
-    def __repr__(self):
-        return '(' + repr(list(self.names)) + ', ' + \
-               '[' + ''.join(repr(line) for line in self.lines) + ']' + ')'
+    The code must not contain long strings or long comments.
+    """
 
-    def __str__(self):
-        if len(self.names) > 0:
-            code = '\n'.join('local %s;' % name for name in self.names) + '\n'
+    lines = []
+    for line in code.splitlines():
+        line = strip_comment(line).strip()
+        if line:
+            lines.append(line)
+
+    return '\n'.join(lines) + '\n'
+
+
+def lua_debug(message, *args):
+    """Produce a statement which publishes a debug message from Lua"""
+
+    if not LUA_DEBUG:
+        return None
+
+    # Format using arguments if provided
+    if len(args) > 0:
+        message = ir.Call(ir.Index(ir.Name('string'), ir.Const('format')),
+                          [ir.Const(message)] +
+                          [ir.Call('tostring', [copy.deepcopy(arg)])
+                           for arg in args])
+    else:
+        message = ir.Const(message)
+
+    # Publish the message to the debug channel
+    return ir.CallStmt(ir.RedisCall('publish', [ir.Const(DEBUG_LOG_CHANNEL),
+                                                message]))
+
+
+#: A script variant registered as a function in its own Redis function
+#: library with the code used to load the library
+LibraryFunction = collections.namedtuple('LibraryFunction',
+                                         ['library', 'name', 'script',
+                                          'read_only', 'reply_type', 'code'])
+
+
+class FunctionLibrary(object):
+    """A group of Redis functions (Redis 7+) holding the scripts of many
+    fragments
+
+    Each function is loaded in a separate library which defines the
+    helpers from the header it uses once when loaded instead of on every
+    call. Libraries are named by a hash of their code and only loaded
+    with FUNCTION LOAD when a server is missing them, so processes with
+    different functions never replace each other's libraries and a new
+    version of a function is loaded alongside the old one.
+    """
+
+    #: Libraries by name
+    LIBRARIES = {}
+
+    def __init__(self, name):
+        self.name = re.sub(r'[^A-Za-z0-9_]', '_', name)
+        self.functions = collections.OrderedDict()
+
+    @classmethod
+    def get(cls, name):
+        """Get the library with a given name creating it if needed"""
+
+        if name not in cls.LIBRARIES:
+            cls.LIBRARIES[name] = cls(name)
+        return cls.LIBRARIES[name]
+
+    def add_function(self, lua_code, read_only, reply_type=None):
+        """Add a function running a script body (using ARGV for its
+        arguments) to the library"""
+
+        # Only helpers used by the function are defined
+        _, definitions = lua_definitions(LUA_HEADER)
+        helpers = used_definitions('', definitions, ir.raw_names(lua_code))
+        name = '%s_%s' % (self.name,
+                          hashlib.md5(helpers + lua_code).hexdigest())
+        if name in self.functions:
+            return self.functions[name]
+
+        flags = "{'no-writes'}" if read_only else '{}'
+        code = '#!lua name=%s\n%s' % (name, helpers)
+        code += 'redis.register_function{function_name=%s, ' \
+                'flags=%s, callback=function(KEYS, ARGV)\n%send}\n' % \
+                (ir.Const(name).render(), flags, lua_code)
+        if not LUA_DEBUG:
+            code = minify_lua(code)
+
+        self.functions[name] = LibraryFunction(self, name, lua_code,
+                                               read_only, reply_type, code)
+        return self.functions[name]
+
+
+class ReplicaSet(object):
+    """Clients for replicas which can run scripts that only read
+
+    Replicas are chosen in turn with the 'round_robin' strategy or by the
+    lowest average time taken by recent calls with 'latency'. Replicas
+    may lag behind the primary so scripts run on them may not see the
+    results of recent writes.
+    """
+
+    #: Weight given to the latest call in the average latency
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, clients, strategy='round_robin'):
+        if strategy not in ('round_robin', 'latency'):
+            raise ValueError('Unknown replica strategy %s' % strategy)
+
+        self.clients = list(clients)
+        self.strategy = strategy
+        self.latencies = [0.0] * len(self.clients)
+        self.next = 0
+
+    def choose(self):
+        """Get the client for the replica the next call should use"""
+
+        if self.strategy == 'latency':
+            index = self.latencies.index(min(self.latencies))
         else:
-            code = ''
+            index = self.next
+            self.next = (self.next + 1) % len(self.clients)
 
-        code += ''.join(str(line) for line in self.lines)
-        return code
+        return self.clients[index]
 
+    def record(self, client, elapsed):
+        """Record the time taken by a call to a replica"""
 
-# A line of Lua code which knows the line numbers of the corresponding Python
-class LuaLine(object):
-    def __init__(self, code, node=None, indent=0, names=set()):
-        self.code = code
-        self.node = node
-        self.indent = indent
-        self.names = names
+        for i, other in enumerate(self.clients):
+            if other is client:
+                self.latencies[i] += self.LATENCY_WEIGHT * \
+                    (elapsed - self.latencies[i])
+
+
+class HashRing(object):
+    """A consistent hash ring mapping keys to the clients for shards
+
+    Each shard is placed at many points on the ring so keys are spread
+    evenly and adding or removing a shard only moves keys to or from that
+    shard. Keys with a hash tag are placed using only the tag, as in a
+    Redis Cluster, so keys with the same tag are on the same shard.
+    """
+
+    #: The number of points on the ring for each shard
+    POINTS = 100
+
+    def __init__(self, clients, points=POINTS):
+        if len(clients) == 0:
+            raise ValueError('A hash ring needs at least one shard')
+
+        # Shards are identified by their server so the ring is the
+        # same regardless of the order clients are given
+        ring = []
+        for client in clients:
+            kwargs = client.connection_pool.connection_kwargs
+            name = '%s:%s:%s/%s' % (kwargs.get('host'), kwargs.get('port'),
+                                    kwargs.get('path'), kwargs.get('db'))
+            for i in range(points):
+                ring.append((self.hash('%s-%d' % (name, i)), client))
+        ring.sort(key=lambda point: point[0])
+
+        self.hashes = [point[0] for point in ring]
+        self.clients = [point[1] for point in ring]
 
     @staticmethod
-    def debug(message, *args):
-        if LUA_DEBUG:
-            # Escape quotes in the message
-            message = message.replace("'", "\\'")
-
-            # Format using arguments if provided
-            if len(args) > 0:
-                message = "string.format('%s', %s)" % \
-                          (message, ', '.join('tostring(%s)' % arg
-                                              for arg in args))
-            else:
-                message = "'%s'" % message
+    def hash(value):
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
 
-            # Publish the message to the debug channel
-            return LuaLine("redis.call('publish', '%s', %s);" %
-                           (DEBUG_LOG_CHANNEL, message))
-        else:
-            return None
+    def __call__(self, key):
+        """Get the client for the shard holding a key"""
+
+        if not isinstance(key, basestring):
+            key = str(key)
+        tag = hash_tag([key])
+        if tag is not None:
+            key = tag[0]
+
+        index = bisect.bisect(self.hashes, self.hash(key))
+        return self.clients[index % len(self.clients)]
+
+
+class DeferredResult(object):
+    """The result of a script queued on a pipeline
+
+    The result is available once the pipeline is executed, which also
+    gives the result in place of the reply from the script.
+    """
+
+    def __init__(self, script, args, keys):
+        self.script = script
+        self.args = args
+        self.keys = keys
+        self.finished = False
+        self.value = None
+        self.error = None
+
+    def done(self):
+        """Check if the pipeline holding the script was executed"""
+
+        return self.finished
 
-    def __repr__(self):
-        return repr(str(self))
+    def result(self):
+        """Get the value returned by the script or raise its error"""
 
-    def __str__(self):
-        return TAB * self.indent + self.code + '\n'
+        if not self.finished:
+            raise ValueError('The pipeline has not been executed')
+        elif self.error is not None:
+            raise self.error
+        else:
+            return self.value
 
 
 class ScriptRegistry(object):
     SCRIPTS = {}
 
+    #: Fragments whose functions call scripts, keyed by fragment ID
+    FRAGMENTS = {}
+
+    #: The SHAs of scripts we have loaded on each server
+    LOADED = collections.defaultdict(set)
+
+    #: Servers which don't support EVALSHA_RO (before Redis 7)
+    NO_READ_ONLY = set()
+
+    #: Servers which have been checked for EVALSHA_RO
+    CHECKED_READ_ONLY = set()
+
+    #: The number of threads used to run batches on many servers at once
+    FAN_OUT_THREADS = 8
+
+    #: Threads used to run batches (created when first needed)
+    POOL = None
+
+    #: Packers for arguments which are reused by each thread
+    PACKERS = threading.local()
+
     # Register the script and return its ID
     @classmethod
-    def register_script(cls, client, lua_code):
+    def register_script(cls, client, lua_code, read_only=False,
+                        reply_type=None):
         script = client.register_script(lua_code)
+        script.read_only = read_only
+        script.reply_type = reply_type
+
+        # Older versions of the client library only compute the SHA
+        # when the script is first loaded, but we need it up front
+        if not script.sha:
+            script.sha = hashlib.sha1(lua_code).hexdigest()
+
         script_id = hashlib.md5(lua_code).hexdigest()
         cls.SCRIPTS[script_id] = script
         return script_id
 
-    # Execute a pre-registered script
     @classmethod
-    def run_script(cls, client, script_id, args):
-        # Dump the necessary arguments with msgpack
-        for i in range(len(args)):
-            if isinstance(args[i], PACKED_TYPES):
-                args[i] = msgpack.packb(args[i], default=encode_msgpack)
+    def register_function(cls, library, lua_code, read_only=False,
+                          reply_type=None):
+        """Register a script body as a function in a library and return
+        its ID"""
+
+        function = library.add_function(lua_code, read_only, reply_type)
+        script_id = hashlib.md5(function.name).hexdigest()
+        cls.SCRIPTS[script_id] = function
+        return script_id
 
-        # Get the registered script
-        script = cls.SCRIPTS[script_id]
+    @staticmethod
+    def server_id(client):
+        """Identify the server a client (or pipeline) is connected to"""
 
-        # Ensure the script is loaded for pipelining
-        # XXX This makes assumptions on the client library
-        if isinstance(client, PIPELINE_CLASS):
-            cmd_exec = client.immediate_execute_command
+        # Scripts are cached per server so the database is irrelevant
+        kwargs = client.connection_pool.connection_kwargs
+        return (kwargs.get('host'), kwargs.get('port'), kwargs.get('path'))
+
+    @staticmethod
+    def loaded_id(script):
+        """Get the ID recorded for a script loaded on a server"""
+
+        if isinstance(script, LibraryFunction):
+            return script.name
         else:
-            cmd_exec = client.execute_command
+            return script.sha
 
-        if not script.sha or not cmd_exec('SCRIPT', 'EXISTS', script.sha,
-                                          **{'parse': 'EXISTS'})[0]:
-            script.sha = cmd_exec('SCRIPT', 'LOAD', script.script,
-                                  **{'parse': 'LOAD'})
+    @staticmethod
+    def load_command(script):
+        """Get the command and options used to load a script"""
 
-        # Execute the script and unpack the return value
-        retval = cmd_exec('EVALSHA', script.sha, 0, *args)
+        if isinstance(script, LibraryFunction):
+            return ('FUNCTION', 'LOAD', script.code), {}
+        else:
+            return ('SCRIPT', 'LOAD', script.script), {'parse': 'LOAD'}
+
+    @classmethod
+    def call_command(cls, server, script, args, keys=()):
+        """Get the command used to execute a script on a server
+
+        Scripts which only read are run with a read-only command so
+        they can also run on replicas.
+        """
+
+        if isinstance(script, LibraryFunction):
+            command = 'FCALL_RO' if script.read_only else 'FCALL'
+            name = script.name
+        elif getattr(script, 'read_only', False) and \
+                server not in cls.NO_READ_ONLY:
+            command, name = 'EVALSHA_RO', script.sha
+        else:
+            command, name = 'EVALSHA', script.sha
+
+        return (command, name, len(keys)) + tuple(keys) + tuple(args)
+
+    @classmethod
+    def check_read_only(cls, cmd_exec, server, script):
+        """Check once if a server has EVALSHA_RO before a read-only script
+        is first run there
+
+        The error from an unknown command echoes its arguments, which the
+        client may fail to decode when they are packed, so we check the
+        version of the server instead of trying the command.
+        """
+
+        if isinstance(script, LibraryFunction) or \
+                not getattr(script, 'read_only', False) or \
+                server in cls.CHECKED_READ_ONLY:
+            return
+
+        version = cmd_exec('INFO', 'server').get('redis_version', '')
+        major = re.match(r'[0-9]+', version)
+        if major is None or int(major.group()) < 7:
+            cls.NO_READ_ONLY.add(server)
+        cls.CHECKED_READ_ONLY.add(server)
+
+    @classmethod
+    def check_unsupported(cls, server, command, error):
+        """Check if an error is because a server doesn't have EVALSHA_RO
+        and avoid using it on that server if so"""
+
+        if command[0] == 'EVALSHA_RO' and \
+                isinstance(error, redis.exceptions.ResponseError) and \
+                'unknown command' in str(error).lower():
+            cls.NO_READ_ONLY.add(server)
+            return True
+
+        return False
+
+    @staticmethod
+    def is_missing(error):
+        """Check if an error is because a script is not loaded"""
+
+        return isinstance(error, redis.exceptions.NoScriptError) or \
+            (isinstance(error, redis.exceptions.ResponseError) and
+             str(error).lower().startswith('function not found'))
+
+    @staticmethod
+    def already_loaded(error):
+        """Check if an error is because another client loaded the same
+        library first"""
+
+        return isinstance(error, redis.exceptions.ResponseError) and \
+            'already exists' in str(error).lower()
+
+    @classmethod
+    def load_script(cls, cmd_exec, server, script):
+        """Load a script on a server and record that it is available"""
+
+        command, options = cls.load_command(script)
+        try:
+            reply = cmd_exec(*command, **options)
+        except redis.exceptions.ResponseError as e:
+            if not cls.already_loaded(e):
+                raise
+        else:
+            if not isinstance(script, LibraryFunction):
+                script.sha = reply
+        cls.LOADED[server].add(cls.loaded_id(script))
+
+    @classmethod
+    def evalsha(cls, cmd_exec, server, script, args, keys=()):
+        """Execute a script, loading it only if the server is missing it"""
+
+        # Optimistically assume the script exists since this saves a
+        # round trip in the common case
+        cls.check_read_only(cmd_exec, server, script)
+        command = cls.call_command(server, script, args, keys)
+        try:
+            retval = cmd_exec(*command)
+        except redis.exceptions.ResponseError as e:
+            if cls.check_unsupported(server, command, e):
+                return cls.evalsha(cmd_exec, server, script, args, keys)
+            elif not cls.is_missing(e):
+                raise
+
+            # The script cache was flushed or we failed over to a new
+            # server so nothing we loaded previously can be trusted
+            cls.LOADED[server].clear()
+            cls.load_script(cmd_exec, server, script)
+            retval = cmd_exec(*cls.call_command(server, script, args, keys))
+        else:
+            cls.LOADED[server].add(cls.loaded_id(script))
+
+        return retval
+
+    @classmethod
+    def decode_retval(cls, retval, reply_type=None, client=None):
+        """Unpack the value returned from a script
+
+        Scripts with a `reply_type` return values of that type as native
+        replies and pack anything else in a reply of a different kind.
+        Streamed lists are read from the server using `client`.
+        """
+
+        if reply_type == STREAM_REPLY:
+            packed = not isinstance(retval, list)
+        elif reply_type == infer.STRING:
+            packed = isinstance(retval, list)
+            if packed:
+                retval = retval[0]
+        else:
+            packed = reply_type is None or isinstance(retval, str)
 
         if retval is None:
             retval = {'__return': True}
+        elif not packed:
+            if reply_type == infer.BOOLEAN:
+                retval = bool(retval)
+            elif reply_type == infer.DICT and isinstance(retval, list):
+                # Maps are flattened for clients using RESP2
+                retval = dict(zip(retval[::2], retval[1::2]))
+            elif reply_type == STREAM_REPLY:
+                retval = cls.stream_items(client, *retval)
+            retval = {'__return': True, '__value': retval}
         else:
             retval = msgpack.unpackb(retval, object_hook=decode_msgpack)
 
@@ -197,6 +637,445 @@ class ScriptRegistry(object):
 
         return retval
 
+    @classmethod
+    def stream_items(cls, client, key, count, page_size):
+        """Generate the items of a list stored by a script, fetching a
+        page at a time and deleting the list when done"""
+
+        execute = cls.command_executor(client)
+        try:
+            for start in xrange(0, count, page_size):
+                page = execute('LRANGE', key, start, start + page_size - 1)
+                if len(page) == 0:
+                    raise ValueError('The streamed result has expired')
+
+                for item in page:
+                    yield msgpack.unpackb(item, object_hook=decode_msgpack)
+        finally:
+            if count > 0:
+                execute('DEL', key)
+
+    @classmethod
+    def pack(cls, value):
+        """Pack a value with msgpack using a packer for this thread"""
+
+        try:
+            packer = cls.PACKERS.packer
+        except AttributeError:
+            packer = cls.PACKERS.packer = msgpack.Packer(
+                default=encode_msgpack)
+
+        return packer.pack(value)
+
+    @classmethod
+    def encode_args(cls, args):
+        """Dump the necessary arguments with msgpack"""
+
+        return [cls.pack(arg) if isinstance(arg, PACKED_TYPES) else arg
+                for arg in args]
+
+    # Execute the script variant of a fragment matching the arguments
+    @classmethod
+    def run_fragment(cls, fragment_id, client, args, clients=()):
+        return cls.FRAGMENTS[fragment_id].run(client, args, clients)
+
+    # Execute a pre-registered script with encoded arguments
+    @classmethod
+    def run_script(cls, client, script_id, args, keys=()):
+        # Get the registered script
+        script = cls.SCRIPTS[script_id]
+
+        # Execute the script and unpack the return value
+        node = cls.node_client(client, keys)
+        try:
+            retval = cls.evalsha(cls.command_executor(node),
+                                 cls.server_id(node), script, args, keys)
+        except MOVED_ERROR:
+            # The cluster was resharded so we find the new node for the
+            # slot and try again
+            client.nodes_manager.initialize()
+            node = cls.node_client(client, keys)
+            retval = cls.evalsha(cls.command_executor(node),
+                                 cls.server_id(node), script, args, keys)
+
+        return cls.decode_retval(retval, script.reply_type, node)
+
+    @staticmethod
+    def node_client(client, keys):
+        """Get the client for the node of a cluster serving the slot of
+        the keys given to a script (or the client itself otherwise)"""
+
+        if CLUSTER_CLASS is None or not isinstance(client, CLUSTER_CLASS):
+            return client
+
+        # All keys hash to the same slot so the first is enough
+        if len(keys) > 0:
+            node = client.get_node_from_key(keys[0])
+        else:
+            node = client.get_default_node()
+        return node.redis_connection
+
+    @classmethod
+    def fan_out(cls, func, items):
+        """Call a function for each item in parallel if there are many"""
+
+        if len(items) <= 1:
+            return map(func, items)
+
+        if cls.POOL is None:
+            cls.POOL = multiprocessing.pool.ThreadPool(cls.FAN_OUT_THREADS)
+        return cls.POOL.map(func, items)
+
+    @classmethod
+    def queue_script(cls, pipe, script_id, args, keys=()):
+        """Queue a script on a pipeline instead of running it now
+
+        The script is loaded in the same pipeline if the server may not
+        have it. This returns a DeferredResult which is available when
+        the pipeline is executed. Arguments must already be encoded.
+        """
+
+        script = cls.SCRIPTS[script_id]
+        server = cls.server_id(pipe)
+
+        # Replies to the commands we queue are handled when the pipeline
+        # is executed, so we wrap execute until then. Resetting the
+        # pipeline (also done when leaving a with block) drops the
+        # commands so it removes the wrappers too
+        # XXX This makes assumptions on the client library
+        if 'execute' not in pipe.__dict__:
+            pipe.locomotor_queued = []
+            pipe.execute = functools.partial(cls.execute_pipeline, pipe,
+                                             pipe.execute)
+            pipe.reset = functools.partial(cls.reset_pipeline, pipe,
+                                           pipe.reset)
+
+        if cls.loaded_id(script) not in cls.LOADED[server]:
+            command, options = cls.load_command(script)
+            pipe.execute_command(*command, **options)
+            pipe.locomotor_queued.append((len(pipe.command_stack) - 1,
+                                          script))
+
+        result = DeferredResult(script, args, keys)
+        cls.check_read_only(pipe.immediate_execute_command, server, script)
+        pipe.execute_command(*cls.call_command(server, script, args, keys))
+        pipe.locomotor_queued.append((len(pipe.command_stack) - 1, result))
+        return result
+
+    @staticmethod
+    def unwrap_pipeline(pipe):
+        """Remove the wrappers added to a pipeline by `queue_script`"""
+
+        for name in ('execute', 'reset', 'locomotor_queued'):
+            pipe.__dict__.pop(name, None)
+
+    @classmethod
+    def reset_pipeline(cls, pipe, reset):
+        """Reset a pipeline, forgetting the scripts queued on it"""
+
+        cls.unwrap_pipeline(pipe)
+        return reset()
+
+    @classmethod
+    def execute_pipeline(cls, pipe, execute, raise_on_error=True):
+        """Execute a pipeline with queued scripts replacing the replies
+        from each script with its result
+
+        Scripts which were missing on the server are run again after the
+        pipeline, except in a transaction where that wouldn't be atomic.
+        The script's result is then an error and it is loaded the next
+        time it is queued.
+        """
+
+        queued = pipe.locomotor_queued
+        cls.unwrap_pipeline(pipe)
+        replies = execute(raise_on_error=False)
+
+        server = cls.server_id(pipe)
+        transaction = pipe.transaction or pipe.explicit_transaction
+        for index, result in reversed(queued):
+            reply = replies[index]
+
+            # Replies to loading scripts are hidden from the caller
+            if not isinstance(result, DeferredResult):
+                if not isinstance(reply, Exception) or \
+                        cls.already_loaded(reply):
+                    cls.LOADED[server].add(cls.loaded_id(result))
+                del replies[index]
+                continue
+
+            # If the script was missing we have no choice but to run it
+            # now, after the rest of the pipeline. That would break the
+            # atomicity of a transaction so we fail it there instead
+            command = cls.call_command(server, result.script, result.args,
+                                       result.keys)
+            missing = cls.check_unsupported(server, command, reply) or \
+                cls.is_missing(reply)
+            if missing and transaction:
+                cls.LOADED[server].discard(cls.loaded_id(result.script))
+                reply = redis.exceptions.ResponseError(
+                    'Script was missing in a transaction, so it was not '
+                    'run: %s' % reply)
+            elif missing:
+                try:
+                    reply = cls.evalsha(pipe.immediate_execute_command,
+                                        server, result.script, result.args,
+                                        result.keys)
+                except redis.exceptions.ResponseError as e:
+                    reply = e
+
+            if isinstance(reply, Exception):
+                result.error = reply
+                replies[index] = reply
+            else:
+                result.value = cls.decode_retval(
+                    reply, result.script.reply_type, pipe)['__value']
+                replies[index] = result.value
+            result.finished = True
+
+        if raise_on_error:
+            for reply in replies:
+                if isinstance(reply, Exception):
+                    raise reply
+
+        return replies
+
+    @staticmethod
+    def command_executor(client):
+        """Get the function used to execute commands on a client"""
+
+        # Pipelined scripts must be executed immediately
+        # XXX This makes assumptions on the client library
+        if isinstance(client, PIPELINE_CLASS):
+            return client.immediate_execute_command
+        else:
+            return client.execute_command
+
+    # Execute a vectorized script over many tuples of arguments at once
+    @classmethod
+    def run_vectorized(cls, client, script_id, arg_tuples, args):
+        args = [cls.pack(arg_tuples)] + cls.encode_args(args)
+        script = cls.SCRIPTS[script_id]
+
+        retval = cls.evalsha(cls.command_executor(client),
+                             cls.server_id(client), script, args)
+
+        results = []
+        for value in msgpack.unpackb(retval, object_hook=decode_msgpack):
+            # An empty table means the body finished without returning
+            if not value:
+                value = {'__return': True}
+
+            if '__error' in value:
+                value = redis.exceptions.ResponseError(value['__error'])
+            elif '__value' not in value:
+                value['__value'] = None
+
+            results.append(value)
+
+        return results
+
+    # Execute a pre-registered script many times in one round trip
+    # with encoded arguments
+    @classmethod
+    def run_batch(cls, client, script_id, arg_lists, key_lists=None):
+        if key_lists is None:
+            key_lists = [()] * len(arg_lists)
+        script = cls.SCRIPTS[script_id]
+        server = cls.server_id(client)
+        cls.check_read_only(client.execute_command, server, script)
+
+        results = [None] * len(arg_lists)
+        pending = range(len(arg_lists))
+        for attempt in range(3):
+            pipe = client.pipeline(transaction=False)
+
+            # Load the script in the same pipeline if the server may not
+            # have it so we don't pay for an additional round trip
+            load = cls.loaded_id(script) not in cls.LOADED[server]
+            if load:
+                command, options = cls.load_command(script)
+                pipe.execute_command(*command, **options)
+
+            commands = [cls.call_command(server, script, arg_lists[i],
+                                         key_lists[i])
+                        for i in pending]
+            for command in commands:
+                pipe.execute_command(*command)
+            replies = pipe.execute(raise_on_error=False)
+
+            if load:
+                if isinstance(replies[0], Exception) and \
+                        not cls.already_loaded(replies[0]):
+                    raise replies[0]
+                replies.pop(0)
+                cls.LOADED[server].add(cls.loaded_id(script))
+
+            # Failed calls are reported individually, but we retry once
+            # if the script was flushed while we were executing and once
+            # if the server doesn't support read-only scripts
+            missing = []
+            unsupported = False
+            for i, command, reply in zip(pending, commands, replies):
+                if cls.check_unsupported(server, command, reply):
+                    missing.append(i)
+                    results[i] = reply
+                    unsupported = True
+                elif cls.is_missing(reply):
+                    missing.append(i)
+                    results[i] = reply
+                elif isinstance(reply, Exception):
+                    results[i] = reply
+                else:
+                    results[i] = cls.decode_retval(reply, script.reply_type,
+                                                   client)
+
+            if len(missing) == 0:
+                break
+
+            if not unsupported:
+                cls.LOADED[server].clear()
+            pending = missing
+
+        return results
+
+
+def loop_exits(body):
+    """Check if the body of a loop contains break or continue statements
+    which apply to the loop itself (and not a nested loop)"""
+
+    has_break = has_continue = False
+    todo = list(body)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, ast.Break):
+            has_break = True
+        elif isinstance(node, ast.Continue):
+            has_continue = True
+        elif isinstance(node, (ast.For, ast.While)):
+            # The else clause of a nested loop is part of this loop
+            todo.extend(node.orelse)
+        elif not isinstance(node, (ast.FunctionDef, ast.ClassDef,
+                                   ast.Lambda)):
+            todo.extend(ast.iter_child_nodes(node))
+
+    return has_break, has_continue
+
+
+def header_exprs(stmt):
+    """Get the expressions evaluated when a statement starts executing
+    (excluding the statements in any nested blocks)"""
+
+    exprs = []
+    for field in stmt._fields:
+        value = getattr(stmt, field)
+        if isinstance(value, ir.Expr):
+            exprs.append(value)
+        elif isinstance(value, list):
+            exprs.extend(v for v in value if isinstance(v, ir.Expr))
+
+    return exprs
+
+
+def code_is_pure(code):
+    """Check if running a list of statements can have side effects
+    other than assigning local variables"""
+
+    for node in ir.walk(ir.Block(code)):
+        if isinstance(node, ir.Stmt) and \
+                not all(ir.is_pure(expr) for expr in header_exprs(node)):
+            return False
+        elif isinstance(node, ir.Assign) and \
+                not all(isinstance(t, ir.Name) for t in node.targets):
+            return False
+
+    return True
+
+
+def early_effects(expr, names):
+    """Check if evaluating an expression may have side effects before
+    any of the given variables are read"""
+
+    if not any(isinstance(node, ir.Name) and node.id in names
+               for node in ir.walk(expr)):
+        return not ir.is_pure(expr)
+
+    # Calls using the variables only run after they are read
+    return any(early_effects(child, names)
+               for child in ir.iter_child_nodes(expr))
+
+
+def key_parts(node):
+    """Split a Python expression producing a key into the constant
+    strings and other string expressions which are concatenated"""
+
+    if isinstance(node, ast.Str):
+        return [node.s]
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+        return key_parts(node.left) + key_parts(node.right)
+    elif isinstance(node, ast.BinOp) and isinstance(node.op, ast.Mod) and \
+            isinstance(node.left, ast.Str):
+        # Simple formatting is the same as converting each value
+        if isinstance(node.right, ast.Tuple):
+            values = node.right.elts
+        else:
+            values = [node.right]
+        conversions = re.findall(r'%.', node.left.s)
+        if len(conversions) != len(values) or \
+                any(conversion not in ('%s', '%d', '%i')
+                    for conversion in conversions):
+            return [node]
+
+        pieces = re.split(r'%.', node.left.s)
+        parts = [pieces[0]]
+        for conversion, value, piece in zip(conversions, values, pieces[1:]):
+            if conversion != '%s':
+                value = ast.Call(ast.Name('int', ast.Load()), [value], [],
+                                 None, None)
+            parts.extend([ast.Call(ast.Name('str', ast.Load()), [value], [],
+                                   None, None), piece])
+        return parts
+    else:
+        return [node]
+
+
+def hash_tag(parts):
+    """Get the parts of a key between the braces of its hash tag
+
+    This is None if the key may not have a hash tag. Constant strings in
+    the result are merged and empty strings are removed.
+    """
+
+    tag = None
+    for part in parts:
+        if tag is None:
+            # Any expression before the tag could contain a brace
+            if not isinstance(part, basestring):
+                return None
+            elif '{' not in part:
+                continue
+
+            tag = []
+            part = part[part.index('{') + 1:]
+
+        if isinstance(part, basestring) and '}' in part:
+            tag.append(part[:part.index('}')])
+            break
+        tag.append(part)
+    else:
+        return None
+
+    merged = []
+    for part in tag:
+        if isinstance(part, basestring) and len(merged) > 0 and \
+                isinstance(merged[-1], basestring):
+            merged[-1] += part
+        elif part != '':
+            merged.append(part)
+
+    # The whole key is hashed if the tag is empty
+    return merged or None
+
 
 class UntranslatableCodeException(Exception):
     """Exception raised when code can't be translated"""
@@ -206,9 +1085,23 @@ class UntranslatableCodeException(Exception):
         message = ast.dump(node)
         super(UntranslatableCodeException, self).__init__(message)
 
+
+class CrossSlotException(Exception):
+    """Exception raised when keys used by code may not all hash to the
+    same slot of a Redis Cluster"""
+
+    def __init__(self, problems):
+        self.problems = problems
+        message = 'Keys may hash to different slots:\n' + \
+            '\n'.join('  ' + problem for problem in problems)
+        super(CrossSlotException, self).__init__(message)
+
+
 class RedisFuncFragment(object):
     def __init__(self, taint, minlineno=None, maxlineno=None,
-                 redis_objs=None, helper=False):
+                 redis_objs=None, helper=False, type_hints=None, passes=None,
+                 library=None, replicas=None, cluster=False, shards=None,
+                 deferred=False, native_replies=True, stream_size=None):
         self.taint = taint
         if redis_objs:
             self.redis_objs = []
@@ -251,6 +1144,10 @@ class RedisFuncFragment(object):
         self.minlineno = minlineno
         self.maxlineno = maxlineno
 
+        # Track whether code before or after the fragment runs locally
+        self.partial = minlineno != body_ast.minlineno or \
+            maxlineno != body_ast.maxlineno
+
         # Translate the expressions to a more useful format
         self.in_exprs.difference_update(self.arg_names)
         self.in_exprs = self.arg_names + self.rename_expressions(self.in_exprs)
@@ -263,20 +1160,125 @@ class RedisFuncFragment(object):
         self.helper = helper
         self.constants = {}
 
-        # Generate the code for the body of the method
-        self.body = LuaBlock()
-        for node in self.taint.func_ast.body[0].body:
-            # Ignore lines we don't want to translate
-            if node.lineno < self.minlineno:
-                continue
-            if node.lineno > self.maxlineno:
-                break
+        # Types of variables given by the user override anything inferred
+        self.type_hints = dict((name, infer.hint_type(hint))
+                               for name, hint in (type_hints or {}).items())
+        self.fragment_id = '%x' % id(self)
+
+        # Optimizations are run on each script after it is generated
+        self.pass_manager = PassManager(passes)
+
+        # Scripts are run with EVALSHA unless given a function library
+        if library is not None:
+            library = FunctionLibrary.get(library)
+        self.library = library
+        self.read_only = None
+
+        # Scripts which only read may run on replicas
+        if replicas is not None and not isinstance(replicas, ReplicaSet):
+            replicas = ReplicaSet(replicas)
+        self.replicas = replicas
+
+        # Keys are given to scripts on a cluster or shards so calls can
+        # be routed to the node holding them
+        if (cluster or shards is not None) and replicas is not None:
+            raise ValueError('Replicas can\'t be used with a cluster '
+                             'or shards')
+        self.cluster = cluster or shards is not None
+        self.shards = shards
+        self.helper_keys = []
+
+        # Scripts called with a pipeline may be queued on the pipeline
+        self.deferred = deferred
+
+        # Simple values are returned as native replies unless disabled
+        self.native_replies = native_replies
+        self.reply_type = None
+
+        # Large lists may be streamed through a key on the server, but
+        # the key could be on a different node from the others we use
+        if stream_size is not None and self.cluster:
+            raise ValueError('Results can\'t be streamed from a cluster '
+                             'or shards')
+        self.stream_size = stream_size
+
+        # Objects on different servers are used by separate scripts
+        # and variables needed by later scripts are returned
+        self.exports = None
+        self.splits = {}
 
-            block = self.process_node(node, 1 if helper else 0)
-            self.body.extend(block)
-
-        # Initialize the script ID to None, we'll register it Later
-        self.script_id = None
+        # Generate the code for the body of the method
+        self.arg_types = {}
+        self.body = self.translate()
+
+        # Scripts are specialized for the types of their arguments
+        # and generated when first called with a new set of types
+        self.patched = False
+        self.stub = self.first_call
+        self.helper_code = None
+        self.variants = collections.OrderedDict()
+        self.signatures = {}
+        self.max_variants = MAX_SCRIPT_VARIANTS
+        self.stats = collections.Counter()
+
+    def translate(self, arg_types=None):
+        """Generate the code for the body assuming the given argument types"""
+
+        # Make the types visible to the methods generating code
+        self.arg_types = arg_types or {}
+
+        # Ignore lines we don't want to translate
+        nodes = [node for node in self.taint.func_ast.body[0].body
+                 if self.minlineno <= node.lineno <= self.maxlineno]
+
+        # Infer what we can about the types of local variables
+        types = dict((name, infer.ANY if arg_type == 'packed' else arg_type)
+                     for name, arg_type in self.arg_types.items())
+        self.types = infer.TypeInference(nodes, types, self.redis_objs,
+                                         self.constant_value, self.type_hints)
+
+        # Results of Redis calls only need to be saved for pipelines
+        self.pipelined = any(isinstance(child, ast.Call) and
+                             isinstance(child.func, ast.Attribute) and
+                             child.func.attr == 'execute'
+                             for node in nodes for child in ast.walk(node))
+
+        # Keys computed from arguments which are never reassigned
+        # can be computed before the script runs
+        self.assigned_names = set(
+            child.id for node in nodes for child in ast.walk(node)
+            if isinstance(child, ast.Name) and
+            not isinstance(child.ctx, ast.Load))
+        self.keys = []
+        self.key_problems = []
+        self.key_exprs = []
+        self.key_function = None
+        self.final_returns = []
+
+        self.local_names = set()
+        self.continue_loops = set()
+        self.pending = []
+        self.bool_count = 0
+        body = ir.Block()
+        for node in nodes:
+            body.extend(self.process_node(node))
+
+        if self.cluster:
+            self.check_slots()
+
+        if self.exports is not None:
+            body.append(ir.Return([ir.Call('__RETVAL', [
+                ir.Table(ir.Pair(ir.Const(name), ir.Name(name))
+                         for name in self.exports),
+                ir.Const(False)])]))
+
+        # Declare all assigned variables as local to the script
+        # except for arguments which were declared when unpacked
+        local_names = sorted(self.local_names.difference(self.in_exprs))
+        if len(local_names) > 0:
+            body.body.insert(0, ir.Local(local_names))
+
+        return body
 
     def rename_expressions(self, expressions):
         """Rename all expressions in a list to their appropriate names"""
@@ -298,20 +1300,8 @@ class RedisFuncFragment(object):
 
         return outlist
 
-    def convert_value(self, value):
-        """Convert the value to a string representation in Lua"""
-
-        if value is None:
-            return 'nil'
-        elif type(value) is str:
-            # XXX Lua probably doesn't follow the exact same escaping rules
-            #     but this will work for a lot of simple cases
-            return "'" + value.encode('string_escape') + "'"
-        else:
-            return str(value)
-
-    def get_constant(self, expr):
-        """Get the value for a constant expression"""
+    def constant_value(self, expr):
+        """Get the Python value of a constant expression"""
 
         try:
             # Try to find this constant in the globals dictionary
@@ -324,205 +1314,334 @@ class RedisFuncFragment(object):
         if len(expr) > 1:
             value = getattr(value, expr[1])
 
-        return self.convert_value(value)
+        return value
 
-    def process_node(self, node, indent=0, loops = 0):
-        """Generate code for a single node at a particular indentation level"""
+    def process_node(self, node, loops=0):
+        """Generate code for a single node nested in some number of loops
 
-        code = []
+        Expressions produce a single expression while
+        statements produce a list of statements.
+        """
 
         # Call the corresponding method or produce an error
         try:
-            cls = node.__class__.__name__
-            getattr(self, 'process_' + cls)(node, code, indent, loops)
-        except KeyError:
+            method = getattr(self, 'process_' + node.__class__.__name__)
+        except AttributeError:
             # XXX This type of node is not handled
             raise UntranslatableCodeException(node)
 
-        return LuaBlock(code)
+        if not isinstance(node, ast.stmt):
+            return method(node, loops)
+
+        # Collect code which must run before the statement
+        self.pending.append([])
+        code = method(node, loops)
+        return self.insert_pending(code, self.pending.pop())
+
+    def insert_pending(self, code, pending):
+        """Run the code computing temporaries before a statement
 
-    def process_Assign(self, node, code, indent, loops):
+        Each element of pending is a temporary name and the code which
+        assigns it. Temporaries are scoped to a do block so they don't
+        count against the limit on local variables in the script.
+        """
+
+        if len(pending) == 0:
+            return code
+        code = ir.Block(code)
+
+        # Computing values early must not reorder side effects, so
+        # fall back to evaluating them inline in a closure if needed
+        names = set(name for name, _ in pending)
+        impure = sum(not code_is_pure(temp_code) for _, temp_code in pending)
+        impure += sum(early_effects(expr, names)
+                      for stmt in code for expr in header_exprs(stmt))
+        if impure <= 1:
+            return [ir.Do(ir.Block(self.pending_code(pending) + code.body))]
+
+        pending = [(name, ir.Block(temp_code)) for name, temp_code in pending]
+        for i, (name, temp_code) in enumerate(pending):
+            closure = ir.Call(ir.Paren(ir.Function([], ir.Block(
+                temp_code.body + [ir.Return([ir.Name(name)])]))))
+            replacer = NameReplacer(name, closure)
+            for _, later_code in pending[i + 1:]:
+                replacer.visit(later_code)
+            replacer.visit(code)
+
+        return code.body
+
+    def pending_code(self, pending):
+        """Get the statements which compute a list of temporaries"""
+
+        return [stmt for _, temp_code in pending for stmt in temp_code]
+
+    def process_Assign(self, node, loops):
         """Generate code for an assignment operation"""
-        value = self.process_node(node.value, indent, loops).code
 
+        value = self.process_node(node.value, loops)
+
+        code = []
         for var in node.targets:
             if isinstance(var, ast.Name):
-                name = var.id
-            elif isinstance(var, (ast.Attribute, ast.Subscript)) and \
-                    isinstance(var.value, ast.Name):
-                name = var.value.id
-            else:
+                self.local_names.add(var.id)
+            elif not (isinstance(var, (ast.Attribute, ast.Subscript)) and
+                      isinstance(var.value, ast.Name)):
                 raise UntranslatableCodeException(node)
 
-            var = self.process_node(var).code
-            names = set([name])
-            line = '%s = %s;' % (var, value)
-            code.append(LuaLine(line, node, indent, names))
+            target = self.process_node(var, loops)
+            code.append(ir.Assign([target], [value]))
+
+            # Avoid evaluating the value again for other targets
+            if isinstance(target, ir.Name) and not ir.is_pure(value):
+                value = ir.Name(target.id)
+            else:
+                value = copy.deepcopy(value)
 
         if LUA_DEBUG:
-            code.append(LuaLine.debug('ASSIGNING %%s TO %s' %
-                                      ', '.join(v.id for v in node.targets),
-                                      value))
+            code.append(lua_debug('ASSIGNING %%s TO %s' %
+                                  ', '.join(stmt.targets[0].render()
+                                            for stmt in code),
+                                  value))
 
-    def process_Attribute(self, node, code, indent, loops):
+        return code
+
+    def process_Attribute(self, node, loops):
         """Generate code for an attribute access x.y"""
 
-        obj = self.process_node(node.value).code
+        if not isinstance(node.value, ast.Name):
+            raise UntranslatableCodeException(node)
 
         # XXX Assume uppercase values are constants
-        if obj != 'self' and not node.attr.isupper():
+        if node.value.id != 'self' and not node.attr.isupper():
             # XXX We're probably doing some external stuff we can't handle
             raise UntranslatableCodeException(node)
 
-        if obj == 'self':
+        if node.value.id == 'self':
             # Access the Lua table corresponding to self
-            expr = 'self.' + node.attr
+            return ir.Index(ir.Name('self'), ir.Const(node.attr))
         else:
-            expr = self.get_constant((obj, node.attr))
+            return ir.Const(self.constant_value((node.value.id, node.attr)))
 
-        code.append(LuaLine(expr, node, indent))
-
-    def process_AugAssign(self, node, code, indent, loops):
+    def process_AugAssign(self, node, loops):
         """Generate code for agumented assignment (e.g. +=)"""
 
-        target = self.process_node(node.target).code
-        value = self.process_node(node.value).code
+        target = self.process_node(node.target, loops)
+        value = self.process_node(node.value, loops)
 
         if isinstance(node.op, ast.Add):
-            line = '%s = %s + %s' % (target, target, value)
+            value = self.add_values(node.target, node.value,
+                                    copy.deepcopy(target), value)
         else:
             # XXX Some unhandled operator
             raise UntranslatableCodeException(node)
 
-        code.append(LuaLine(line, node, indent))
+        if isinstance(node.target, ast.Name):
+            self.local_names.add(node.target.id)
+
+        return [ir.Assign([target], [value])]
 
-    def process_BinOp(self, node, code, indent, loops):
+    def process_BinOp(self, node, loops):
         """Generate code for a binary operator"""
 
-        op1 = self.process_node(node.left).code
-        op2 = self.process_node(node.right).code
+        op1 = self.process_node(node.left, loops)
+        op2 = self.process_node(node.right, loops)
 
         if isinstance(node.op, ast.Add):
-            int_add = False
-            for op in (node.left, node.right):
-                if isinstance(op, ast.Call) and isinstance(op.func, ast.Name) \
-                        and op.func.id in ('int', 'float'):
-                    int_add = True
-                    break
-
-            # Guess if either operand is a number
-            # XXX This will fail if we add two numerical variables
-            if int_add or op1.isdigit() or op2.isdigit():
-                op = ' + '
-            else:
-                op = ' .. '
+            return self.add_values(node.left, node.right, op1, op2)
         elif isinstance(node.op, ast.Sub):
-            op = ' - '
+            op = '-'
         elif isinstance(node.op, ast.Mod):
-            op = ' % '
+            op = '%'
         elif isinstance(node.op, ast.Mult):
-            op = ' * '
+            op = '*'
         elif isinstance(node.op, ast.Div):
-            op = ' / '
+            op = '/'
         elif isinstance(node.op, ast.Pow):
-            op = ' ^ '
+            op = '^'
         else:
             # XXX Some unhandled operator
             raise UntranslatableCodeException(node)
 
-        line = op1 + op + op2
-        code.append(LuaLine(line, node, indent))
+        return ir.BinOp(op, op1, op2)
+
+    def add_operator(self, left, right):
+        """Get the Lua operator to add or concatenate two values
+
+        This is None if the types of the values must be checked at runtime.
+        """
+
+        types = set([self.types.expr_type(left),
+                     self.types.expr_type(right)])
+
+        # Python can only add numbers to other numbers
+        # and strings to other strings
+        if infer.NUMBER in types:
+            return '+'
+        elif infer.STRING in types:
+            return '..'
+        else:
+            return None
+
+    def add_values(self, left, right, op1, op2):
+        """Generate code to add the values of two expressions"""
+
+        op = self.add_operator(left, right)
+        if op is None:
+            # Check the types at runtime
+            return ir.Call('__ADD', [op1, op2])
+        else:
+            return ir.BinOp(op, op1, op2)
 
-    def process_BoolOp(self, node, code, indent, loops):
-        """Generate code for a boolean operator"""
+    def process_BoolOp(self, node, loops):
+        """Generate code for a boolean operator
 
-        values = ['(' + self.process_node(n).code + ')' for n in node.values]
+        Lua's operators only match Python's when every value but the
+        last is a boolean or None. Otherwise the result is computed in
+        a temporary before the statement using Python's notion of truth.
+        """
 
         if isinstance(node.op, ast.Or):
-            op = '__OR'
+            op = 'or'
         elif isinstance(node.op, ast.And):
-            op = '__AND'
+            op = 'and'
         else:
             # XXX Some unhandled operator
             raise UntranslatableCodeException(node)
 
-        line = '%s(%s)' % (op, ', '.join(values))
-        code.append(LuaLine(line, node, indent))
+        first = self.process_node(node.values[0], loops)
+
+        # Code for later values must only run if the value is needed
+        rest = []
+        for value in node.values[1:]:
+            self.pending.append([])
+            expr = self.process_node(value, loops)
+            rest.append((self.pending.pop(), expr))
+
+        types = [self.known_type(n) for n in node.values[:-1]]
+        if all(t in (infer.BOOLEAN, infer.NIL) for t in types) and \
+                not any(pending for pending, _ in rest):
+            result = first
+            for _, expr in rest:
+                result = ir.BinOp(op, result, expr)
+            return result
+
+        self.bool_count += 1
+        name = '__BOOL%d' % self.bool_count
+        code = [ir.Local([name], [first])]
+        block = code
+        for value, (pending, expr) in zip(node.values, rest):
+            test = self.truth_test(ir.Name(name), self.known_type(value))
+            if op == 'or':
+                test = ir.UnOp('not', test)
+
+            body = ir.Block(self.pending_code(pending) +
+                            [ir.Assign([ir.Name(name)], [expr])])
+            block.append(ir.If(test, body))
+            block = body.body
+
+        self.pending[-1].append((name, code))
+        return ir.Name(name)
+
+    def known_type(self, node):
+        """Get the type of an expression only if all of its possible
+        values are known to have the same type"""
+
+        if isinstance(node, ast.BoolOp):
+            types = set(self.known_type(value) for value in node.values)
+            return types.pop() if len(types) == 1 else None
+        else:
+            return self.types.expr_type(node)
+
+    def truth_test(self, expr, expr_type):
+        """Generate code to test if a value is true in Python
+
+        The expression may be evaluated more than once.
+        """
+
+        if expr_type in (infer.BOOLEAN, infer.NIL):
+            return expr
+        elif expr_type == infer.NUMBER:
+            test = ir.BinOp('~=', copy.deepcopy(expr), ir.Const(0))
+        elif expr_type == infer.STRING:
+            test = ir.BinOp('~=', copy.deepcopy(expr), ir.Const(''))
+        elif expr_type == infer.LIST:
+            test = ir.BinOp('>', ir.UnOp('#', copy.deepcopy(expr)),
+                            ir.Const(0))
+        else:
+            return ir.Call('__TRUE', [expr])
+
+        # Missing values from Redis are false in Lua
+        return ir.BinOp('and', expr, test)
 
-    def process_Call(self, node, code, indent, loops):
+    def process_Call(self, node, loops):
         """Generate code for a function call"""
 
         # We don't support positional or keyword arguments
         if node.starargs or node.kwargs:
             raise UntranslatableCodeException(node)
 
-        raw_args = [self.process_node(n) for n in node.args]
-        args = ', '.join(arg.code for arg in raw_args)
+        args = [self.process_node(n, loops) for n in node.args]
 
         # Handle some built-in functions
         if isinstance(node.func, ast.Name):
             if node.func.id in ('int', 'float'):
-                line = 'tonumber(%s)' % args
+                return ir.Call('tonumber', args)
             elif node.func.id == 'str':
-                line = 'tostring(%s)' % args
+                return ir.Call('tostring', args)
             elif node.func.id in ('range', 'xrange'):
-                # Extend to always use three arguments
-                if len(node.args) == 1:
-                    args = '0, %s - 1, 1' % args
-                elif len(node.args) == 2:
-                    args += ' - 1, 1'
-
-                line = args
+                return self.range_table(*self.range_bounds(args))
             elif node.func.id == 'len':
-                assert len(node.args) == 1
-                line = '#' + args
+                assert len(args) == 1
+                return ir.UnOp('#', args[0])
             else:
                 # XXX We don't know how to handle this function
                 raise UntranslatableCodeException(node)
 
         # XXX We assume now that the function being called is an Attribute
+        obj = self.process_node(node.func.value, loops)
 
         # Get the current time for time.time()
-        elif isinstance(node.func, ast.Attribute) and \
-                isinstance(node.func.value, ast.Name) and \
+        if isinstance(node.func.value, ast.Name) and \
                 node.func.value.id == node.func.attr == 'time':
-            line = '((function() local __TIME = redis.call("TIME"); ' \
-                   'return __TIME[1] + (__TIME[2] / 1000000) end)())'
-
-        # Perform string replacement
+            now = ir.Name('__TIME')
+            return ir.Call(ir.Paren(ir.Function([], ir.Block([
+                ir.Local(['__TIME'], [ir.RedisCall('time')]),
+                ir.Return([ir.BinOp('+', ir.Index(now, ir.Const(1)),
+                                    ir.BinOp('/', ir.Index(now, ir.Const(2)),
+                                             ir.Const(1000000)))])]))))
+
+        # Perform string replacement keeping only the new string
         elif node.func.attr == 'replace':
-            line = '((function() local __TEMP, _; ' \
-                   '__TEMP, _ = string.gsub(%s, %s); ' \
-                   'return __TEMP end)())' \
-                   % (self.process_node(node.func.value).code, args)
+            gsub = ir.Index(ir.Name('string'), ir.Const('gsub'))
+            return ir.Paren(ir.Call(gsub, [obj] + args))
 
         # Join a table of strings
         elif node.func.attr == 'join':
-            line = 'table.concat(%s, %s)\n' \
-                   % (args, self.process_node(node.func.value).code)
+            concat = ir.Index(ir.Name('table'), ir.Const('concat'))
+            return ir.Call(concat, args + [obj])
 
         # If we're calling append, add to the end of a list
         elif node.func.attr == 'append':
-            line = 'table.insert(%s, %s)' \
-                   % (self.process_node(node.func.value).code, args)
+            insert = ir.Index(ir.Name('table'), ir.Const('insert'))
+            return ir.Call(insert, [obj] + args)
 
         # If we're calling insert, add to the appropriate list position
         elif node.func.attr == 'insert':
-            line = 'table.insert(%s, %s + 1, %s)\n' \
-                   % (self.process_node(node.func.value).code,
-                      raw_args[0].code, raw_args[1].code)
+            insert = ir.Index(ir.Name('table'), ir.Const('insert'))
+            return ir.Call(insert, [obj, ir.BinOp('+', args[0], ir.Const(1)),
+                                    args[1]])
 
         # Check if we have a method call
-        elif node.func.value.id == 'self':
-            line = '%s(%s)' % ('self.' + node.func.attr, args)
+        elif isinstance(node.func.value, ast.Name) and \
+                node.func.value.id == 'self':
+            return ir.Call(ir.Index(obj, ir.Const(node.func.attr)), args)
 
         # XXX Assume this is a Redis pipeline execution
         elif node.func.attr == 'pipe':
             # Do nothing to start a pipeline
-                line = ''
+            return ir.Const(None)
         elif node.func.attr == 'execute':
-            expr = self.process_node(node.func.value).code
-            line = '__PIPE_GET(\'%s\')' % expr
+            return ir.Call('__PIPE_GET', [ir.Const(obj.render())])
 
         # XXX Otherwise, assume this is a redis function call
         elif any(sully.nodes_equal(node.func.value, obj)
@@ -531,210 +1650,396 @@ class RedisFuncFragment(object):
             cmd = node.func.attr
             if cmd == 'delete':
                 cmd = 'del'
-            call = 'redis.call(\'%s\', %s)' % (cmd, args)
+            if self.cluster:
+                args = self.cluster_keys(node, cmd, args)
+            call = ir.RedisCall(cmd, args)
 
             # Wrap the Redis call in a function which stores the
             # result if needed later for pipelining and returns it
-            expr = self.process_node(node.func.value).code
-            line = '__PIPE_ADD(\'%s\', %s)' % (expr, call)
+            if self.pipelined:
+                return ir.Call('__PIPE_ADD', [ir.Const(obj.render()), call])
+            else:
+                return call
         else:
             # XXX Something we can't handle
             raise UntranslatableCodeException(node)
 
-        code.append(LuaLine(line, node, indent))
+    def cluster_keys(self, node, command, args):
+        """Record the keys used by a Redis command on a cluster and
+        replace those which can be computed by the client with KEYS"""
+
+        positions = commands.accessed_keys(command, range(len(args)))
+        if positions is None:
+            self.key_problems.append('line %d: %s may use keys which '
+                                     'can\'t be identified' %
+                                     (node.lineno, command.upper()))
+            return args
+
+        args = list(args)
+        for i in positions:
+            key = node.args[i]
+            computable = self.computable(key)
+            tag = hash_tag(key_parts(key))
+            if tag is not None and not all(isinstance(part, basestring) or
+                                           self.computable(part)
+                                           for part in tag):
+                tag = None
+            self.keys.append(KeyUse(key, args[i].render(), computable, tag))
+
+            if computable:
+                index = self.lift_key(key)
+                args[i] = ir.Index(ir.Name('KEYS'), ir.Const(index + 1))
+
+        return args
+
+    def computable(self, node):
+        """Check if a Python expression only uses arguments of the
+        script so it can be evaluated before the script runs"""
+
+        # Arguments of helpers are not arguments of the script
+        if self.helper:
+            return False
+
+        if isinstance(node, (ast.Str, ast.Num)):
+            return True
+        elif isinstance(node, ast.Name):
+            return node.id in self.in_exprs and \
+                node.id not in self.assigned_names
+        elif isinstance(node, ast.BinOp) and \
+                isinstance(node.op, (ast.Add, ast.Mod)):
+            return self.computable(node.left) and \
+                self.computable(node.right)
+        elif isinstance(node, ast.Tuple):
+            return all(self.computable(elt) for elt in node.elts)
+        elif isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Name) and \
+                node.func.id in ('int', 'str') and len(node.args) == 1 and \
+                not (node.keywords or node.starargs or node.kwargs):
+            return self.computable(node.args[0])
+        else:
+            return False
+
+    def lift_key(self, node):
+        """Get the index in KEYS of the value of a Python expression"""
+
+        for i, key in enumerate(self.key_exprs):
+            if sully.nodes_equal(key, node):
+                return i
+
+        self.key_exprs.append(node)
+        return len(self.key_exprs) - 1
+
+    def check_slots(self):
+        """Ensure all keys used by the fragment hash to the same slot
+
+        This is true if there is a single key which we compute before
+        running the script or all keys have the same hash tag which
+        doesn't depend on values computed by the script. Otherwise a
+        CrossSlotException reports the keys which are a problem.
+        """
+
+        keys = []
+        for key in self.keys + self.helper_keys:
+            if not any(sully.nodes_equal(key.node, other.node)
+                       for other in keys):
+                keys.append(key)
+        problems = list(self.key_problems)
+        if len(problems) == 0 and (len(keys) == 0 or
+                                   (len(keys) == 1 and keys[0].computable)):
+            return
+
+        tags = collections.OrderedDict()
+        for key in keys:
+            if key.tag is None:
+                problems.append('line %d: %s has no hash tag known before '
+                                'the script runs' % (key.node.lineno,
+                                                     key.code))
+            else:
+                tags.setdefault(self.tag_signature(key.tag), []).append(key)
+
+        if len(tags) > 1:
+            problems.append('keys have different hash tags: ' + ', '.join(
+                'line %d: %s' % (key.node.lineno, key.code)
+                for tag_keys in tags.values() for key in tag_keys))
+
+        if len(problems) > 0:
+            raise CrossSlotException(problems)
+
+        # Calls are routed using the first key so if none are given to
+        # the script we compute the tag they share and give that instead
+        if len(self.key_exprs) == 0 and len(keys) > 0:
+            parts = ['{'] + keys[0].tag + ['}']
+            parts = [ast.Str(part) if isinstance(part, basestring) else part
+                     for part in parts]
+            self.lift_key(reduce(lambda left, right:
+                                 ast.BinOp(left, ast.Add(), right), parts))
+
+    @staticmethod
+    def tag_signature(tag):
+        """Get a value which is equal for hash tags with the same parts"""
+
+        signature = []
+        for part in tag:
+            # Concatenated values must already be strings
+            if isinstance(part, ast.Call) and part.func.id == 'str':
+                part = part.args[0]
+            if not isinstance(part, basestring):
+                part = ast.dump(part)
+            signature.append(part)
+
+        return tuple(signature)
+
+    def script_keys(self, args):
+        """Compute the keys given to the script from its arguments"""
+
+        if len(self.key_exprs) == 0:
+            return []
+
+        # The expressions are compiled to a function of the arguments
+        # where those which are attributes of self are never used
+        if self.key_function is None:
+            params = [expr if isinstance(expr, str) else '__SELF%d' % i
+                      for i, expr in enumerate(self.in_exprs)]
+            func = ast.Lambda(ast.arguments([ast.Name(param, ast.Param())
+                                             for param in params],
+                                            None, None, []),
+                              ast.List(self.key_exprs, ast.Load()))
+            code = compile(ast.fix_missing_locations(ast.Expression(func)),
+                           '<keys>', 'eval')
+            self.key_function = eval(code, {})
+
+        return self.key_function(*args)
+
+    def range_bounds(self, args):
+        """Convert the arguments of range to the bounds of a Lua loop"""
+
+        # Extend to always use three arguments
+        if len(args) == 1:
+            start, stop, step = ir.Const(0), args[0], ir.Const(1)
+        elif len(args) == 2:
+            (start, stop), step = args, ir.Const(1)
+        else:
+            start, stop, step = args
+
+        # Python ranges do not include the final value
+        if isinstance(step, ir.Const) and step.value < 0:
+            stop = ir.BinOp('+', stop, ir.Const(1))
+        else:
+            stop = ir.BinOp('-', stop, ir.Const(1))
+
+        return start, stop, step
 
-    def process_Compare(self, node, code, indent, loops):
+    def range_table(self, start, stop, step):
+        """Generate code to build a table with the values in a range"""
+
+        values = ir.Name('__RANGE')
+        index = ir.Index(values, ir.BinOp('+', ir.UnOp('#', values),
+                                          ir.Const(1)))
+        return ir.Call(ir.Paren(ir.Function([], ir.Block([
+            ir.Local(['__RANGE'], [ir.Table()]),
+            ir.NumericFor('__I', start, stop, step, ir.Block([
+                ir.Assign([index], [ir.Name('__I')])])),
+            ir.Return([values])]))))
+
+    def process_Compare(self, node, loops):
         """Generate code for a comparison operation"""
 
         # XXX We only handle a single comparison
         if len(node.ops) != 1 or len(node.comparators) != 1:
             raise UntranslatableCodeException(node)
 
-        lhs = self.process_node(node.left).code
+        # Identity can only be checked against None
+        if isinstance(node.ops[0], (ast.Is, ast.IsNot)):
+            if isinstance(node.comparators[0], ast.Name) and \
+                    node.comparators[0].id == 'None':
+                other = node.left
+            elif isinstance(node.left, ast.Name) and node.left.id == 'None':
+                other = node.comparators[0]
+            else:
+                raise UntranslatableCodeException(node)
+
+            # Missing values from Redis are false in Lua so only booleans
+            # need to be compared with nil
+            value = self.process_node(other, loops)
+            if self.known_type(other) == infer.BOOLEAN:
+                test = ir.BinOp('==', value, ir.Const(None))
+            else:
+                test = ir.UnOp('not', value)
+
+            if isinstance(node.ops[0], ast.IsNot):
+                test = ir.UnOp('not', test)
+            return test
+
+        lhs = self.process_node(node.left, loops)
 
         if isinstance(node.ops[0], ast.Eq):
-            op = ' == '
+            op = '=='
         elif isinstance(node.ops[0], ast.NotEq):
-            op = ' ~= '
+            op = '~='
         elif isinstance(node.ops[0], ast.Gt):
-            op = ' > '
+            op = '>'
         elif isinstance(node.ops[0], ast.GtE):
-            op = ' >= '
+            op = '>='
         elif isinstance(node.ops[0], ast.Lt):
-            op = ' < '
+            op = '<'
         elif isinstance(node.ops[0], ast.LtE):
-            op = ' <= '
+            op = '<='
         else:
             # XXX We don't handle this type of comparison
             raise UntranslatableCodeException(node)
 
-        rhs = self.process_node(node.comparators[0]).code
-        line = '%s %s %s' % (lhs, op, rhs)
-        code.append(LuaLine(line, node, indent))
+        rhs = self.process_node(node.comparators[0], loops)
+        return ir.BinOp(op, lhs, rhs)
 
-    def process_Break(self, node, code, indent, loops):
+    def process_Break(self, node, loops):
         """Generate code for a break statement"""
 
-        if LUA_DEBUG:
-            code.append(LuaLine.debug('LOOP BREAK'))
+        # Without a nested loop for continue we can break out directly
+        if loops not in self.continue_loops:
+            return [lua_debug('LOOP BREAK'), ir.Break()]
 
         # Set the break flag for the current loop
-        code.append(LuaLine('__BREAK%d = true' % loops, [], indent))
-        code.append(LuaLine('do break end', [], indent))
+        return [lua_debug('LOOP BREAK'),
+                ir.Assign([ir.Name('__BREAK%d' % loops)], [ir.Const(True)]),
+                ir.Break()]
 
-    def process_Continue(self, node, code, indent, loops):
+    def process_Continue(self, node, loops):
         """Generate code for a continue statement"""
 
-        if LUA_DEBUG:
-            code.append(LuaLine.debug('LOOP CONTINUE'))
-
         # We use the hack below of nested loops to implement continue,
         # so we just break out of that inner loop here
         # http://stackoverflow.com/a/25781200/123695
-        # We have to embed this in a dummy conditional since for syntactic
-        # reasons, break must always be the last statement in a block
-        code.append(LuaLine('if true then break end', [], indent))
+        return [lua_debug('LOOP CONTINUE'), ir.Break()]
 
-    def process_Dict(self, node, code, indent, loops):
+    def process_Dict(self, node, loops):
         """Generate code for a dictionary literal"""
 
-        pairs = ["['__DICT'] = true"]
+        items = [ir.Pair(ir.Const('__DICT'), ir.Const(True))]
         for key, value in itertools.izip(node.keys, node.values):
-            key = self.process_node(key).code
-            value = self.process_node(value).code
-            pairs.append('[%s] = %s' % (key, value))
+            items.append(ir.Pair(self.process_node(key, loops),
+                                 self.process_node(value, loops)))
 
-        line = '({%s})' % ', '.join(pairs)
-        code.append(LuaLine(line, [], indent))
+        return ir.Table(items)
 
-    def process_Expr(self, node, code, indent, loops):
+    def process_Expr(self, node, loops):
         """Generate code for an expression"""
 
-        code.append(self.process_node(node.value, indent))
+        value = self.process_node(node.value, loops)
+        if isinstance(value, ir.Call):
+            return [ir.CallStmt(value)]
+        elif ir.is_pure(value):
+            # Values such as docstrings don't do anything
+            return []
+        else:
+            return [ir.Local(['_'], [value])]
 
-    def process_For(self, node, code, indent, loops):
+    def process_For(self, node, loops):
         """Generate code for a for loop"""
 
-        # Get the list we are looping over
-        for_list = self.process_node(node.iter).code
-
-        # Try to find a comma in the list
-        try:
-            comma_index = for_list.index(',')
-        except ValueError:
-            comma_index = False
-
-        # This is a dumb heuristic and we just propagate this information
-        # if we were more careful, but we check for a digit followed by
-        # a comma to see if this is a loop over a range or a list
-        if comma_index is not False and for_list[0:comma_index].isdigit():
-            line = 'for %s=%s do' % (node.target.id, for_list)
-        else:
-            line = 'for _, %s in ipairs(%s) do' % \
-                   (node.target.id, for_list)
-
-        if LUA_DEBUG:
-            code.append(LuaLine.debug('STARTING LOOP OVER %s' % for_list))
+        if not isinstance(node.target, ast.Name):
+            raise UntranslatableCodeException(node)
 
-        # Increment the loop counter and initialize the break flag
+        # Increment the loop counter for the break flag
         loops += 1
-        code.append(LuaLine('local __BREAK%d = false' % loops, node, indent))
-
-        # Add the start of the for statement
-        code.append(LuaLine(line, node, indent))
-
-        # Trigger a break if the flag was set
-        code.append(LuaLine('if __BREAK%d then break end' % loops,
-            node, indent + 1))
-
-        # Add a nested loop with only one iteration
-        # which will allow us to break out when needed
-        code.append(LuaLine('repeat', node, indent + 1))
+        flag = ir.Name('__BREAK%d' % loops)
+        has_break, has_continue = loop_exits(node.body)
+        if has_continue:
+            self.continue_loops.add(loops)
+        else:
+            self.continue_loops.discard(loops)
 
         # Add all statements in the body
+        body = ir.Block()
         for n in node.body:
-            code.append(self.process_node(n, indent + 2, loops))
-
-        # End the nested loop from above
-        code.append(LuaLine('until true', node, indent + 1))
+            body.extend(self.process_node(n, loops))
+
+        # Add a nested loop with only one iteration which will allow us to
+        # continue by breaking out of it and then break out of the outer
+        # loop if the flag was set
+        flag_code = []
+        if has_continue:
+            body = ir.Block([ir.Repeat(body, ir.Const(True))])
+            if has_break:
+                body.append(ir.If(flag, ir.Block([ir.Break()])))
+                flag_code.append(ir.Local([flag.id], [ir.Const(False)]))
+
+        # Loops over ranges are translated to numeric for loops
+        if isinstance(node.iter, ast.Call) and \
+                isinstance(node.iter.func, ast.Name) and \
+                node.iter.func.id in ('range', 'xrange'):
+            args = [self.process_node(n, loops) for n in node.iter.args]
+            start, stop, step = self.range_bounds(args)
+            loop = ir.NumericFor(node.target.id, start, stop, step, body)
+            for_list = '%s, %s' % (start.render(), stop.render())
+        else:
+            for_list = self.process_node(node.iter, loops)
+            loop = ir.GenericFor(['_', node.target.id],
+                                 [ir.Call('ipairs', [for_list])], body)
+            for_list = for_list.render()
 
-        # End the outer loop
-        code.append(LuaLine('end', [], indent))
+        return [lua_debug('STARTING LOOP OVER %s' % for_list)] + \
+            flag_code + [loop]
 
-    def process_If(self, node, code, indent, loops):
+    def process_If(self, node, loops):
         """Generate code for an if statement"""
-        # Generate code for the test expression
-        test = self.process_node(node.test).code
-
-        if LUA_DEBUG:
-            code.append(LuaLine.debug('CHECKING CONDITION %s' % test))
 
-        # Add a line for the initial test
-        line = 'if %s then' % test
-        code.append(LuaLine(line, node, indent))
-
-        if LUA_DEBUG:
-            code.append(LuaLine.debug('CONDITION TRUE'))
+        # Generate code for the test expression
+        test = self.process_node(node.test, loops)
 
         # Generate the body of the if block
+        body = ir.Block([lua_debug('CONDITION TRUE')])
         for n in node.body:
-            code.append(self.process_node(n, indent + 1, loops))
+            body.extend(self.process_node(n, loops))
 
         # Generate the body of the else branch
+        orelse = ir.Block()
         if len(node.orelse) > 0:
-            code.append(LuaLine('else', [], indent))
-            code.append(LuaLine.debug('CONDITION FALSE, ELSE'))
+            orelse.append(lua_debug('CONDITION FALSE, ELSE'))
 
         for n in node.orelse:
-            code.append(self.process_node(n, indent + 1, loops))
+            orelse.extend(self.process_node(n, loops))
 
-        # Close the if block
-        code.append(LuaLine('end', [], indent))
+        return [lua_debug('CHECKING CONDITION %s' % test.render()),
+                ir.If(test, body, orelse)]
 
-    def process_Index(self, node, code, indent, loops):
+    def process_Index(self, node, loops):
         """Generate code for an index value"""
 
-        return self.process_Expr(node, code, indent, loops)
+        return self.process_node(node.value, loops)
 
-    def process_List(self, node, code, indent, loops):
+    def process_List(self, node, loops):
         """Generate code for a list constant"""
 
-        line = '{' + \
-               ', '.join(self.process_node(n).code for n in node.elts) + '}'
-        code.append(LuaLine(line, node, indent))
+        return ir.Table([self.process_node(n, loops) for n in node.elts])
 
-    def process_Name(self, node, code, indent, loops):
+    def process_Name(self, node, loops):
         """Generate code for a simple variable name"""
 
         # Replace common constants (assuming they are not redefined)
         if node.id == 'None':
-            name = 'nil'
+            return ir.Const(None)
         elif node.id in ('True', 'False'):
-            name = node.id.lower()
+            return ir.Const(node.id == 'True')
 
         # Uppercase names are assumed to be constants
         elif node.id.isupper():
-            name = self.get_constant((node.id,))
+            return ir.Const(self.constant_value((node.id,)))
 
-            # Otherwise we assume a local variable
+        # Otherwise we assume a local variable
         else:
-            name = node.id
+            return ir.Name(node.id)
 
-        code.append(LuaLine(name, node, indent))
-
-    def process_Num(self, node, code, indent, loops):
+    def process_Num(self, node, loops):
         """Generate code for a numberical constant"""
 
-        line = self.convert_value(node.n)
-        code.append(LuaLine(line, node, indent))
+        return ir.Const(node.n)
 
-    def process_Pass(self, node, code, indent, loops):
+    def process_Pass(self, node, loops):
         """Generate code for `pass`"""
 
-        line = 'do end'
-        code.append(LuaLine(line, node, indent))
+        return []
 
-    def process_Print(self, node, code, indent, loops):
+    def process_Print(self, node, loops):
         """Generate code for a print statement"""
 
         # XXX This changes behaviour to log to Redis instead
@@ -745,99 +2050,140 @@ class RedisFuncFragment(object):
             raise UntranslatableCodeException(node)
 
         # Add a log statement for each print
+        code = []
+        redis_log = ir.Index(ir.Name('redis'), ir.Const('log'))
         for value in node.values:
-            value = self.process_node(value)
-            line = 'redis.log(redis.LOG_DEBUG, %s)' % value
-            code.append(LuaLine(line, node, indent))
+            value = self.process_node(value, loops)
+            code.append(ir.CallStmt(ir.Call(redis_log, [
+                ir.Index(ir.Name('redis'), ir.Const('LOG_DEBUG')), value])))
+            code.append(lua_debug('PRINT: %s', value))
 
-            if LUA_DEBUG:
-                code.append(LuaLine.debug('PRINT: %s', value))
+        return code
 
-    def process_Return(self, node, code, indent, loops):
+    def process_Return(self, node, loops):
         """Generate code for a return statement"""
 
-        retval = self.process_node(node.value).code
+        if node.value is None:
+            retval = ir.Const(None)
+        else:
+            retval = self.process_node(node.value, loops)
+
+        code = [lua_debug('RETURNING %s', retval)]
 
         # If this is the final return value, pack it up with cmsgpack
         if self.helper:
-            line = 'return %s' % retval
+            code.append(ir.Return([retval]))
         else:
-            line = 'return __RETVAL(%s, true)' % retval
+            call = ir.Call('__RETVAL', [retval, ir.Const(True)])
+            if node.value is None:
+                value_type = infer.NIL
+            else:
+                value_type = self.types.expr_type(node.value)
+            self.final_returns.append((call, value_type))
+            code.append(ir.Return([call]))
 
-        if LUA_DEBUG:
-            code.append(LuaLine.debug('RETURNING %s', retval))
+        return code
 
-        code.append(LuaLine(line, node, indent))
+    def final_reply_type(self, client):
+        """Get the type of value this fragment returns if it can be
+        given as a native reply (nil is allowed with any type) or
+        STREAM_REPLY if lists it returns are streamed"""
 
-    def process_Str(self, node, code, indent, loops):
-        """Generate code for a string constant"""
+        if self.partial or self.exports is not None:
+            return None
+        elif self.stream_size is not None:
+            return STREAM_REPLY
+        elif not self.native_replies:
+            return None
 
-        line = self.convert_value(node.s)
-        code.append(LuaLine(line, node, indent))
+        value_types = set(value_type for _, value_type
+                          in self.final_returns)
+        value_types.discard(infer.NIL)
+        if len(value_types) != 1:
+            return None
 
-    def process_Subscript(self, node, code, indent, loops):
-        """Generate code for a subscript []"""
+        reply_type = value_types.pop()
+        if reply_type not in NATIVE_REPLY_TYPES or \
+                (reply_type == infer.DICT and not uses_resp3(client)):
+            return None
+        return reply_type
 
-        subs = self.process_node(node.slice).code
-        expr = self.process_node(node.value).code
+    def process_Str(self, node, loops):
+        """Generate code for a string constant"""
 
-        # Here we check the __DICT property of the object to see if
-        # it is not a dictionary in which case we add 1 to the index
-        line = '%s[(%s.__DICT) and (%s) or (%s + 1)]' % \
-               (expr, expr, subs, subs)
+        return ir.Const(node.s)
 
-        code.append(LuaLine(line, node, indent))
+    def process_Subscript(self, node, loops):
+        """Generate code for a subscript []"""
 
-    def process_Tuple(self, node, code, indent, loops):
+        subs = self.process_node(node.slice, loops)
+        expr = self.process_node(node.value, loops)
+
+        value_type = self.types.expr_type(node.value)
+        if value_type == infer.DICT:
+            return ir.Index(expr, subs)
+        elif value_type == infer.LIST:
+            # Lua tables are indexed starting from one
+            if isinstance(node.slice, ast.Index) and \
+                    isinstance(node.slice.value, ast.Num):
+                subs = ir.Const(node.slice.value.n + 1)
+            else:
+                subs = ir.BinOp('+', subs, ir.Const(1))
+            return ir.Index(expr, subs)
+        else:
+            # Here we check the __DICT property of the object to see if
+            # it is not a dictionary in which case we add 1 to the index
+            is_dict = ir.Index(copy.deepcopy(expr), ir.Const('__DICT'))
+            subs = ir.BinOp('or', ir.BinOp('and', is_dict, subs),
+                            ir.BinOp('+', copy.deepcopy(subs),
+                                     ir.Const(1)))
+            return ir.Index(expr, subs)
+
+    def process_Tuple(self, node, loops):
         """Generate code for a tuple constant"""
 
-        return self.process_List(node, code, indent, loops)
+        return self.process_List(node, loops)
 
-    def process_UnaryOp(self, node, code, indent, loops):
+    def process_UnaryOp(self, node, loops):
         """Generate code for a unary operator"""
 
-        operand = self.process_node(node.operand).code
-        line = None
+        operand = self.process_node(node.operand, loops)
 
         if isinstance(node.op, ast.USub):
-            op = '-'
+            return ir.UnOp('-', operand)
         elif isinstance(node.op, ast.UAdd):
             # XXX We're assuming that unary addition does nothing
-            op = ''
+            return operand
         elif isinstance(node.op, ast.Not):
-            line = '(not __TRUE(%s))' % operand
+            operand_type = self.known_type(node.operand)
+            if not isinstance(operand, (ir.Name, ir.Const)) and \
+                    operand_type not in (infer.BOOLEAN, infer.NIL):
+                # Avoid evaluating the operand twice
+                operand_type = None
+            return ir.UnOp('not', self.truth_test(operand, operand_type))
         else:
             # XXX Some unhandled operator
             raise UntranslatableCodeException(node)
 
-        if not line:
-            line = '(%s%s)' % (op, self.process_node(node.operand).code)
-        code.append(LuaLine(line, node, indent))
-
-    def arg_conversion(self, arg):
+    def arg_conversion(self, arg_type):
         """Returns the function used to convert this argument to Lua"""
 
-        if isinstance(arg, (int, long, float)):
+        if arg_type == 'number':
             # Convert numbers from string form
-            return 'tonumber'
-        elif isinstance(arg, PACKED_TYPES):
-            return 'cmsgpack.unpack'
+            return ir.Name('tonumber')
+        elif arg_type == 'string':
+            return None
         else:
-            return ''
+            return ir.Index(ir.Name('cmsgpack'), ir.Const('unpack'))
 
-    def unpack_args(self, args, start_arg=0, helpers=[],
-                    method_self=None):
-        """Generate code to unpack arguments with the correct name and type"""
+    def load_helpers(self, method_self):
+        """Generate code for all helper functions called by the fragment"""
 
-        # Unpack arguments to their original names performing
-        # any necessary type conversions
-        # XXX We assume arguments will always have the same type
-        arg_unpacking = 'local self = {}\n'
-        new_args = 0
+        if self.helper_code is not None:
+            return
 
-        # Generate code for all helper functions
-        helper_functions = ''
-        for method_name in helpers:
+        helper_code = ir.Block()
+        for method_name in self.helpers:
             # We can skip Redis calls or calls to what we assume
             # are builtin functions
             if method_name[0] in map(lambda x: x.id, self.redis_objs) or \
@@ -854,94 +2200,559 @@ class RedisFuncFragment(object):
             #     the instance
             method = getattr(method_self, method_name[1])
             taint = sully.TaintAnalysis(method)
-            wrapped = RedisFuncFragment(taint, helper=True)
+            wrapped = RedisFuncFragment(taint, helper=True,
+                                        cluster=self.cluster)
+            self.helper_keys.extend(wrapped.keys)
 
             # Add any newly discovered expressions which are required
             for in_expr in wrapped.in_exprs:
                 if in_expr not in wrapped.arg_names and \
                    in_expr not in self.in_exprs:
                     self.in_exprs.append(in_expr)
-                    new_args += 1
 
-            # Dump the helper function code into a local variable
-            helper_functions += 'self.%s = function(%s)\n%s\nend\n' % \
-                                (method_name[1],
-                                 ', '.join(wrapped.arg_names), wrapped.body)
+            # Store the helper function in the table for self
+            helper_code.append(ir.Assign(
+                [ir.Index(ir.Name('self'), ir.Const(method_name[1]))],
+                [ir.Function(wrapped.arg_names, wrapped.body)]))
+
+        self.helper_code = helper_code
+
+    def unpack_args(self, arg_types, start_arg=0, argv_offset=0):
+        """Generate code to unpack arguments with the correct name and type"""
+
+        # Unpack arguments to their original names performing
+        # any necessary type conversions
+        code = ir.Block([ir.Local(['self'], [ir.Table()])])
+
+        for i, name in enumerate(self.in_exprs[start_arg:], start_arg):
+            value = ir.Index(ir.Name('ARGV'), ir.Const(i + argv_offset + 1))
+            conversion = self.arg_conversion(arg_types[i])
+            if conversion is not None:
+                value = ir.Call(conversion, [value])
 
-        for i, name in enumerate(self.in_exprs[start_arg:]):
             # Perform the lookup for class variables
             # We should be able to extend this to support multiple lookups
             # i.e., self.foo.bar
             if isinstance(name, tuple):
                 if name[0] == 'self':
-                    definition = 'self.%s' % name[1]
-                    arg = getattr(method_self, name[1])
+                    target = ir.Index(ir.Name('self'), ir.Const(name[1]))
+                    code.append(ir.Assign([target], [value]))
                 else:
                     # XXX This shouldn't happen yet since we don't support
                     #     accessing things on objects other than self
                     raise Exception()
             else:
-                definition = 'local %s' % self.in_exprs[i + start_arg]
-                arg = args[i + start_arg]
-
-            arg_unpacking += '%s = %s(ARGV[%d])\n' % \
-                             (definition, self.arg_conversion(arg),
-                              i + start_arg + 1)
+                target = ir.Name(name)
+                code.append(ir.Local([name], [value]))
 
             # Track if this is a dictionary so we know if we
             # need to add one to indexes into the Lua table
-            if isinstance(arg, dict):
-                expr = self.in_exprs[i + start_arg]
-                if isinstance(expr, tuple):
-                    expr = '.'.join(expr)
-
-                arg_unpacking += '%s.__DICT = true\n' % expr
-
-        # Expand any necessary helper arguments
-        if new_args > 0:
-            # Args is passed through as an empty array since all of them
-            # must be pulled from method_self anyway
-            helper_unpacking = self.unpack_args([], start_arg + new_args, [],
-                                                method_self)
+            if arg_types[i] == 'dict':
+                code.append(ir.Assign(
+                    [ir.Index(copy.deepcopy(target), ir.Const('__DICT'))],
+                    [ir.Const(True)]))
+
+        # Passes modify code in place so helpers are copied for each script
+        code.extend(copy.deepcopy(self.helper_code))
+        return code
+
+    def lua_code(self, client, arg_types, vectorize=False, library=False):
+        """Produce the lua code for this script fragment
+
+        With `library`, this is the body of a function in a function
+        library which defines the header helpers itself. This also sets
+        `read_only` to indicate if the code only reads data from Redis
+        and `reply_type` to the type of value returned as a native reply.
+        """
+
+        # Specialize the body for the types of the arguments
+        body = self.translate(dict(
+            ('.'.join(expr) if isinstance(expr, tuple) else expr, arg_type)
+            for expr, arg_type in zip(self.in_exprs, arg_types)))
+
+        # Lists may be streamed and values of a single simple type are
+        # returned as native replies (checked when returned in case we
+        # inferred the wrong type)
+        self.reply_type = None
+        if not vectorize:
+            self.reply_type = self.final_reply_type(client)
+        for call, _ in self.final_returns:
+            if self.reply_type == STREAM_REPLY:
+                call.func = ir.Name('__STREAM')
+                call.args = [call.args[0], ir.Const(self.stream_size)]
+            elif self.reply_type is not None:
+                call.func = ir.Name('__REPLY_' + self.reply_type.upper())
+                call.args = call.args[:1]
+
+        # Avoid most of the pipelining overhead if it isn't needed
+        pipelined = any(isinstance(node, ir.Call) and
+                        isinstance(node.func, ir.Name) and
+                        node.func.id == '__PIPE_GET'
+                        for node in ir.walk(ir.Block([body,
+                                                      self.helper_code])))
+        pipeline_code = PIPELINED_CODE if pipelined else UNPIPELINED_CODE
+        sources = [LUA_HEADER, pipeline_code]
+        if vectorize:
+            sources.append(VECTORIZED_RETVAL)
+        preamble, definitions = lua_definitions(*sources)
+
+        # Passes see every helper which could be defined
+        helpers = ir.RawStmt(preamble + ''.join(definitions.values()))
+        code = ir.Block([helpers])
+
+        if not vectorize:
+            code.extend([self.unpack_args(arg_types), body])
         else:
-            helper_unpacking = ''
+            # All function arguments are packed together in the first value
+            # so only attributes of the instance are unpacked individually
+            nargs = len(self.arg_names)
+            code.append(self.unpack_args(arg_types, nargs, 1 - nargs))
+
+            # Wrap the body in a function called for each set of arguments
+            dict_flags = ir.Block()
+            for name, arg_type in zip(self.arg_names, arg_types):
+                if arg_type == 'dict':
+                    dict_flags.append(ir.If(ir.Name(name), ir.Block([
+                        ir.Assign([ir.Index(ir.Name(name),
+                                            ir.Const('__DICT'))],
+                                  [ir.Const(True)])])))
+
+            code.append(ir.Local(['__NARGS'], [ir.Const(nargs)]))
+            code.append(ir.Local(['__BODY'], [
+                ir.Function(self.arg_names, ir.Block([dict_flags, body]))]))
+            code.append(ir.RawStmt(VECTORIZED_CODE))
+
+        # Passes may hide which commands are run and streamed lists
+        # are written to a key
+        self.read_only = only_reads(ir.Block(code.body[1:])) and \
+            self.reply_type != STREAM_REPLY
+        code = self.pass_manager.run(code)
+
+        # Helpers from the header are defined when the library is loaded
+        # but other helpers are kept since they may hold state for a call
+        if library:
+            _, header = lua_definitions(LUA_HEADER)
+            preamble = ''
+            definitions = collections.OrderedDict(
+                (name, definition)
+                for name, definition in definitions.items()
+                if header.get(name) != definition)
+
+        # Only define the helpers which the script uses
+        index = code.body.index(helpers)
+        names = ir.name_reads(ir.Block(code.body[:index] +
+                                       code.body[index + 1:]))
+        code.body[index] = ir.RawStmt(used_definitions(preamble, definitions,
+                                                       names))
+
+        if LUA_DEBUG:
+            return code.render()
+        else:
+            return minify_lua(code.render())
+
+    def script_variant(self, client, args, vectorize=False):
+        """Get the ID of the script specialized for the argument types"""
+
+        return self.encoded_variant(client, args, vectorize)[0]
+
+    def encoded_variant(self, client, args, vectorize=False):
+        """Get the ID of the script specialized for the argument types
+        and a function which encodes the arguments for the script"""
 
-        return helper_unpacking + arg_unpacking + helper_functions
+        # Checking the types directly is enough to select the script
+        signature = (vectorize,) + tuple(map(type, args))
+        try:
+            variant = self.signatures[signature]
+            self.stats['hits'] += 1
+            return variant
+        except KeyError:
+            self.stats['misses'] += 1
+
+        # Different types may still produce the same script
+        arg_types = tuple(arg_type(arg) for arg in args)
+        key = (vectorize,) + arg_types
+        script_id = self.variants.get(key)
+        if script_id is None:
+            lua_code = self.lua_code(client, arg_types, vectorize,
+                                     self.library is not None)
+            if self.library is None:
+                script_id = ScriptRegistry.register_script(
+                    client, lua_code, self.read_only, self.reply_type)
+            else:
+                script_id = ScriptRegistry.register_function(
+                    self.library, lua_code, self.read_only, self.reply_type)
+            self.variants[key] = script_id
+            self.stats['variants'] += 1
+
+            # Track the size of scripts sent to the server
+            self.stats['script_bytes'] += len(lua_code)
+
+            # Drop the oldest variant if we have too many
+            if len(self.variants) > self.max_variants:
+                _, evicted = self.variants.popitem(last=False)
+                for old_signature, old_variant in self.signatures.items():
+                    if old_variant[0] == evicted:
+                        del self.signatures[old_signature]
+                self.stats['evictions'] += 1
+
+        variant = (script_id, self.make_encoder(signature[1:]))
+        self.signatures[signature] = variant
+        return variant
+
+    @staticmethod
+    def make_encoder(classes):
+        """Generate a function which encodes arguments of the given
+        classes to be passed to a script
+
+        Other values are passed to the client as they are and None
+        is given as a constant instead of being packed on each call.
+        """
+
+        values = []
+        for i, cls in enumerate(classes):
+            if cls is types.NoneType:
+                values.append(repr(msgpack.packb(None)))
+            elif issubclass(cls, PACKED_TYPES):
+                values.append('pack(args[%d])' % i)
+            else:
+                values.append('args[%d]' % i)
 
-    def lua_code(self, client, args, method_self=None):
-        """Produce the lua code for this script fragment"""
+        return eval('lambda args: [%s]' % ', '.join(values),
+                    {'pack': ScriptRegistry.pack})
 
-        body = str(self.body)
+    def replica(self, client, script_id):
+        """Get the client for a replica to run a script or None if the
+        script must run using the given client"""
+
+        # Pipelined commands must run on the same connection and function
+        # libraries can only be loaded on the primary
+        script = ScriptRegistry.SCRIPTS[script_id]
+        if self.replicas is None or isinstance(client, PIPELINE_CLASS) or \
+                isinstance(script, LibraryFunction) or not script.read_only:
+            return None
+
+        return self.replicas.choose()
+
+    def run(self, client, args, clients=()):
+        """Run the script variant matching the arguments and return the
+        unpacked result"""
+
+        # Redis objects on different servers need separate scripts
+        if len(clients) > 1 and not self.cluster and \
+                len(set(map(ScriptRegistry.server_id, clients))) > 1:
+            return self.run_split(clients, args)
+
+        script_id, encoder = self.encoded_variant(client, args)
+        keys = self.script_keys(args)
+        client = self.shard(client, keys)
+        args = encoder(args)
+
+        # The result of a deferred script is returned from the function
+        # before the pipeline is executed
+        if self.defer(client):
+            return {'__return': True,
+                    '__value': ScriptRegistry.queue_script(client, script_id,
+                                                           args, keys)}
+
+        # Scripts which only read may run on a replica
+        replica = self.replica(client, script_id)
+        if replica is None:
+            return ScriptRegistry.run_script(client, script_id, args, keys)
+
+        start = time.time()
+        retval = ScriptRegistry.run_script(replica, script_id, args)
+        self.replicas.record(replica, time.time() - start)
+        return retval
+
+    def defer(self, client):
+        """Check if a script should be queued on a pipeline"""
+
+        if not self.deferred or not isinstance(client, PIPELINE_CLASS):
+            return False
+
+        # Pipelines watching keys run commands immediately until MULTI
+        if client.watching and not client.explicit_transaction:
+            return False
+
+        # Code after a partial fragment needs the result right away and
+        # fragments which execute the pipeline themselves must run now
+        return not self.partial and not self.pipelined
+
+    def redis_obj_names(self, node):
+        """Get the names of the Redis objects used in a statement"""
+
+        names = set(obj.id for obj in self.redis_objs
+                    if isinstance(obj, ast.Name))
+        return set(child.func.value.id for child in ast.walk(node)
+                   if isinstance(child, ast.Call) and
+                   isinstance(child.func, ast.Attribute) and
+                   isinstance(child.func.value, ast.Name) and
+                   child.func.value.id in names)
+
+    def split(self, servers):
+        """Split the fragment into fragments for each run of statements
+        using Redis objects on the same server
+
+        `servers` maps the name of each Redis object to its server. Each
+        fragment records the object it uses and the earlier fragments it
+        must wait for, which are those on the same server, those giving
+        it variables, and those which may return.
+        """
+
+        # The split only depends on which objects share a server
+        pattern = tuple(servers[obj.id] == servers[other.id]
+                        for obj in self.redis_objs
+                        for other in self.redis_objs)
+        if pattern in self.splits:
+            return self.splits[pattern]
+
+        if self.partial:
+            raise ValueError('Only functions translated in their entirety '
+                             'can use Redis objects on different servers')
+
+        runs = []
+        pending = []
+        nodes = [node for node in self.taint.func_ast.body[0].body
+                 if self.minlineno <= node.lineno <= self.maxlineno]
+        for node in nodes:
+            names = sorted(self.redis_obj_names(node))
+            if len(set(servers[name] for name in names)) > 1:
+                raise ValueError('Line %d uses Redis objects on different '
+                                 'servers' % node.lineno)
+
+            # Statements without Redis calls run with the previous ones
+            if len(names) == 0:
+                (runs[-1][1] if len(runs) > 0 else pending).append(node)
+            elif len(runs) > 0 and servers[runs[-1][0]] == servers[names[0]]:
+                runs[-1][1].append(node)
+            else:
+                runs.append((names[0], pending + [node]))
+                pending = []
 
-        # XXX This is dumb but lets us avoid most of the pipelining
-        #     overhead if we're sure that it isn't needed
-        pipeline_code = PIPELINED_CODE if '__PIPE_GET' in body \
-            else UNPIPELINED_CODE
+        fragments = []
+        for i, (name, run) in enumerate(runs):
+            if i + 1 < len(runs):
+                maxlineno = runs[i + 1][1][0].lineno - 1
+            else:
+                maxlineno = self.maxlineno
+            fragment = RedisFuncFragment(
+                self.taint, run[0].lineno, maxlineno,
+                redis_objs=self.redis_objs,
+                library=self.library and self.library.name)
+            fragment.pass_manager = self.pass_manager
+            fragment.type_hints = self.type_hints
+            fragment.helper_code = self.helper_code
+            fragment.client_name = name
+            fragment.assigned = set(
+                child.id for node in run for child in ast.walk(node)
+                if isinstance(child, ast.Name) and
+                isinstance(child.ctx, ast.Store))
+            fragment.returns = any(isinstance(child, ast.Return)
+                                   for node in run
+                                   for child in ast.walk(node))
+            fragments.append(fragment)
+
+        for i, fragment in enumerate(fragments):
+            if i + 1 < len(fragments):
+                later = set(expr for other in fragments[i + 1:]
+                            for expr in other.in_exprs)
+                fragment.exports = sorted(fragment.assigned & later)
+
+            fragment.depends = [
+                j for j, other in enumerate(fragments[:i])
+                if other.returns or
+                servers[other.client_name] == servers[fragment.client_name]
+                or set(other.exports).intersection(fragment.in_exprs)]
+
+        self.splits[pattern] = fragments
+        return fragments
+
+    def run_split(self, clients, args):
+        """Run the fragment as separate scripts for each server
+
+        Scripts run as soon as those they depend on have finished so
+        scripts on different servers may run at the same time.
+        """
+
+        clients = dict((obj.id, client)
+                       for obj, client in zip(self.redis_objs, clients))
+        fragments = self.split(dict(
+            (name, ScriptRegistry.server_id(client))
+            for name, client in clients.items()))
+        values = dict(zip(self.in_exprs, args))
+
+        def run_fragment(fragment):
+            client = clients[fragment.client_name]
+            args = [values.get(expr) for expr in fragment.in_exprs]
+            script_id, encoder = fragment.encoded_variant(client, args)
+            return ScriptRegistry.run_script(client, script_id,
+                                             encoder(args))
+
+        done = set()
+        while len(done) < len(fragments):
+            ready = [i for i, fragment in enumerate(fragments)
+                     if i not in done and done.issuperset(fragment.depends)]
+            retvals = ScriptRegistry.fan_out(
+                run_fragment, [fragments[i] for i in ready])
+
+            for i, retval in zip(ready, retvals):
+                if retval['__return']:
+                    return retval
+
+                # Variables which are None are missing from the table
+                exported = retval['__value']
+                if not isinstance(exported, dict):
+                    exported = {}
+                for name in fragments[i].exports:
+                    values[name] = exported.get(name)
+                done.add(i)
+
+        return {'__return': True, '__value': None}
+
+    def script_args(self, method_self, args):
+        """Get the values of all the expressions passed to the script"""
+
+        values = dict(zip(self.arg_names, args))
+        script_args = []
+        for expr in self.in_exprs:
+            if isinstance(expr, tuple):
+                script_args.append(getattr(method_self, expr[1]))
+            else:
+                script_args.append(values[expr])
 
-        arg_unpacking = self.unpack_args(args, 0, self.helpers, method_self)
-        return LUA_HEADER + pipeline_code + arg_unpacking + body
+        return script_args
 
     def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
         # We need a descriptor here to get the class instance then we
-        # just stick it as the first argument we pass to __call__
-        @functools.wraps(self.taint.func)
-        def inner(*args):
-            return self.__call__(instance, *args)
+        # just stick it as the first argument we pass to the stub
+        if self.patched:
+            bound = functools.partial(self.stub, instance)
+        else:
+            bound = functools.partial(self.__call__, instance)
+        functools.update_wrapper(bound, self.taint.func)
+
+        # Batched calls also need the instance
+        bound.map = functools.partial(self.map, instance=instance)
+        bound.starmap = functools.partial(self.starmap, instance=instance)
 
-        return inner
+        return bound
 
     def __call__(self, *args):
-        # Register this script if needed
-        if self.script_id is None:
-            orig_args = copy.copy(args)
-            self.register_script(*args)
-        else:
-            orig_args = args
+        return self.stub(*args)
+
+    def first_call(self, *args):
+        """Register the script on the first call and then run it"""
+
+        self.register_script(*args)
+        return self.stub(*args)
+
+    def map(self, *iterables, **kwargs):
+        """Call the function with arguments taken from each iterable"""
+
+        return self.starmap(zip(*iterables), **kwargs)
+
+    def starmap(self, arg_tuples, instance=None, vectorize=False):
+        """Call the function once for each tuple of arguments
+
+        All calls using the same client are sent in a single pipeline and
+        pipelines for different clients are sent in parallel. Results are
+        returned in order and calls which fail produce the exception in
+        place of their result instead of failing the batch.
+        With `vectorize`, each batch instead runs as a single script which
+        loops over all the tuples of arguments on the server.
+        """
+
+        # Pipelined calls can't continue running code locally
+        if self.partial:
+            raise ValueError('Only functions translated in their '
+                             'entirety can be called in batches')
+        if vectorize and self.cluster:
+            raise ValueError('Vectorized calls can\'t be routed to the '
+                             'nodes of a cluster or shards')
+        if vectorize and self.stream_size is not None:
+            raise ValueError('Vectorized calls can\'t stream results')
+
+        arg_tuples = [tuple(args) for args in arg_tuples]
+        if self.method and instance is not None:
+            arg_tuples = [(instance,) + args for args in arg_tuples]
+        if len(arg_tuples) == 0:
+            return []
+
+        # Group the arguments for each call by the client and script used
+        # Vectorized scripts also share the attributes of the instance
+        nargs = len(self.arg_names)
+        batches = collections.OrderedDict()
+        for i, args in enumerate(arg_tuples):
+            method_self, clients, args = self.split_args(args)
+            self.load_helpers(method_self)
+            args = self.script_args(method_self, args)
+
+            if len(clients) > 1 and not self.cluster and \
+                    len(set(map(ScriptRegistry.server_id, clients))) > 1:
+                raise ValueError('Batched calls must use Redis objects on '
+                                 'the same server')
+            client = clients[0]
+            script_id, encoder = self.encoded_variant(client, args,
+                                                      vectorize)
+            replica = self.replica(client, script_id)
+            if replica is not None:
+                client = replica
+
+            # Calls on a cluster or shards are batched for each node
+            keys = self.script_keys(args)
+            client = ScriptRegistry.node_client(self.shard(client, keys),
+                                                keys)
+            if vectorize:
+                key = (id(client), script_id, id(method_self))
+                self_args = args[nargs:]
+                args = args[:nargs]
+            else:
+                key = (id(client), script_id)
+                self_args = []
+                args = encoder(args)
+
+            batch = batches.setdefault(key, (client, script_id, self_args,
+                                             [], [], []))
+            batch[3].append(i)
+            batch[4].append(args)
+            batch[5].append(keys)
+
+        def run_batch(batch):
+            client, script_id, self_args, _, arg_lists, key_lists = batch
+            if vectorize:
+                return ScriptRegistry.run_vectorized(
+                    client, script_id, arg_lists, self_args)
+            else:
+                return ScriptRegistry.run_batch(client, script_id,
+                                                arg_lists, key_lists)
+
+        # Batches for different servers run at the same time
+        results = [None] * len(arg_tuples)
+        batch_retvals = ScriptRegistry.fan_out(run_batch, batches.values())
+        for batch, retvals in zip(batches.values(), batch_retvals):
+            indexes = batch[3]
+            for i, retval in zip(indexes, retvals):
+                if isinstance(retval, Exception):
+                    results[i] = retval
+                else:
+                    results[i] = retval['__value']
 
-        return self.taint.func(*orig_args)
+        return results
 
-    def register_script(self, *args):
-        """Register the script with the client and patch the function code"""
+    def shard(self, client, keys):
+        """Get the client for the shard holding the keys of a script"""
+
+        if self.shards is None or len(keys) == 0:
+            return client
+
+        # All keys have the same hash tag so the first is enough
+        return self.shards(keys[0])
+
+    def split_args(self, args):
+        """Separate the instance, clients, and remaining arguments"""
 
         # Check if this is a method and pull the correct arguments
         if self.method:
@@ -951,36 +2762,79 @@ class RedisFuncFragment(object):
             method_self = None
             args = list(args)
 
-        # Remove the client arguments from what is serialized and
-        # pick the first client to actually use
-        # XXX We do not actually support multiple different clients
+        # Remove the client arguments from what is serialized
         clients = []
         for arg in args[:]:
-            if isinstance(arg, redis.StrictRedis):
+            if isinstance(arg, CLIENT_CLASSES):
                 clients.append(arg)
                 args.remove(arg)
-        client = clients[0]
 
-        lua_code = self.lua_code(client, args, method_self)
-        self.script_id = ScriptRegistry.register_script(client, lua_code)
+        return method_self, clients, args
+
+    def make_stub(self, params, arg_exprs, client_args):
+        """Generate a function with the given parameters which runs the
+        script directly and returns its value"""
+
+        # Other clients are only needed to check their servers
+        if len(client_args) > 1:
+            other_clients = ', [%s]' % ', '.join(client_args)
+        else:
+            other_clients = ''
+
+        name = self.taint.func.__name__
+        source = 'def %s(%s):\n' \
+                 '    return __run(%s, [%s]%s)["__value"]\n' % \
+                 (name, ', '.join(params), client_args[0],
+                  ', '.join(arg_exprs), other_clients)
+        namespace = {'__run': self.run}
+        exec(compile(source, '<locomotor %s>' % name, 'exec'), namespace)
+
+        stub = namespace[name]
+        stub.func_defaults = self.taint.func.func_defaults
+        return functools.update_wrapper(stub, self.taint.func)
+
+    def register_script(self, *args):
+        """Register the script with the client and create the stub which
+        is called in place of the function"""
+
+        # Helper functions may require additional arguments
+        method_self, clients, args = self.split_args(args)
+        self.load_helpers(method_self)
+
+        # Scripts are generated when called since we need to know
+        # the types of all the arguments
+        ScriptRegistry.FRAGMENTS[self.fragment_id] = self
+        self.patched = True
 
         # Get all the arguments to go to the function
-        arg_exprs = copy.copy(self.arg_names)
-        for attr in self.in_exprs:
-            if isinstance(attr, tuple):
-                arg_exprs.append('.'.join(attr))
+        arg_exprs = ['.'.join(expr) if isinstance(expr, tuple) else expr
+                     for expr in self.in_exprs]
+
+        # Scripts run using the first Redis object unless others are
+        # on a different server
+        client_args = [obj.id for obj in self.redis_objs]
+
+        # Functions translated in their entirety are replaced by a
+        # function which takes the same arguments and runs the script
+        argspec = inspect.getargspec(self.taint.func)
+        if not self.partial and not argspec.varargs and \
+                not argspec.keywords:
+            self.stub = self.make_stub(argspec.args, arg_exprs, client_args)
+            return
 
-        # XXX For now, there can be only one
-        client_arg = self.redis_objs[0].id
+        # Otherwise the part of the function which was translated is
+        # patched to run the script
+        self.stub = self.taint.func
 
         # Compile code to call our script
         # We first store the return value of the script in a temporary
         # variable and then check if we're supposed to return
         # __RETURN_HERE__ is a placeholder that we can insert the return
         # instruction as "return" is not valid in the current context
-        script_call = '__RETVAL = ScriptRegistry.run_script' \
-                      '(%s, "%s", [%s])\n' \
-                      % (client_arg, self.script_id, ', '.join(arg_exprs))
+        script_call = '__RETVAL = ScriptRegistry.run_fragment' \
+                      '("%s", %s, [%s], [%s])\n' \
+                      % (self.fragment_id, client_args[0],
+                         ', '.join(arg_exprs), ', '.join(client_args))
         script_call += 'if __RETVAL["__return"]:\n' \
                        '    __RETVAL["__value"]\n' \
                        '    __RETURN_HERE__\n' \
@@ -1047,13 +2901,55 @@ class RedisFuncFragment(object):
         self.taint.func.func_globals['ScriptRegistry'] = ScriptRegistry
 
 
-def redis_server(method=None, redis_objs=None, minlineno=None, maxlineno=None):
-    """Create a decorator which converts a function to run on the server"""
+def redis_server(method=None, redis_objs=None, minlineno=None, maxlineno=None,
+                 type_hints=None, passes=None, library=None, replicas=None,
+                 cluster=False, shards=None, deferred=False,
+                 native_replies=True, stream_size=None):
+    """Create a decorator which converts a function to run on the server
+
+    `type_hints` optionally maps variable names to the Python type of
+    their values where these can't be inferred (e.g. {'total': int}).
+    `passes` optionally lists the optimization passes to run on the
+    generated code instead of those in `passes.DEFAULT_PASSES`.
+    `library` optionally names a group of Redis functions (Redis 7+) which
+    the scripts are registered as instead of being run with EVALSHA. Each
+    is loaded once in its own library which defines the helpers it uses.
+    `replicas` optionally gives a `ReplicaSet` (or a list of clients) for
+    replicas where scripts which only read data are run instead.
+    `cluster` passes the keys used by scripts in KEYS so they can run on
+    a Redis Cluster. This fails with a `CrossSlotException` if the keys
+    may not hash to the same slot (e.g. without a common hash tag).
+    `shards` optionally gives a function (e.g. a `HashRing`) mapping a key
+    to the client for the shard holding it. Keys are checked as with
+    `cluster` and each call runs on the shard of its keys, so the function
+    must place keys with the same hash tag on the same shard. Batches of
+    calls from `map` and `starmap` run on all shards in parallel.
+    `deferred` queues scripts called with a pipeline on the pipeline
+    instead of running them immediately. The call returns a
+    `DeferredResult` and the pipeline's `execute` gives the value
+    returned by the script in place of its reply. A script the server no
+    longer has is run again after the pipeline, or fails in a
+    transaction.
+    `native_replies` returns numbers, strings, booleans and flat lists
+    (and dicts with RESP3) as native Redis replies when a function only
+    returns one of these types. Other values are packed with msgpack,
+    which is always used when this is False.
+    `stream_size` optionally gives a number of items. Lists returned by
+    the function are then stored in a temporary key on the server and the
+    call returns a generator which fetches that many items at a time.
+    This can't be used with a cluster or shards.
+    """
 
     def decorator(method):
         taint = sully.TaintAnalysis(method)
         fragment = RedisFuncFragment(taint, redis_objs=redis_objs,
-                                     minlineno=minlineno, maxlineno=maxlineno)
+                                     minlineno=minlineno, maxlineno=maxlineno,
+                                     type_hints=type_hints, passes=passes,
+                                     library=library, replicas=replicas,
+                                     cluster=cluster, shards=shards,
+                                     deferred=deferred,
+                                     native_replies=native_replies,
+                                     stream_size=stream_size)
         return functools.update_wrapper(fragment, method)
 
     return decorator(method) if method else decorator
@@ -0,0 +1,136 @@
+#: Commands which read data without modifying anything
+READ_COMMANDS = set([
+    'bitcount', 'bitpos', 'dbsize', 'echo', 'exists', 'get', 'getbit',
+    'getrange', 'hexists', 'hget', 'hgetall', 'hkeys', 'hlen', 'hmget',
+    'hrandfield', 'hscan', 'hstrlen', 'hvals', 'keys', 'lindex', 'llen',
+    'lrange', 'mget', 'ping', 'pttl', 'randomkey', 'scan', 'scard', 'sdiff',
+    'sinter', 'sismember', 'smembers', 'smismember', 'srandmember', 'sscan',
+    'strlen', 'substr', 'sunion', 'time', 'ttl', 'type', 'zcard', 'zcount',
+    'zlexcount', 'zmscore', 'zrandmember', 'zrange', 'zrangebylex',
+    'zrangebyscore', 'zrank', 'zrevrange', 'zrevrangebylex',
+    'zrevrangebyscore', 'zrevrank', 'zscan', 'zscore',
+])
+
+#: Reads whose reply depends only on the data stored in their keys
+#: so repeating them without an intervening write gives the same reply
+REPEATABLE_COMMANDS = READ_COMMANDS - set([
+    'dbsize', 'echo', 'hrandfield', 'hscan', 'keys', 'ping', 'pttl',
+    'randomkey', 'scan', 'srandmember', 'sscan', 'time', 'ttl', 'zrandmember',
+    'zscan',
+])
+
+#: Reads which reply with a list (a table in Lua) instead of a single value
+LIST_REPLY_COMMANDS = set([
+    'hgetall', 'hkeys', 'hmget', 'hvals', 'lrange', 'mget', 'sdiff',
+    'sinter', 'smembers', 'smismember', 'sunion', 'zmscore', 'zrange',
+    'zrangebylex', 'zrangebyscore', 'zrevrange', 'zrevrangebylex',
+    'zrevrangebyscore',
+])
+
+#: Reads which take any number of keys as their arguments
+MULTI_KEY_READ_COMMANDS = set(['exists', 'mget', 'sdiff', 'sinter',
+                               'sunion'])
+
+#: Reads which may use any key in the database
+GLOBAL_READ_COMMANDS = set(['dbsize', 'keys', 'randomkey', 'scan'])
+
+#: Reads which don't use any keys
+KEYLESS_READ_COMMANDS = set(['echo', 'ping', 'time'])
+
+#: Commands which only modify the key given as their first argument
+SINGLE_KEY_WRITE_COMMANDS = set([
+    'append', 'decr', 'decrby', 'expire', 'expireat', 'getdel', 'getex',
+    'getset', 'hdel', 'hincrby', 'hincrbyfloat', 'hmset', 'hset', 'hsetnx',
+    'incr', 'incrby', 'incrbyfloat', 'linsert', 'lpop', 'lpush', 'lpushx',
+    'lrem', 'lset', 'ltrim', 'persist', 'pexpire', 'pexpireat', 'psetex',
+    'rpop', 'rpush', 'rpushx', 'sadd', 'sdiffstore', 'set', 'setbit',
+    'setex', 'setnx', 'setrange', 'sinterstore', 'spop', 'srem',
+    'sunionstore', 'zadd', 'zincrby', 'zinterstore', 'zpopmax', 'zpopmin',
+    'zrem', 'zremrangebylex', 'zremrangebyrank', 'zremrangebyscore',
+    'zunionstore',
+])
+
+#: Positions of the keys modified by other commands as slice arguments
+WRITE_KEY_POSITIONS = {
+    'del': (0, None, 1), 'lmove': (0, 2, 1), 'mset': (0, None, 2),
+    'msetnx': (0, None, 2), 'rename': (0, 2, 1), 'renamenx': (0, 2, 1),
+    'rpoplpush': (0, 2, 1), 'smove': (0, 2, 1), 'unlink': (0, None, 1),
+}
+
+#: Commands which don't modify any keys but are not reads
+NO_KEY_COMMANDS = set(['publish'])
+
+#: Writes which also read all the keys given after their destination
+STORE_COMMANDS = set(['sdiffstore', 'sinterstore', 'sunionstore'])
+
+#: Writes which also read keys that depend on the value of an argument
+COUNTED_STORE_COMMANDS = set(['zinterstore', 'zunionstore'])
+
+#: Writes which accept repeated groups of arguments given as the number
+#: of fixed arguments before the groups and the size of each group
+VARIADIC_WRITE_COMMANDS = {
+    'del': (0, 1), 'hdel': (1, 1), 'hmset': (1, 2), 'hset': (1, 2),
+    'lpush': (1, 1), 'rpush': (1, 1), 'sadd': (1, 1), 'srem': (1, 1),
+    'unlink': (0, 1), 'zadd': (1, 2),
+}
+
+#: Commands to use instead of others when repeating arguments
+#: (HSET only accepts multiple fields since Redis 4.0)
+VARIADIC_EQUIVALENTS = {'hset': 'hmset'}
+
+
+def written_keys(command, args):
+    """Get the arguments which are keys modified by a command
+
+    This is None if the command may modify keys we can't identify.
+    """
+
+    command = command.lower()
+    if command in READ_COMMANDS or command in NO_KEY_COMMANDS:
+        return []
+    elif command in SINGLE_KEY_WRITE_COMMANDS:
+        return list(args[:1])
+    elif command in WRITE_KEY_POSITIONS:
+        start, stop, step = WRITE_KEY_POSITIONS[command]
+        return list(args[start:stop:step])
+    else:
+        return None
+
+
+def read_keys(command, args):
+    """Get the arguments which are keys read by a command
+
+    This is None if the command may read keys we can't identify.
+    """
+
+    command = command.lower()
+    if command in GLOBAL_READ_COMMANDS:
+        return None
+    elif command in MULTI_KEY_READ_COMMANDS:
+        return list(args)
+    elif command in KEYLESS_READ_COMMANDS:
+        return []
+    elif command in READ_COMMANDS:
+        return list(args[:1])
+    else:
+        return []
+
+
+def accessed_keys(command, args):
+    """Get the arguments which are keys read or modified by a command
+
+    This is None if the command may use keys we can't identify.
+    """
+
+    command = command.lower()
+    if command in STORE_COMMANDS:
+        return list(args)
+    elif command in COUNTED_STORE_COMMANDS:
+        return None
+
+    read = read_keys(command, args)
+    written = written_keys(command, args)
+    if read is None or written is None:
+        return None
+
+    return read + [arg for arg in written if arg not in read]
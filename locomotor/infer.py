@@ -0,0 +1,301 @@
+import ast
+import sully
+
+#: Types which values in generated Lua code can be inferred to have
+NUMBER = 'number'
+STRING = 'string'
+LIST = 'list'
+DICT = 'dict'
+BOOLEAN = 'boolean'
+NIL = 'nil'
+
+#: A value whose type can't be determined statically
+ANY = 'any'
+
+#: Types of the replies to Redis commands as seen by Lua scripts
+#: Note that HGETALL produces a flat list of keys and values in Lua
+REPLY_TYPES = {
+    'append': NUMBER, 'decr': NUMBER, 'decrby': NUMBER, 'del': NUMBER,
+    'delete': NUMBER, 'exists': NUMBER, 'expire': NUMBER,
+    'expireat': NUMBER, 'getbit': NUMBER, 'hdel': NUMBER,
+    'hexists': NUMBER, 'hincrby': NUMBER, 'hlen': NUMBER, 'hset': NUMBER,
+    'hsetnx': NUMBER, 'incr': NUMBER, 'incrby': NUMBER, 'linsert': NUMBER,
+    'llen': NUMBER, 'lpush': NUMBER, 'lpushx': NUMBER, 'lrem': NUMBER,
+    'move': NUMBER, 'msetnx': NUMBER, 'persist': NUMBER, 'publish': NUMBER,
+    'renamenx': NUMBER, 'rpush': NUMBER, 'rpushx': NUMBER, 'sadd': NUMBER,
+    'scard': NUMBER, 'sdiffstore': NUMBER, 'setbit': NUMBER,
+    'setnx': NUMBER, 'setrange': NUMBER, 'sinterstore': NUMBER,
+    'sismember': NUMBER, 'smove': NUMBER, 'srem': NUMBER, 'strlen': NUMBER,
+    'sunionstore': NUMBER, 'ttl': NUMBER, 'zadd': NUMBER, 'zcard': NUMBER,
+    'zinterstore': NUMBER, 'zrank': NUMBER, 'zrem': NUMBER,
+    'zremrangebyrank': NUMBER, 'zrevrank': NUMBER, 'zunionstore': NUMBER,
+
+    'get': STRING, 'getset': STRING, 'hget': STRING, 'lindex': STRING,
+    'lpop': STRING, 'randomkey': STRING, 'rpop': STRING,
+    'rpoplpush': STRING, 'brpoplpush': STRING, 'substr': STRING,
+    'zincrby': STRING, 'zscore': STRING,
+
+    'blpop': LIST, 'brpop': LIST, 'execute': LIST, 'hgetall': LIST,
+    'hkeys': LIST, 'hmget': LIST, 'hvals': LIST, 'keys': LIST,
+    'lrange': LIST, 'mget': LIST, 'sdiff': LIST, 'sinter': LIST,
+    'smembers': LIST, 'sort': LIST, 'sunion': LIST, 'zrange': LIST,
+    'zrangebyscore': LIST, 'zrevrange': LIST, 'zrevrangebyscore': LIST,
+}
+
+#: Commands which return a list instead of a single value given a count
+COUNT_REPLY_COMMANDS = ('spop', 'srandmember')
+
+
+def value_type(value):
+    """Get the type of a Python value once converted to Lua"""
+
+    # Booleans are a subclass of int so we need to be careful here
+    if isinstance(value, bool):
+        return ANY
+    elif isinstance(value, (int, long, float)):
+        return NUMBER
+    elif isinstance(value, basestring):
+        return STRING
+    elif isinstance(value, (list, tuple)):
+        return LIST
+    elif isinstance(value, dict):
+        return DICT
+    elif value is None:
+        return NIL
+    else:
+        return ANY
+
+
+def hint_type(hint):
+    """Get the type corresponding to a Python type given as a hint"""
+
+    if issubclass(hint, bool):
+        return BOOLEAN
+    elif issubclass(hint, (int, long, float)):
+        return NUMBER
+    elif issubclass(hint, basestring):
+        return STRING
+    elif issubclass(hint, (list, tuple)):
+        return LIST
+    elif issubclass(hint, dict):
+        return DICT
+    else:
+        return ANY
+
+
+class TypeInference(object):
+    """Infer the types of local variables in a sequence of statements
+
+    The analysis is flow-insensitive, so a variable is given a type only
+    if every value assigned to it within the statements has that type.
+    Arguments and attributes of `self` (named as `self.attr`) start
+    with the type given in `arg_types` while types in `hints` are
+    always used for the corresponding names.
+    """
+
+    def __init__(self, nodes, arg_types=None, redis_objs=(), constant=None,
+                 hints=None):
+        self.redis_objs = redis_objs
+        self.constant = constant
+        self.arg_types = arg_types or {}
+        self.hints = hints or {}
+
+        # Find all the values assigned to each name and any names which
+        # are used as lists by appending to them
+        self.assignments = {}
+        self.appended = set()
+        for node in nodes:
+            self.find_assignments(node)
+
+        # Iterate until no types change since assignments
+        # can depend on the types of other variables
+        self.types = dict(self.arg_types)
+        self.types.update(self.hints)
+        for _ in range(len(self.assignments) + 1):
+            types = dict(self.arg_types)
+            for name in self.assignments:
+                types[name] = self.assigned_type(name)
+            types.update(self.hints)
+
+            if types == self.types:
+                break
+            self.types = types
+
+    def add_assignment(self, name, value):
+        """Record a value (or a type if given a string) assigned to a name"""
+
+        self.assignments.setdefault(name, []).append(value)
+
+    def find_assignments(self, node):
+        """Record all assignments in a statement and any nested statements"""
+
+        if isinstance(node, ast.Assign):
+            for target in node.targets:
+                if isinstance(target, ast.Name):
+                    self.add_assignment(target.id, node.value)
+                elif isinstance(target, (ast.Tuple, ast.List)):
+                    for elt in target.elts:
+                        if isinstance(elt, ast.Name):
+                            self.add_assignment(elt.id, ANY)
+        elif isinstance(node, ast.AugAssign) and \
+                isinstance(node.target, ast.Name):
+            self.add_assignment(node.target.id,
+                                ast.BinOp(left=node.target, op=node.op,
+                                          right=node.value))
+        elif isinstance(node, ast.For) and isinstance(node.target, ast.Name):
+            # Loops over ranges are translated to numeric for loops
+            if isinstance(node.iter, ast.Call) and \
+                    isinstance(node.iter.func, ast.Name) and \
+                    node.iter.func.id in ('range', 'xrange'):
+                self.add_assignment(node.target.id, NUMBER)
+            else:
+                self.add_assignment(node.target.id, ANY)
+
+        # Appending or inserting into a value means it must be a list
+        for child in ast.walk(node):
+            if isinstance(child, ast.Call) and \
+                    isinstance(child.func, ast.Attribute) and \
+                    child.func.attr in ('append', 'insert') and \
+                    isinstance(child.func.value, ast.Name):
+                self.appended.add(child.func.value.id)
+
+        for field in ('body', 'orelse'):
+            for child in getattr(node, field, []):
+                self.find_assignments(child)
+
+    def assigned_type(self, name):
+        """Combine the types of all values assigned to a name"""
+
+        types = set()
+        if name in self.arg_types:
+            types.add(self.arg_types[name])
+
+        for value in self.assignments[name]:
+            if isinstance(value, str):
+                types.add(value)
+            else:
+                types.add(self.expr_type(value))
+        types.discard(None)
+
+        # Values which are appended to are lists even if
+        # we don't know what was originally assigned
+        if name in self.appended:
+            types.discard(ANY)
+            types.add(LIST)
+
+        if len(types) == 1:
+            return types.pop()
+        elif len(types) == 0:
+            return None
+        else:
+            return ANY
+
+    def name_type(self, name):
+        """Get the type of a variable or attribute of self"""
+
+        return self.types.get(name) or ANY
+
+    def is_redis_obj(self, node):
+        """Check if a node refers to a Redis client object"""
+
+        return any(sully.nodes_equal(node, obj) for obj in self.redis_objs)
+
+    def constant_type(self, expr):
+        """Get the type of a constant value"""
+
+        if self.constant is None:
+            return ANY
+
+        try:
+            return value_type(self.constant(expr))
+        except Exception:
+            return ANY
+
+    def expr_type(self, node):
+        """Get the type of the value of an expression
+
+        This is None for variables we have no information about yet.
+        """
+
+        if isinstance(node, ast.Num):
+            return NUMBER
+        elif isinstance(node, ast.Str):
+            return STRING
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            return LIST
+        elif isinstance(node, ast.Dict):
+            return DICT
+        elif isinstance(node, ast.Name):
+            if node.id == 'None':
+                return NIL
+            elif node.id in ('True', 'False'):
+                return BOOLEAN
+            elif node.id.isupper():
+                return self.constant_type((node.id,))
+            else:
+                return self.types.get(node.id)
+        elif isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name):
+            if node.value.id == 'self':
+                return self.name_type('self.' + node.attr)
+            elif node.attr.isupper():
+                return self.constant_type((node.value.id, node.attr))
+        elif isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Add):
+                types = set([self.expr_type(node.left),
+                             self.expr_type(node.right)])
+
+                # Python would fail to add numbers to anything else
+                if NUMBER in types:
+                    return NUMBER
+                elif STRING in types:
+                    return STRING
+                elif types == set([LIST]):
+                    return LIST
+                else:
+                    return ANY
+            else:
+                # Other operators are always arithmetic in Lua
+                return NUMBER
+        elif isinstance(node, ast.BoolOp):
+            types = set(self.expr_type(value) for value in node.values)
+            types.discard(None)
+            return types.pop() if len(types) == 1 else ANY
+        elif isinstance(node, ast.Compare):
+            return BOOLEAN
+        elif isinstance(node, ast.UnaryOp):
+            return BOOLEAN if isinstance(node.op, ast.Not) else NUMBER
+        elif isinstance(node, ast.IfExp):
+            types = set([self.expr_type(node.body),
+                         self.expr_type(node.orelse)])
+            types.discard(None)
+            return types.pop() if len(types) == 1 else ANY
+        elif isinstance(node, ast.Call):
+            return self.call_type(node)
+
+        return ANY
+
+    def call_type(self, node):
+        """Get the type of the value returned by a function call"""
+
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id in ('int', 'float', 'len'):
+                return NUMBER
+            elif func.id == 'str':
+                return STRING
+            elif func.id in ('range', 'xrange'):
+                return LIST
+        elif isinstance(func, ast.Attribute):
+            if isinstance(func.value, ast.Name) and \
+                    func.value.id == func.attr == 'time':
+                return NUMBER
+            elif func.attr in ('join', 'replace'):
+                return STRING
+            elif self.is_redis_obj(func.value):
+                if func.attr in COUNT_REPLY_COMMANDS:
+                    return LIST if len(node.args) > 1 else STRING
+
+                return REPLY_TYPES.get(func.attr, ANY)
+
+        return ANY
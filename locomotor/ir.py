@@ -0,0 +1,670 @@
+import collections
+import math
+import re
+
+#: The string literal to use for tabs in generated Lua code
+TAB = '  '
+
+#: Lua keywords which can't be used as names
+LUA_KEYWORDS = set(['and', 'break', 'do', 'else', 'elseif', 'end', 'false',
+                    'for', 'function', 'if', 'in', 'local', 'nil', 'not',
+                    'or', 'repeat', 'return', 'then', 'true', 'until',
+                    'while'])
+
+#: A valid Lua identifier
+IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+#: Precedence of Lua binary operators (higher binds more tightly)
+BINARY_PRECEDENCE = {'or': 1, 'and': 2, '<': 3, '>': 3, '<=': 3, '>=': 3,
+                     '~=': 3, '==': 3, '..': 4, '+': 5, '-': 5, '*': 6,
+                     '/': 6, '%': 6, '^': 8}
+
+#: Binary operators which are right associative
+RIGHT_ASSOCIATIVE = ('..', '^')
+
+#: Precedence of unary operators
+UNARY_PRECEDENCE = 7
+
+#: Precedence of expressions which never need parentheses
+ATOM_PRECEDENCE = 10
+
+#: Functions which have no side effects
+PURE_FUNCTIONS = ('__TRUE', 'tonumber', 'tostring', 'type')
+
+
+class Node(object):
+    """A node in the tree of Lua code"""
+
+    #: The attributes of the node which contain other nodes
+    _fields = ()
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join(repr(getattr(self, field))
+                                     for field in self._fields))
+
+    def __str__(self):
+        return self.render()
+
+
+# Expressions
+
+class Expr(Node):
+    precedence = ATOM_PRECEDENCE
+
+    def render(self, indent=0, tab=TAB):
+        raise NotImplementedError()
+
+
+class Const(Expr):
+    """A literal value given as the equivalent Python value"""
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return 'Const(%r)' % (self.value,)
+
+    @property
+    def precedence(self):
+        # Negative numbers behave as a unary minus
+        if isinstance(self.value, (int, long, float)) and \
+                not isinstance(self.value, bool) and self.value < 0:
+            return UNARY_PRECEDENCE
+        return ATOM_PRECEDENCE
+
+    def render(self, indent=0, tab=TAB):
+        value = self.value
+        if value is None:
+            return 'nil'
+        elif isinstance(value, bool):
+            return 'true' if value else 'false'
+        elif isinstance(value, float):
+            if math.isnan(value):
+                return '(0/0)'
+            elif math.isinf(value):
+                return '(1/0)' if value > 0 else '(-1/0)'
+            return repr(value)
+        elif isinstance(value, (int, long)):
+            return str(value)
+        elif isinstance(value, basestring):
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+
+            # XXX Lua probably doesn't follow the exact same escaping rules
+            #     but this will work for a lot of simple cases
+            return "'" + value.encode('string_escape') + "'"
+        else:
+            return str(value)
+
+
+class Name(Expr):
+    """A reference to a variable"""
+
+    _fields = ()
+
+    def __init__(self, id):
+        self.id = id
+
+    def __repr__(self):
+        return 'Name(%r)' % self.id
+
+    def render(self, indent=0, tab=TAB):
+        return self.id
+
+
+class Index(Expr):
+    """Indexing into a table, obj[key]"""
+
+    _fields = ('obj', 'key')
+
+    def __init__(self, obj, key):
+        self.obj = obj
+        self.key = key
+
+    def render(self, indent=0, tab=TAB):
+        obj = prefix(self.obj, indent, tab)
+        if isinstance(self.key, Const) and \
+                isinstance(self.key.value, str) and \
+                IDENTIFIER_RE.match(self.key.value) and \
+                self.key.value not in LUA_KEYWORDS:
+            return '%s.%s' % (obj, self.key.value)
+        else:
+            return '%s[%s]' % (obj, self.key.render(indent, tab))
+
+
+class BinOp(Expr):
+    """A binary operator using Lua syntax (e.g. '..' or 'and')"""
+
+    _fields = ('left', 'right')
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def __repr__(self):
+        return 'BinOp(%r, %r, %r)' % (self.op, self.left, self.right)
+
+    @property
+    def precedence(self):
+        return BINARY_PRECEDENCE[self.op]
+
+    def render(self, indent=0, tab=TAB):
+        prec = self.precedence
+        right_assoc = self.op in RIGHT_ASSOCIATIVE
+
+        left = self.left.render(indent, tab)
+        if self.left.precedence < prec or \
+                (right_assoc and self.left.precedence == prec):
+            left = '(%s)' % left
+
+        right = self.right.render(indent, tab)
+        if self.right.precedence < prec or \
+                (not right_assoc and self.right.precedence == prec):
+            right = '(%s)' % right
+
+        return '%s %s %s' % (left, self.op, right)
+
+
+class UnOp(Expr):
+    """A unary operator ('-', 'not', or '#')"""
+
+    _fields = ('operand',)
+    precedence = UNARY_PRECEDENCE
+
+    def __init__(self, op, operand):
+        self.op = op
+        self.operand = operand
+
+    def __repr__(self):
+        return 'UnOp(%r, %r)' % (self.op, self.operand)
+
+    def render(self, indent=0, tab=TAB):
+        operand = self.operand.render(indent, tab)
+
+        # Avoid accidentally producing a comment with two minus signs
+        if self.operand.precedence <= UNARY_PRECEDENCE:
+            operand = '(%s)' % operand
+
+        if self.op == 'not':
+            return 'not ' + operand
+        else:
+            return self.op + operand
+
+
+class Paren(Expr):
+    """An expression in parentheses which also truncates multiple values"""
+
+    _fields = ('expr',)
+
+    def __init__(self, expr):
+        self.expr = expr
+
+    def render(self, indent=0, tab=TAB):
+        return '(%s)' % self.expr.render(indent, tab)
+
+
+class Call(Expr):
+    """A function call"""
+
+    _fields = ('func', 'args')
+
+    def __init__(self, func, args=None):
+        if isinstance(func, str):
+            func = Name(func)
+        self.func = func
+        self.args = list(args or [])
+
+    def render(self, indent=0, tab=TAB):
+        return '%s(%s)' % (prefix(self.func, indent, tab),
+                           ', '.join(arg.render(indent, tab)
+                                     for arg in self.args))
+
+
+class RedisCall(Call):
+    """A call to a Redis command with redis.call"""
+
+    _fields = ('args',)
+
+    def __init__(self, command, args=None):
+        self.command = command.lower()
+        super(RedisCall, self).__init__(Index(Name('redis'), Const('call')),
+                                        args)
+
+    def __repr__(self):
+        return 'RedisCall(%r, %r)' % (self.command, self.args)
+
+    def render(self, indent=0, tab=TAB):
+        return 'redis.call(%s)' % ', '.join(
+            [Const(self.command).render()] +
+            [arg.render(indent, tab) for arg in self.args])
+
+
+class Function(Expr):
+    """An anonymous function"""
+
+    _fields = ('body',)
+
+    def __init__(self, params, body):
+        self.params = list(params)
+        self.body = body
+
+    def __repr__(self):
+        return 'Function(%r, %r)' % (self.params, self.body)
+
+    def render(self, indent=0, tab=TAB):
+        return 'function(%s)\n%s%send' % (', '.join(self.params),
+                                         self.body.render(indent + 1, tab),
+                                         tab * indent)
+
+
+class Pair(Node):
+    """A keyed entry in a table constructor"""
+
+    _fields = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key = key
+        self.value = value
+
+    def render(self, indent=0, tab=TAB):
+        return '[%s] = %s' % (self.key.render(indent, tab),
+                              self.value.render(indent, tab))
+
+
+class Table(Expr):
+    """A table constructor whose items are expressions or pairs"""
+
+    _fields = ('items',)
+
+    def __init__(self, items=None):
+        self.items = list(items or [])
+
+    def render(self, indent=0, tab=TAB):
+        return '{%s}' % ', '.join(item.render(indent, tab)
+                                  for item in self.items)
+
+
+class Raw(Expr):
+    """An expression given directly as Lua code"""
+
+    precedence = 0
+
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return 'Raw(%r)' % self.code
+
+    def render(self, indent=0, tab=TAB):
+        return self.code
+
+
+def prefix(expr, indent, tab):
+    """Render an expression which is called or indexed"""
+
+    code = expr.render(indent, tab)
+    if isinstance(expr, (Name, Index, Call, Paren)):
+        return code
+    else:
+        return '(%s)' % code
+
+
+# Statements
+
+class Stmt(Node):
+    #: Statements which must be the last in a block
+    last = False
+
+    def render(self, indent=0, tab=TAB):
+        return tab * indent + self.render_line(indent, tab) + '\n'
+
+    def render_line(self, indent, tab):
+        raise NotImplementedError()
+
+
+class Block(Node):
+    """A sequence of statements"""
+
+    _fields = ('body',)
+
+    def __init__(self, body=None):
+        self.body = []
+        for stmt in body or []:
+            self.append(stmt)
+
+    def append(self, stmt):
+        if stmt is None:
+            return
+        elif isinstance(stmt, Block):
+            self.body.extend(stmt.body)
+        elif isinstance(stmt, list):
+            for item in stmt:
+                self.append(item)
+        else:
+            self.body.append(stmt)
+
+    extend = append
+
+    def __len__(self):
+        return len(self.body)
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def render(self, indent=0, tab=TAB):
+        code = ''
+        for i, stmt in enumerate(self.body):
+            # Lua only allows return and break at the end of a block
+            if stmt.last and i != len(self.body) - 1:
+                code += tab * indent + 'do ' + \
+                        stmt.render_line(indent, tab) + ' end\n'
+            else:
+                code += stmt.render(indent, tab)
+
+        return code
+
+
+class Local(Stmt):
+    """Declaration of local variables with optional values"""
+
+    _fields = ('values',)
+
+    def __init__(self, names, values=None):
+        self.names = list(names)
+        self.values = list(values or [])
+
+    def __repr__(self):
+        return 'Local(%r, %r)' % (self.names, self.values)
+
+    def render_line(self, indent, tab):
+        line = 'local ' + ', '.join(self.names)
+        if self.values:
+            line += ' = ' + ', '.join(value.render(indent, tab)
+                                      for value in self.values)
+        return line + ';'
+
+
+class Assign(Stmt):
+    _fields = ('targets', 'values')
+
+    def __init__(self, targets, values):
+        self.targets = list(targets)
+        self.values = list(values)
+
+    def render_line(self, indent, tab):
+        return '%s = %s;' % (', '.join(target.render(indent, tab)
+                                       for target in self.targets),
+                             ', '.join(value.render(indent, tab)
+                                       for value in self.values))
+
+
+class CallStmt(Stmt):
+    """A function call executed for its side effects"""
+
+    _fields = ('call',)
+
+    def __init__(self, call):
+        self.call = call
+
+    def render_line(self, indent, tab):
+        return self.call.render(indent, tab) + ';'
+
+
+class Return(Stmt):
+    _fields = ('values',)
+    last = True
+
+    def __init__(self, values=None):
+        self.values = list(values or [])
+
+    def render_line(self, indent, tab):
+        if self.values:
+            return 'return %s;' % ', '.join(value.render(indent, tab)
+                                            for value in self.values)
+        else:
+            return 'return;'
+
+
+class Break(Stmt):
+    last = True
+
+    def render_line(self, indent, tab):
+        return 'break;'
+
+
+class If(Stmt):
+    _fields = ('test', 'body', 'orelse')
+
+    def __init__(self, test, body, orelse=None):
+        self.test = test
+        self.body = body
+        self.orelse = orelse or Block()
+
+    def render(self, indent=0, tab=TAB):
+        code = tab * indent + 'if %s then\n' % self.test.render(indent, tab)
+        code += self.body.render(indent + 1, tab)
+        if len(self.orelse) > 0:
+            code += tab * indent + 'else\n'
+            code += self.orelse.render(indent + 1, tab)
+        return code + tab * indent + 'end\n'
+
+
+class NumericFor(Stmt):
+    _fields = ('start', 'stop', 'step', 'body')
+
+    def __init__(self, var, start, stop, step, body):
+        self.var = var
+        self.start = start
+        self.stop = stop
+        self.step = step
+        self.body = body
+
+    def __repr__(self):
+        return 'NumericFor(%r, %r, %r, %r, %r)' % \
+               (self.var, self.start, self.stop, self.step, self.body)
+
+    def render(self, indent=0, tab=TAB):
+        bounds = [self.start.render(indent, tab),
+                  self.stop.render(indent, tab)]
+        if not (isinstance(self.step, Const) and self.step.value == 1):
+            bounds.append(self.step.render(indent, tab))
+
+        return tab * indent + 'for %s = %s do\n' % (self.var,
+                                                   ', '.join(bounds)) + \
+            self.body.render(indent + 1, tab) + tab * indent + 'end\n'
+
+
+class GenericFor(Stmt):
+    _fields = ('exprs', 'body')
+
+    def __init__(self, names, exprs, body):
+        self.names = list(names)
+        self.exprs = list(exprs)
+        self.body = body
+
+    def __repr__(self):
+        return 'GenericFor(%r, %r, %r)' % (self.names, self.exprs, self.body)
+
+    def render(self, indent=0, tab=TAB):
+        return tab * indent + 'for %s in %s do\n' % \
+            (', '.join(self.names),
+             ', '.join(expr.render(indent, tab) for expr in self.exprs)) + \
+            self.body.render(indent + 1, tab) + tab * indent + 'end\n'
+
+
+class While(Stmt):
+    _fields = ('test', 'body')
+
+    def __init__(self, test, body):
+        self.test = test
+        self.body = body
+
+    def render(self, indent=0, tab=TAB):
+        return tab * indent + 'while %s do\n' % \
+            self.test.render(indent, tab) + \
+            self.body.render(indent + 1, tab) + tab * indent + 'end\n'
+
+
+class Repeat(Stmt):
+    _fields = ('body', 'test')
+
+    def __init__(self, body, test):
+        self.body = body
+        self.test = test
+
+    def render(self, indent=0, tab=TAB):
+        return tab * indent + 'repeat\n' + \
+            self.body.render(indent + 1, tab) + \
+            tab * indent + 'until %s\n' % self.test.render(indent, tab)
+
+
+class Do(Stmt):
+    _fields = ('body',)
+
+    def __init__(self, body):
+        self.body = body
+
+    def render(self, indent=0, tab=TAB):
+        return tab * indent + 'do\n' + self.body.render(indent + 1, tab) + \
+            tab * indent + 'end\n'
+
+
+class RawStmt(Stmt):
+    """Statements given directly as Lua code"""
+
+    def __init__(self, code):
+        self.code = code
+
+    def __repr__(self):
+        return 'RawStmt(%r)' % self.code
+
+    def render(self, indent=0, tab=TAB):
+        if self.code.endswith('\n'):
+            return self.code
+        else:
+            return self.code + '\n'
+
+
+# Traversal and analysis
+
+def iter_child_nodes(node):
+    """Yield all the nodes directly contained in a node"""
+
+    for field in node._fields:
+        value = getattr(node, field)
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, Node):
+                    yield item
+        elif isinstance(value, Node):
+            yield value
+
+
+def walk(node):
+    """Yield a node and all nodes it contains"""
+
+    todo = collections.deque([node])
+    while todo:
+        node = todo.popleft()
+        todo.extend(iter_child_nodes(node))
+        yield node
+
+
+class NodeTransformer(object):
+    """Walk a tree replacing nodes with the value returned from a
+    visit_ method for the class of the node. Returning None removes the
+    node from a list and returning a list splices in multiple nodes."""
+
+    def visit(self, node):
+        method = getattr(self, 'visit_' + node.__class__.__name__,
+                         self.generic_visit)
+        return method(node)
+
+    def generic_visit(self, node):
+        for field in node._fields:
+            value = getattr(node, field)
+            if isinstance(value, list):
+                new_values = []
+                for item in value:
+                    if isinstance(item, Node):
+                        item = self.visit(item)
+                        if item is None:
+                            continue
+                        elif isinstance(item, list):
+                            new_values.extend(item)
+                            continue
+                    new_values.append(item)
+                value[:] = new_values
+            elif isinstance(value, Node):
+                setattr(node, field, self.visit(value))
+
+        return node
+
+
+#: Identifiers in raw Lua code
+RAW_NAME_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+
+
+def raw_names(code):
+    """Find every name which might be used in raw Lua code"""
+
+    return set(RAW_NAME_RE.findall(code)) - LUA_KEYWORDS
+
+
+def name_reads(node):
+    """Count the number of times each variable is read"""
+
+    reads = collections.Counter()
+    for child in walk(node):
+        if isinstance(child, Name):
+            reads[child.id] += 1
+        elif isinstance(child, (Raw, RawStmt)):
+            reads.update(raw_names(child.code))
+        elif isinstance(child, Assign):
+            # Names being assigned to aren't read
+            for target in child.targets:
+                if isinstance(target, Name):
+                    reads[target.id] -= 1
+
+    return reads
+
+
+def name_writes(node):
+    """Count the number of times each variable is assigned or declared"""
+
+    writes = collections.Counter()
+    for child in walk(node):
+        if isinstance(child, Assign):
+            for target in child.targets:
+                if isinstance(target, Name):
+                    writes[target.id] += 1
+        elif isinstance(child, Local):
+            writes.update(child.names)
+        elif isinstance(child, NumericFor):
+            writes[child.var] += 1
+        elif isinstance(child, GenericFor):
+            writes.update(child.names)
+        elif isinstance(child, Function):
+            writes.update(child.params)
+        elif isinstance(child, (Raw, RawStmt)):
+            writes.update(raw_names(child.code))
+
+    return writes
+
+
+def is_pure(expr):
+    """Check if evaluating an expression can have side effects"""
+
+    if isinstance(expr, (Raw, RedisCall)):
+        return False
+    elif isinstance(expr, Call):
+        if not (isinstance(expr.func, Name) and
+                expr.func.id in PURE_FUNCTIONS):
+            return False
+    elif isinstance(expr, Function):
+        # Creating a function doesn't run it
+        return True
+
+    return all(is_pure(child) for child in iter_child_nodes(expr))
@@ -0,0 +1,26 @@
+-- Keys are sent in chunks since unpack fails with too many values
+local __BATCH_SIZE = 1000
+
+local __BATCH_READ = function(command, key, args)
+  local __VALUES = {}
+  for __I = 1, #args, __BATCH_SIZE do
+    local __LAST = math.min(__I + __BATCH_SIZE - 1, #args)
+    local __REPLY
+    if key == nil then
+      __REPLY = redis.call(command, unpack(args, __I, __LAST))
+    else
+      __REPLY = redis.call(command, key, unpack(args, __I, __LAST))
+    end
+
+    for __J = 1, #__REPLY do
+      -- MGET gives nil for keys of other types where GET fails so we
+      -- read missing values again to raise the same error
+      if key == nil and not __REPLY[__J] then
+        redis.call('get', args[__I + __J - 1])
+      end
+      __VALUES[__I + __J - 1] = __REPLY[__J]
+    end
+  end
+
+  return __VALUES
+end
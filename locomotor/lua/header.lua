@@ -21,28 +21,113 @@ local __TRUE = function(expr)
   end
 end
 
-local __OR = function(...)
-    local __VAL = nil
-    for i, v in ipairs(arg) do
-        if __TRUE(v) then
-            return v
-        else
-            __VAL = v
-        end
+local __ADD = function(a, b)
+  if type(a) == "number" and type(b) == "number" then
+    return a + b
+  else
+    return a .. b
+  end
+end
+
+-- Values returned as native replies must be strings or integers which
+-- Redis can convert without losing anything
+local __SCALAR = function(value)
+  local __TYPE = type(value)
+  if __TYPE == "number" then
+    return value == math.floor(value) and math.abs(value) < 2^53
+  else
+    return __TYPE == "string"
+  end
+end
+
+-- Scripts returning one type of value give it as a native reply when
+-- it fits and otherwise pack it in a reply of another kind
+local __REPLY_NUMBER = function(value)
+  if type(value) == "number" and __SCALAR(value) then
+    return value
+  else
+    return __RETVAL(value, true)
+  end
+end
+
+local __REPLY_STRING = function(value)
+  if value == nil or type(value) == "string" then
+    return value
+  else
+    return {__RETVAL(value, true)}
+  end
+end
+
+local __REPLY_BOOLEAN = function(value)
+  if value == true then
+    return 1
+  elseif value == false then
+    return 0
+  else
+    return __RETVAL(value, true)
+  end
+end
+
+local __REPLY_LIST = function(value)
+  if type(value) ~= "table" or value["__DICT"] then
+    return __RETVAL(value, true)
+  end
+
+  local __COUNT = 0
+  for _, __ITEM in pairs(value) do
+    if not __SCALAR(__ITEM) then
+      return __RETVAL(value, true)
+    end
+    __COUNT = __COUNT + 1
+  end
+
+  -- Tables with holes or other keys aren't lists
+  if __COUNT ~= #value then
+    return __RETVAL(value, true)
+  end
+
+  return value
+end
+
+local __REPLY_DICT = function(value)
+  if type(value) ~= "table" or not value["__DICT"] then
+    return __RETVAL(value, true)
+  end
+
+  local __MAP = {}
+  for __KEY, __ITEM in pairs(value) do
+    if __KEY ~= "__DICT" then
+      if not __SCALAR(__KEY) or not __SCALAR(__ITEM) then
+        return __RETVAL(value, true)
+      end
+      __MAP[__KEY] = __ITEM
     end
+  end
 
-    return __VAL
+  return {map = __MAP}
 end
 
-local __AND = function(...)
-    local __VAL = nil
-    for i, v in ipairs(arg) do
-        if not __TRUE(v) then
-            return v
-        else
-            __VAL = v
-        end
+-- Lists returned by scripts which stream their results are stored in a
+-- temporary key read in pages (which expires if it is never read)
+local __STREAM = function(value, page_size)
+  if type(value) ~= "table" or value["__DICT"] then
+    return __RETVAL(value, true)
+  end
+
+  local __KEY = "locomotor-stream:" .. redis.call("incr", "locomotor-stream")
+  local __CHUNK = {}
+  for __I = 1, #value do
+    __CHUNK[#__CHUNK + 1] = cmsgpack.pack(value[__I])
+
+    -- Items are pushed in chunks since unpack fails with too many values
+    if #__CHUNK == 1000 or __I == #value then
+      redis.call("rpush", __KEY, unpack(__CHUNK))
+      __CHUNK = {}
     end
+  end
+  if #value > 0 then
+    redis.call("expire", __KEY, 300)
+  end
 
-    return __VAL
+  return {__KEY, #value, page_size}
 end
@@ -0,0 +1,16 @@
+local __RESULTS = {}
+for __I, __ARGS in ipairs(cmsgpack.unpack(ARGV[1])) do
+  local __OK, __RESULT = pcall(__BODY, unpack(__ARGS, 1, __NARGS))
+
+  -- Record errors so a single failure doesn't lose every result
+  if not __OK then
+    if type(__RESULT) == "table" then
+      __RESULT = __RESULT["err"]
+    end
+    __RESULT = {["__error"] = tostring(__RESULT)}
+  end
+
+  __RESULTS[__I] = __RESULT or {}
+end
+
+return cmsgpack.pack(__RESULTS)
@@ -0,0 +1,2110 @@
+import collections
+import copy
+import operator
+import os
+import re
+import time
+
+from . import commands
+from . import ir
+
+#: A function which reads many keys or fields with a single command
+BATCHED_READ_CODE = open(os.path.dirname(__file__) +
+                         '/lua/batched.lua').read()
+
+#: The largest integer which Lua numbers (doubles) represent exactly
+MAX_EXACT_INT = 2 ** 53
+
+#: Arithmetic operators which can be evaluated at compile time
+ARITHMETIC_OPERATORS = {'+': operator.add, '-': operator.sub,
+                        '*': operator.mul, '/': operator.truediv,
+                        '%': operator.mod, '^': operator.pow}
+
+#: Comparisons which can be evaluated between numbers
+COMPARISON_OPERATORS = {'<': operator.lt, '<=': operator.le,
+                        '>': operator.gt, '>=': operator.ge}
+
+#: Strings which Lua would convert to the same integer as Python
+INTEGER_RE = re.compile(r'^-?[0-9]+$')
+
+
+def is_number(value):
+    """Check if a constant is a number in Lua"""
+
+    return isinstance(value, (int, long, float)) and \
+        not isinstance(value, bool)
+
+
+def is_scalar(value):
+    """Check if a constant can be compared by value"""
+
+    return value is None or isinstance(value, (bool, basestring)) or \
+        is_number(value)
+
+
+def is_exact(value):
+    """Check if a number is represented exactly in Lua"""
+
+    return isinstance(value, float) or abs(value) < MAX_EXACT_INT
+
+
+def truthy(value):
+    """Check if a constant is true in a Lua condition"""
+
+    return value is not None and value is not False
+
+
+def lua_type(value):
+    if value is None:
+        return 'nil'
+    elif isinstance(value, bool):
+        return 'boolean'
+    elif is_number(value):
+        return 'number'
+    else:
+        return 'string'
+
+
+def fold_binary(op, left, right):
+    """Evaluate a binary operator on constants or return None"""
+
+    if op in ARITHMETIC_OPERATORS and is_number(left) and is_number(right):
+        if op in ('/', '^'):
+            left = float(left)
+        try:
+            value = ARITHMETIC_OPERATORS[op](left, right)
+        except (ArithmeticError, ValueError):
+            return None
+
+        # Avoid producing values which Lua would compute differently
+        if isinstance(value, complex) or \
+                not all(is_exact(v) for v in (left, right, value)):
+            return None
+
+        return ir.Const(value)
+    elif op in COMPARISON_OPERATORS and \
+            is_number(left) and is_number(right):
+        return ir.Const(COMPARISON_OPERATORS[op](left, right))
+    elif op in ('==', '~=') and is_scalar(left) and is_scalar(right):
+        equal = lua_type(left) == lua_type(right) and left == right
+        return ir.Const(equal if op == '==' else not equal)
+    elif op == '..':
+        # Lua formats numbers differently from Python
+        # so we only concatenate integers with exact digits
+        values = []
+        for value in (left, right):
+            if isinstance(value, str):
+                values.append(value)
+            elif isinstance(value, (int, long)) and \
+                    not isinstance(value, bool) and abs(value) < 10 ** 14:
+                values.append(str(value))
+            else:
+                return None
+
+        return ir.Const(''.join(values))
+
+    return None
+
+
+class ConstantFolder(ir.NodeTransformer):
+    """Evaluate operators and conversions on constant values"""
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.left, ir.Const):
+            return node
+
+        # Logical operators only need to know the value on the left
+        if node.op == 'and':
+            return node.right if truthy(node.left.value) else node.left
+        elif node.op == 'or':
+            return node.left if truthy(node.left.value) else node.right
+
+        if not isinstance(node.right, ir.Const):
+            return node
+
+        return fold_binary(node.op, node.left.value, node.right.value) or node
+
+    def visit_UnOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.operand, ir.Const):
+            return node
+
+        value = node.operand.value
+        if node.op == 'not' and is_scalar(value):
+            return ir.Const(not truthy(value))
+        elif node.op == '-' and is_number(value):
+            return ir.Const(-value)
+        elif node.op == '#' and isinstance(value, str):
+            return ir.Const(len(value))
+
+        return node
+
+    def visit_Paren(self, node):
+        self.generic_visit(node)
+
+        # Parentheses only matter for truncating multiple values
+        if isinstance(node.expr, ir.Const):
+            return node.expr
+        return node
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.func, ir.Name) or len(node.args) != 1 or \
+                not isinstance(node.args[0], ir.Const):
+            return node
+
+        value = node.args[0].value
+        if node.func.id == 'tonumber':
+            if is_number(value):
+                return node.args[0]
+            elif isinstance(value, str) and INTEGER_RE.match(value) and \
+                    abs(int(value)) < MAX_EXACT_INT:
+                return ir.Const(int(value))
+        elif node.func.id == 'tostring':
+            if isinstance(value, str):
+                return node.args[0]
+            elif isinstance(value, (int, long)) and \
+                    not isinstance(value, bool) and abs(value) < 10 ** 14:
+                return ir.Const(str(value))
+
+        return node
+
+
+def fold_constants(block):
+    """Replace operations on constants with their values"""
+
+    return ConstantFolder().visit(block)
+
+
+class DeadCodeEliminator(ir.NodeTransformer):
+    """Remove statements which can never run or have no effect"""
+
+    def inline(self, block):
+        """Splice a block into the enclosing block when this is safe"""
+
+        # Locals would become visible after the block and
+        # return or break must stay at the end of a block
+        if any(isinstance(stmt, ir.Local) or stmt.last
+               for stmt in block.body):
+            return ir.Do(block)
+        else:
+            return block.body
+
+    def visit_Block(self, node):
+        self.generic_visit(node)
+
+        # Nothing after a return or break can run
+        for i, stmt in enumerate(node.body):
+            if stmt.last:
+                del node.body[i + 1:]
+                break
+
+        # A block at the end can be merged since nothing follows it
+        if len(node.body) > 0 and isinstance(node.body[-1], ir.Do):
+            node.body[-1:] = node.body[-1].body.body
+
+        return node
+
+    def visit_Do(self, node):
+        self.generic_visit(node)
+        return self.inline(node.body)
+
+    def visit_If(self, node):
+        self.generic_visit(node)
+        if isinstance(node.test, ir.Const):
+            if truthy(node.test.value):
+                return self.inline(node.body)
+            else:
+                return self.inline(node.orelse)
+        elif len(node.body) == 0 and len(node.orelse) == 0 and \
+                ir.is_pure(node.test):
+            return None
+
+        return node
+
+    def visit_While(self, node):
+        self.generic_visit(node)
+        if isinstance(node.test, ir.Const) and not truthy(node.test.value):
+            return None
+
+        return node
+
+    def visit_NumericFor(self, node):
+        self.generic_visit(node)
+        bounds = (node.start, node.stop, node.step)
+        if len(node.body) == 0 and all(ir.is_pure(b) for b in bounds):
+            return None
+
+        # Check for loops which will never execute
+        if all(isinstance(b, ir.Const) and is_number(b.value)
+               for b in bounds):
+            start, stop, step = (b.value for b in bounds)
+            if (step > 0 and start > stop) or (step < 0 and start < stop):
+                return None
+
+        return node
+
+    def visit_GenericFor(self, node):
+        self.generic_visit(node)
+        if len(node.body) == 0 and all(ir.is_pure(e) for e in node.exprs):
+            return None
+
+        return node
+
+
+def eliminate_dead_code(block):
+    """Remove unreachable code and statements which do nothing"""
+
+    return DeadCodeEliminator().visit(block)
+
+
+class NameReplacer(ir.NodeTransformer):
+    """Replace all reads of a variable with an expression"""
+
+    def __init__(self, name, value):
+        self.name = name
+        self.value = value
+
+    def visit_Name(self, node):
+        if node.id == self.name:
+            return copy.deepcopy(self.value)
+        return node
+
+
+def single_definition(stmt, declared, writes):
+    """Get the name and value of a statement which is the only
+    assignment to a local variable or (None, None)"""
+
+    if isinstance(stmt, ir.Local) and len(stmt.names) == 1 and \
+            len(stmt.values) == 1 and writes[stmt.names[0]] == 1:
+        return stmt.names[0], stmt.values[0]
+    elif isinstance(stmt, ir.Assign) and len(stmt.targets) == 1 and \
+            len(stmt.values) == 1 and isinstance(stmt.targets[0], ir.Name):
+        # The variable must be declared earlier in the same block
+        name = stmt.targets[0].id
+        if name in declared and writes[name] == 2:
+            return name, stmt.values[0]
+
+    return None, None
+
+
+def propagate_scope(block, params, writes):
+    """Propagate copies defined in the statements of a single function"""
+
+    # Variables which are never reassigned after their definition
+    stable = set(name for name in params if writes[name] == 1)
+    declared = set()
+
+    for i, stmt in enumerate(block.body):
+        if isinstance(stmt, ir.Local) and not stmt.values:
+            declared.update(stmt.names)
+            continue
+
+        name, value = single_definition(stmt, declared, writes)
+        if name is None:
+            continue
+
+        if (isinstance(value, ir.Const) and is_scalar(value.value)) or \
+                (isinstance(value, ir.Name) and value.id in stable):
+            # Uses before the definition would see nil
+            earlier = ir.name_reads(ir.Block(block.body[:i]))
+            if earlier[name] == 0:
+                replacer = NameReplacer(name, value)
+                block.body[i + 1:] = [replacer.visit(s)
+                                      for s in block.body[i + 1:]]
+
+        stable.add(name)
+
+
+def propagate_copies(block):
+    """Replace variables assigned once from a constant or another
+    variable which is never reassigned with the original value"""
+
+    writes = ir.name_writes(block)
+    propagate_scope(block, [], writes)
+    for node in ir.walk(block):
+        if isinstance(node, ir.Function):
+            propagate_scope(node.body, node.params, writes)
+
+    return block
+
+
+class UnusedLocalRemover(ir.NodeTransformer):
+    """Remove local variables which are never read"""
+
+    def __init__(self, reads, local_names):
+        self.reads = reads
+        self.local_names = local_names
+        self.changed = False
+
+    def discard(self, node, value):
+        """Keep only the side effects of evaluating a value"""
+
+        if ir.is_pure(value):
+            self.changed = True
+            return None
+        elif isinstance(value, ir.Call):
+            self.changed = True
+            return ir.CallStmt(value)
+        else:
+            return node
+
+    def visit_Local(self, node):
+        self.generic_visit(node)
+        if node.values:
+            if len(node.names) == 1 and len(node.values) == 1 and \
+                    self.reads[node.names[0]] <= 0:
+                return self.discard(node, node.values[0])
+            return node
+
+        names = [name for name in node.names if self.reads[name] > 0]
+        if len(names) == len(node.names):
+            return node
+
+        self.changed = True
+        if len(names) == 0:
+            return None
+        node.names = names
+        return node
+
+    def visit_Assign(self, node):
+        self.generic_visit(node)
+        if len(node.targets) == 1 and len(node.values) == 1 and \
+                isinstance(node.targets[0], ir.Name) and \
+                node.targets[0].id in self.local_names and \
+                self.reads[node.targets[0].id] <= 0:
+            return self.discard(node, node.values[0])
+
+        return node
+
+
+def remove_unused_locals(block):
+    """Remove declarations of and assignments to unused local variables"""
+
+    local_names = set()
+    for node in ir.walk(block):
+        if isinstance(node, ir.Local):
+            local_names.update(node.names)
+
+    # Removing an assignment may leave other variables unused
+    while True:
+        remover = UnusedLocalRemover(ir.name_reads(block), local_names)
+        block = remover.visit(block)
+        if not remover.changed:
+            return block
+
+
+#: Functions without side effects which return a single string or number
+SINGLE_VALUE_FUNCTIONS = set(['__ADD', '__TRUE', 'string.char',
+                              'string.format', 'string.len', 'string.lower',
+                              'string.rep', 'string.reverse', 'string.sub',
+                              'string.upper', 'table.concat', 'tonumber',
+                              'tostring', 'type'])
+
+#: Functions without side effects
+PURE_LIBRARY_FUNCTIONS = SINGLE_VALUE_FUNCTIONS | set(['string.gsub'])
+
+#: Calls which don't modify any tables visible to the script
+NON_MUTATING_FUNCTIONS = ('__PIPE_ADD', '__PIPE_GET', '__REPLY_BOOLEAN',
+                          '__REPLY_DICT', '__REPLY_LIST', '__REPLY_NUMBER',
+                          '__REPLY_STRING', '__RETVAL', 'cmsgpack.pack',
+                          'cmsgpack.unpack', 'ipairs', 'pairs')
+
+
+def library_function(func):
+    """Get the name of a library function (e.g. 'string.sub') or None"""
+
+    if isinstance(func, ir.Name):
+        return func.id
+    elif isinstance(func, ir.Index) and isinstance(func.obj, ir.Name) and \
+            isinstance(func.key, ir.Const) and isinstance(func.key.value, str):
+        return '%s.%s' % (func.obj.id, func.key.value)
+    else:
+        return None
+
+
+def root_name(expr):
+    """Get the variable at the base of a chain of indexes or None"""
+
+    while isinstance(expr, ir.Index):
+        expr = expr.obj
+    return expr.id if isinstance(expr, ir.Name) else None
+
+
+class HelperAnalysis(object):
+    """Find helper functions stored in `self` which have no side effects
+
+    A helper is pure if it only calls other pure functions and modifies
+    nothing except its own local variables and tables it creates. Pure
+    helpers which return a single number or string are also recorded
+    since their results can be shared without aliasing a table.
+    """
+
+    def __init__(self, block):
+        # Helpers may only be defined once to be analyzed
+        helpers = {}
+        assigned = collections.Counter()
+        for node in ir.walk(block):
+            if isinstance(node, ir.Assign):
+                for target, value in zip(node.targets, node.values):
+                    name = self.helper_name(target)
+                    if name is not None:
+                        assigned[name] += 1
+                        helpers[name] = value
+        helpers = dict((name, func) for name, func in helpers.items()
+                       if assigned[name] == 1 and
+                       isinstance(func, ir.Function))
+
+        # Find the variables each helper reads from enclosing scopes
+        self.free_names = {}
+        for name, func in helpers.items():
+            local_names = set(func.params)
+            for node in ir.walk(func.body):
+                if isinstance(node, ir.Local):
+                    local_names.update(node.names)
+            self.free_names[name] = \
+                set(ir.name_reads(func.body)) - local_names
+
+        # Helpers can call each other so repeat until nothing changes
+        self.pure = set()
+        self.scalar = set()
+        changed = True
+        while changed:
+            changed = False
+            for name, func in helpers.items():
+                if name not in self.pure and self.is_pure_function(func):
+                    self.pure.add(name)
+                    changed = True
+                if name in self.pure and name not in self.scalar and \
+                        self.returns_scalar(func):
+                    self.scalar.add(name)
+                    changed = True
+
+    @staticmethod
+    def helper_name(expr):
+        if isinstance(expr, ir.Index) and isinstance(expr.obj, ir.Name) and \
+                expr.obj.id == 'self' and isinstance(expr.key, ir.Const):
+            return expr.key.value
+        return None
+
+    def is_pure_call(self, call):
+        """Check if a call has no side effects"""
+
+        if isinstance(call, ir.RedisCall):
+            return False
+
+        if library_function(call.func) in PURE_LIBRARY_FUNCTIONS:
+            return True
+
+        return self.helper_name(call.func) in self.pure
+
+    def returns_single(self, call):
+        """Check if a call returns a single number, string, or boolean"""
+
+        if library_function(call.func) in SINGLE_VALUE_FUNCTIONS:
+            return True
+
+        return self.helper_name(call.func) in self.scalar
+
+    def is_fresh(self, expr):
+        """Check if an expression may create a new table or function"""
+
+        if isinstance(expr, (ir.Table, ir.Function, ir.Raw)):
+            return True
+        elif isinstance(expr, ir.BinOp) and expr.op in ('and', 'or'):
+            return self.is_fresh(expr.left) or self.is_fresh(expr.right)
+        elif isinstance(expr, ir.Paren):
+            if isinstance(expr.expr, ir.Call) and \
+                    library_function(expr.expr.func) == 'string.gsub':
+                return False
+            return self.is_fresh(expr.expr)
+        elif isinstance(expr, ir.Call):
+            return not self.returns_single(expr)
+
+        return False
+
+    def returns_scalar(self, func):
+        for node in ir.walk(func.body):
+            if isinstance(node, ir.Return) and (
+                    len(node.values) > 1 or
+                    any(self.is_fresh(value) or
+                        isinstance(value, (ir.Name, ir.Index))
+                        for value in node.values)):
+                return False
+
+        return True
+
+    def is_pure_function(self, func):
+        local_names = set(func.params)
+        for node in ir.walk(func.body):
+            if isinstance(node, ir.Local):
+                local_names.update(node.names)
+
+        # Tables created in the function can safely be modified
+        # as long as nothing else is assigned to the variable
+        fresh = set(name for name in local_names - set(func.params))
+        for node in ir.walk(func.body):
+            if isinstance(node, ir.Local):
+                for name, value in zip(node.names, node.values):
+                    if not isinstance(value, ir.Table):
+                        fresh.discard(name)
+            elif isinstance(node, ir.Assign):
+                for target, value in zip(node.targets, node.values):
+                    if isinstance(target, ir.Name) and \
+                            not isinstance(value, ir.Table):
+                        fresh.discard(target.id)
+
+        for node in ir.walk(func.body):
+            if isinstance(node, (ir.Raw, ir.RawStmt, ir.Function)):
+                return False
+            elif isinstance(node, ir.Assign):
+                for target in node.targets:
+                    if isinstance(target, ir.Name):
+                        if target.id not in local_names:
+                            return False
+                    elif root_name(target) not in fresh:
+                        return False
+            elif isinstance(node, ir.Call) and not self.is_pure_call(node):
+                if library_function(node.func) != 'table.insert' or \
+                        len(node.args) == 0 or \
+                        not isinstance(node.args[0], ir.Name) or \
+                        node.args[0].id not in fresh:
+                    return False
+
+        return True
+
+    def call_reads(self, call):
+        """Get the variables a call to a helper reads from outside it"""
+
+        return self.free_names.get(self.helper_name(call.func), set())
+
+
+class LoopInvariantHoister(ir.NodeTransformer):
+    """Move expressions which have the same value in every iteration of
+    a loop into local variables assigned before the loop
+
+    Only expressions without side effects which are always evaluated in
+    the first iteration are moved. Expressions which may raise an error
+    are only moved if nothing writes to Redis before them in the first
+    iteration, so a failing script still makes the same writes. Loops
+    which might not run at all are wrapped in a check so nothing is
+    evaluated in this case. Tables in `private` are never shared so
+    writes to them can't change any other table.
+    """
+
+    def __init__(self, helpers, private=(), count=0):
+        self.helpers = helpers
+        self.private = private
+        self.count = count
+
+    def visit_Block(self, node):
+        self.generic_visit(node)
+        for i, stmt in enumerate(node.body):
+            if isinstance(stmt, (ir.NumericFor, ir.GenericFor)):
+                prev = node.body[i - 1] if i > 0 else None
+                node.body[i] = self.hoist(stmt, prev)
+
+        return node
+
+    def loop_guard(self, loop):
+        """Get a condition for whether a loop runs at least once
+
+        This is None if the loop always runs and False if unknown.
+        """
+
+        if isinstance(loop, ir.NumericFor):
+            if not (isinstance(loop.step, ir.Const) and
+                    is_number(loop.step.value) and loop.step.value != 0):
+                return False
+            elif not (ir.is_pure(loop.start) and ir.is_pure(loop.stop)):
+                return False
+
+            op = '<=' if loop.step.value > 0 else '>='
+            guard = ConstantFolder().visit(
+                ir.BinOp(op, copy.deepcopy(loop.start),
+                         copy.deepcopy(loop.stop)))
+            if isinstance(guard, ir.Const):
+                return None if guard.value else False
+            return guard
+        elif len(loop.exprs) == 1 and isinstance(loop.exprs[0], ir.Call) and \
+                library_function(loop.exprs[0].func) == 'ipairs' and \
+                len(loop.exprs[0].args) == 1 and \
+                isinstance(loop.exprs[0].args[0], ir.Name):
+            values = loop.exprs[0].args[0]
+            return ir.BinOp('~=', ir.Index(copy.deepcopy(values),
+                                           ir.Const(1)), ir.Const(None))
+        else:
+            return False
+
+    def hoist(self, loop, prev):
+        guard = self.loop_guard(loop)
+        if guard is False:
+            return loop
+
+        # The break flag can't be set when the loop starts
+        flag = break_flag(prev)
+
+        # Find what the loop may change
+        self.written = set(ir.name_writes(loop.body))
+        self.written.update(loop.names if isinstance(loop, ir.GenericFor)
+                            else [loop.var])
+        self.mutated = set()
+        self.unknown_calls = False
+        for node in ir.walk(loop.body):
+            if isinstance(node, ir.Assign):
+                for target in node.targets:
+                    if not isinstance(target, ir.Name):
+                        self.mutated.add(root_name(target))
+            elif isinstance(node, ir.Call) and \
+                    not isinstance(node, ir.RedisCall) and \
+                    not self.helpers.is_pure_call(node):
+                name = library_function(node.func)
+                if name in ('table.insert', 'table.remove') and \
+                        len(node.args) > 0:
+                    self.mutated.add(root_name(node.args[0]))
+                elif name not in NON_MUTATING_FUNCTIONS and \
+                        name != 'redis.log':
+                    self.unknown_calls = True
+
+        # A table which may be shared could be read through another name
+        # (or through an index of another table) so writes to it have the
+        # same effect as an unknown call
+        if not self.mutated.issubset(self.private):
+            self.unknown_calls = True
+
+        hoisted = collections.OrderedDict()
+        self.after_write = False
+        for expr in always_evaluated(loop.body, flag):
+            self.find_invariants(expr, hoisted)
+        if len(hoisted) == 0:
+            return loop
+
+        loop.body = HoistedReplacer(hoisted).visit(loop.body)
+        body = ir.Block([ir.Local([name], [expr])
+                         for name, expr in hoisted.values()] + [loop])
+        if guard is None:
+            return ir.Do(body)
+        else:
+            return ir.If(guard, body)
+
+    def find_invariants(self, expr, hoisted):
+        """Record the largest invariant expressions within an expression
+
+        Parts of the expression are visited in the order they are
+        evaluated to track if anything may have written to Redis.
+        """
+
+        if expr is None or isinstance(expr, (ir.Name, ir.Const)):
+            return
+        elif self.is_invariant(expr) and \
+                not (self.after_write and may_raise(expr)):
+            key = expr.render()
+            if key not in hoisted:
+                self.count += 1
+                hoisted[key] = ('__INVARIANT%d' % self.count,
+                                copy.deepcopy(expr))
+            return
+
+        # Only the left side of a logical operator is always evaluated
+        if isinstance(expr, ir.BinOp) and expr.op in ('and', 'or'):
+            self.find_invariants(expr.left, hoisted)
+        elif isinstance(expr, ir.Call):
+            # Functions being called are left for other passes
+            if self.may_write(expr.func):
+                self.after_write = True
+            for arg in expr.args:
+                self.find_invariants(arg, hoisted)
+        elif not isinstance(expr, ir.Function):
+            for child in ir.iter_child_nodes(expr):
+                if isinstance(child, ir.Pair):
+                    self.find_invariants(child.key, hoisted)
+                    self.find_invariants(child.value, hoisted)
+                else:
+                    self.find_invariants(child, hoisted)
+
+        if self.may_write(expr):
+            self.after_write = True
+
+    def may_write(self, expr):
+        """Check if an expression may write to Redis"""
+
+        for node in ir.walk(expr):
+            if isinstance(node, ir.Raw):
+                return True
+            elif isinstance(node, ir.RedisCall):
+                if node.command not in commands.READ_COMMANDS:
+                    return True
+            elif isinstance(node, ir.Call) and \
+                    not self.helpers.is_pure_call(node) and \
+                    library_function(node.func) not in \
+                    NON_MUTATING_FUNCTIONS + ('table.insert', 'table.remove'):
+                return True
+
+        return False
+
+    def is_invariant(self, expr):
+        """Check if an expression has the same value in every iteration"""
+
+        if self.helpers.is_fresh(expr):
+            return False
+
+        reads = set()
+        for node in ir.walk(expr):
+            if isinstance(node, (ir.Raw, ir.Function)):
+                return False
+            elif isinstance(node, ir.Call):
+                if not self.helpers.is_pure_call(node):
+                    return False
+                reads.update(self.helpers.call_reads(node))
+            elif isinstance(node, ir.Name):
+                reads.add(node.id)
+
+            # Anything reading a table may see the effects of unknown calls
+            if self.unknown_calls and (
+                    isinstance(node, (ir.Index, ir.Call)) or
+                    (isinstance(node, ir.UnOp) and node.op == '#')):
+                return False
+
+        return reads.isdisjoint(self.written) and \
+            reads.isdisjoint(self.mutated)
+
+
+class HoistedReplacer(ir.NodeTransformer):
+    """Replace hoisted expressions with the variables holding them"""
+
+    def __init__(self, hoisted):
+        self.hoisted = hoisted
+
+    def visit(self, node):
+        if isinstance(node, ir.Expr) and \
+                not isinstance(node, (ir.Name, ir.Const)):
+            hoisted = self.hoisted.get(node.render())
+            if hoisted is not None:
+                return ir.Name(hoisted[0])
+
+        return super(HoistedReplacer, self).visit(node)
+
+
+def break_flag(stmt):
+    """Get the name of the break flag declared by the statement before
+    a loop or None"""
+
+    if isinstance(stmt, ir.Local) and len(stmt.names) == 1 and \
+            len(stmt.values) == 1 and \
+            isinstance(stmt.values[0], ir.Const) and \
+            stmt.values[0].value is False:
+        return stmt.names[0]
+    return None
+
+
+def always_evaluated(block, flag):
+    """Yield expressions always evaluated when a block runs
+
+    This stops after statements which may exit the block early. If
+    the block ends early, the last value yielded is None.
+    """
+
+    for stmt in block.body:
+        # Checks of the break flag can't succeed in the first iteration
+        # (the flag is replaced by false if the loop never breaks)
+        if isinstance(stmt, ir.If) and (
+                (isinstance(stmt.test, ir.Name) and stmt.test.id == flag) or
+                (isinstance(stmt.test, ir.Const) and
+                 not truthy(stmt.test.value))):
+            continue
+        elif isinstance(stmt, (ir.Do, ir.Repeat)):
+            for expr in always_evaluated(stmt.body, None):
+                if expr is None:
+                    yield None
+                    return
+                yield expr
+            continue
+
+        for field in stmt._fields:
+            value = getattr(stmt, field)
+            for child in (value if isinstance(value, list) else [value]):
+                if isinstance(child, ir.Expr):
+                    yield child
+
+        if may_exit(stmt):
+            yield None
+            return
+
+
+def may_exit(node):
+    """Check if a statement may leave the enclosing block early"""
+
+    if isinstance(node, (ir.Return, ir.Break)):
+        return True
+    elif isinstance(node, (ir.NumericFor, ir.GenericFor, ir.While,
+                           ir.Repeat)):
+        # Breaks in nested loops only exit those loops
+        return any(isinstance(child, ir.Return)
+                   for child in ir.walk(node.body))
+
+    return any(may_exit(child) for child in ir.iter_child_nodes(node)
+               if isinstance(child, (ir.Stmt, ir.Block)))
+
+
+#: Operators which never raise errors whatever their operands are
+SAFE_OPERATORS = ('==', '~=', 'and', 'or', 'not')
+
+#: Nodes which never raise errors themselves
+SAFE_NODES = (ir.Assign, ir.Block, ir.Const, ir.Do, ir.Function, ir.If,
+              ir.Local, ir.Name, ir.Pair, ir.Paren, ir.Table)
+
+
+def may_raise(node):
+    """Check if code may raise an error
+
+    This is conservative so calls other than to pure functions, indexes
+    and arithmetic are all assumed to fail.
+    """
+
+    for child in ir.walk(node):
+        if isinstance(child, (ir.BinOp, ir.UnOp)):
+            if child.op not in SAFE_OPERATORS:
+                return True
+        elif isinstance(child, ir.RedisCall):
+            return True
+        elif isinstance(child, ir.Call):
+            if not (isinstance(child.func, ir.Name) and
+                    child.func.id in ir.PURE_FUNCTIONS):
+                return True
+        elif not isinstance(child, SAFE_NODES):
+            return True
+
+    return False
+
+
+def hoist_invariants(block):
+    """Move loop invariant expressions out of loops"""
+
+    # Avoid reusing the names of variables from earlier runs
+    count = max([int(name[len('__INVARIANT'):])
+                 for name in ir.name_writes(block)
+                 if re.match(r'^__INVARIANT[0-9]+$', name)] + [0])
+
+    hoister = LoopInvariantHoister(HelperAnalysis(block),
+                                   private_tables(block), count)
+    return hoister.visit(block)
+
+
+def key_affixes(expr):
+    """Get the constant prefix and suffix of a key expression and whether
+    the key is exactly this constant"""
+
+    if isinstance(expr, ir.Const):
+        value = expr.value
+        if isinstance(value, str):
+            return value, value, True
+        elif isinstance(value, (int, long)) and \
+                not isinstance(value, bool) and abs(value) < 10 ** 14:
+            return str(value), str(value), True
+    elif isinstance(expr, ir.BinOp) and expr.op == '..':
+        left_prefix, left_suffix, left_exact = key_affixes(expr.left)
+        right_prefix, right_suffix, right_exact = key_affixes(expr.right)
+        prefix = left_prefix + right_prefix if left_exact else left_prefix
+        suffix = left_suffix + right_suffix if right_exact else right_suffix
+        return prefix, suffix, left_exact and right_exact
+
+    return '', '', False
+
+
+def keys_may_alias(key1, key2):
+    """Check if two key expressions may evaluate to the same key
+
+    Keys are only known to differ if they are different constants or
+    start or end with different constant strings (e.g. 'user:' .. id
+    and 'post:' .. id).
+    """
+
+    prefix1, suffix1, exact1 = key_affixes(key1)
+    prefix2, suffix2, exact2 = key_affixes(key2)
+    if exact1 and exact2:
+        return prefix1 == prefix2
+
+    return (prefix1.startswith(prefix2) or prefix2.startswith(prefix1)) and \
+        (suffix1.endswith(suffix2) or suffix2.endswith(suffix1))
+
+
+#: A read whose result is available in a variable
+ReadEntry = collections.namedtuple('ReadEntry',
+                                   ['name', 'reads', 'keys', 'indexed'])
+
+
+class ReadReplacer(ir.NodeTransformer):
+    """Replace Redis reads with the variables holding their results"""
+
+    def __init__(self, available, skip=()):
+        self.available = available
+        self.skip = skip
+
+    def visit_Function(self, node):
+        # Functions may be called after the values change
+        return node
+
+    def visit_RedisCall(self, node):
+        self.generic_visit(node)
+        entry = self.available.get(node.render())
+        if entry is None or any(node is skip for skip in self.skip):
+            return node
+        return ir.Name(entry.name)
+
+
+class NodeReplacer(ir.NodeTransformer):
+    """Replace a single node with another"""
+
+    def __init__(self, old, new):
+        self.old = old
+        self.new = new
+
+    def visit(self, node):
+        if node is self.old:
+            return self.new
+        return super(NodeReplacer, self).visit(node)
+
+
+class EffectAnalysis(object):
+    """Find which keys code may write to using helpers found in a block"""
+
+    def __init__(self, block):
+        self.helpers = HelperAnalysis(block)
+
+    def is_known_call(self, call):
+        """Check if a call can only read keys and modify new tables"""
+
+        name = library_function(call.func)
+        return self.helpers.is_pure_call(call) or \
+            name in NON_MUTATING_FUNCTIONS or name == 'redis.log' or \
+            (isinstance(call.func, ir.Paren) and
+             isinstance(call.func.expr, ir.Function))
+
+    def effects(self, nodes):
+        """Find the keys written by code and whether it modifies tables
+
+        The keys are None if the code may write to any key.
+        """
+
+        keys = []
+        mutates = False
+        for node in nodes:
+            for child in ir.walk(node):
+                if isinstance(child, (ir.Raw, ir.RawStmt)):
+                    return None, True
+                elif isinstance(child, ir.RedisCall):
+                    written = commands.written_keys(child.command, child.args)
+                    if written is None:
+                        return None, True
+                    keys.extend(written)
+                elif isinstance(child, ir.Call):
+                    name = library_function(child.func)
+                    if name in ('table.insert', 'table.remove'):
+                        mutates = True
+                    elif not self.is_known_call(child):
+                        return None, True
+                elif isinstance(child, ir.Assign) and \
+                        any(not isinstance(target, ir.Name)
+                            for target in child.targets):
+                    mutates = True
+
+        return keys, mutates
+
+    def mutated_tables(self, nodes):
+        """Find the variables holding tables which code modifies (with
+        None for tables which aren't held by a variable)"""
+
+        tables = set()
+        for node in nodes:
+            for child in ir.walk(node):
+                if isinstance(child, ir.Call) and \
+                        library_function(child.func) in ('table.insert',
+                                                         'table.remove') \
+                        and len(child.args) > 0:
+                    tables.add(root_name(child.args[0]))
+                elif isinstance(child, ir.Assign):
+                    tables.update(root_name(target)
+                                  for target in child.targets
+                                  if not isinstance(target, ir.Name))
+
+        return tables
+
+    def accessed_keys(self, nodes):
+        """Find the keys read or written by code or None if unknown"""
+
+        keys, _ = self.effects(nodes)
+        if keys is None:
+            return None
+
+        for node in nodes:
+            for child in ir.walk(node):
+                if isinstance(child, ir.RedisCall):
+                    read = commands.read_keys(child.command, child.args)
+                    if read is None:
+                        return None
+                    keys.extend(read)
+
+        return keys
+
+
+def unconditional_redis_calls(expr):
+    """Yield the Redis calls always evaluated with an expression"""
+
+    if isinstance(expr, ir.Function):
+        return
+    elif isinstance(expr, ir.BinOp) and expr.op in ('and', 'or'):
+        children = [expr.left]
+    else:
+        children = ir.iter_child_nodes(expr)
+
+    for child in children:
+        for call in unconditional_redis_calls(child):
+            yield call
+
+    if isinstance(expr, ir.RedisCall):
+        yield expr
+
+
+class RepeatedReadEliminator(EffectAnalysis):
+    """Reuse the results of Redis reads which are repeated on the same key
+
+    Scripts run atomically so reading a key again gives the same result
+    unless the script wrote to it in between. Reads are only reused when
+    no command in between may write to any key the read uses and none of
+    the variables or tables used to build the key may have changed. Keys
+    which are not known to differ are assumed to be the same. Reads which
+    reply with a table are only shared if the script never modifies a
+    table which may hold a reply.
+    """
+
+    def __init__(self, block, count=0):
+        super(RepeatedReadEliminator, self).__init__(block)
+        self.writes = ir.name_writes(block)
+        self.count = count
+        self.extracted = []
+
+        # Variables declared without a value before they are assigned
+        self.declared = set()
+        for node in ir.walk(block):
+            if isinstance(node, ir.Local) and not node.values:
+                self.declared.update(node.names)
+
+        self.share_tables = not self.mutates_replies(block)
+
+    def mutates_replies(self, block):
+        """Check if code may modify a table replied by Redis"""
+
+        for node in ir.walk(block):
+            if isinstance(node, ir.Assign):
+                for target in node.targets:
+                    # Attributes of self and dictionary flags
+                    # are only set on tables which are not replies
+                    if isinstance(target, ir.Index) and \
+                            isinstance(target.key, ir.Const) and \
+                            (target.key.value == '__DICT' or
+                             (isinstance(target.obj, ir.Name) and
+                              target.obj.id == 'self')):
+                        continue
+                    elif not isinstance(target, ir.Name):
+                        return True
+            elif isinstance(node, ir.Call) and \
+                    not isinstance(node, ir.RedisCall) and \
+                    not self.is_known_call(node):
+                return True
+
+        return False
+
+    def invalidate(self, available, nodes, names=None):
+        """Forget reads whose results may be changed by code which
+        assigns to the given variables (by default, any it assigns)"""
+
+        keys, mutates = self.effects(nodes)
+        if keys is None:
+            available.clear()
+            return
+
+        if names is None:
+            names = set()
+            for node in nodes:
+                names.update(ir.name_writes(node))
+
+        for key, entry in available.items():
+            if entry.reads & names or (mutates and entry.indexed) or \
+                    any(keys_may_alias(written, read)
+                        for written in keys for read in entry.keys):
+                del available[key]
+
+    def is_candidate(self, call):
+        """Check if a call is a read whose result can be reused"""
+
+        return call.command in commands.REPEATABLE_COMMANDS and \
+            all(ir.is_pure(arg) for arg in call.args) and \
+            (self.share_tables or
+             call.command not in commands.LIST_REPLY_COMMANDS)
+
+    def holder(self, stmt, call):
+        """Get the variable a statement stores the result of a call in
+        if it is never assigned anything else or None"""
+
+        if isinstance(stmt, ir.Local) and len(stmt.names) == 1 and \
+                len(stmt.values) == 1 and stmt.values[0] is call and \
+                self.writes[stmt.names[0]] == 1:
+            return stmt.names[0]
+        elif isinstance(stmt, ir.Assign) and len(stmt.targets) == 1 and \
+                len(stmt.values) == 1 and stmt.values[0] is call and \
+                isinstance(stmt.targets[0], ir.Name) and \
+                stmt.targets[0].id in self.declared and \
+                self.writes[stmt.targets[0].id] == 2:
+            return stmt.targets[0].id
+
+        return None
+
+    def replace(self, stmt, fields, replacer):
+        for field in fields:
+            value = getattr(stmt, field)
+            if isinstance(value, list):
+                value[:] = [replacer.visit(item) for item in value]
+            else:
+                setattr(stmt, field, replacer.visit(value))
+
+    def process(self, stmt, fields, available, extract=True):
+        """Reuse reads in the expressions of a statement which are
+        evaluated once and record the reads they make
+
+        This returns any statements which must be added before.
+        """
+
+        exprs = []
+        for field in fields:
+            value = getattr(stmt, field)
+            exprs.extend(value if isinstance(value, list) else [value])
+
+        # Variables assigned by simple statements are not in expressions
+        written = set()
+        for node in exprs + ([stmt] if fields == stmt._fields else []):
+            written.update(ir.name_writes(node))
+
+        # Only reads which stay valid for the whole statement are reused
+        self.invalidate(available, exprs, written)
+        self.replace(stmt, fields, ReadReplacer(available))
+
+        keys, mutates = self.effects(exprs)
+        if not extract or keys is None or keys or mutates:
+            return []
+
+        code = []
+        new_calls = []
+        for expr in exprs:
+            for call in unconditional_redis_calls(expr):
+                key = call.render()
+                reads = set(name for name, count
+                            in ir.name_reads(call).items() if count > 0)
+                if key in available or not self.is_candidate(call) or \
+                        reads & written or \
+                        (isinstance(stmt, ir.CallStmt) and
+                         stmt.call is call):
+                    continue
+
+                name = self.holder(stmt, call)
+                if name is None:
+                    # Store the result in a new variable before the statement
+                    self.count += 1
+                    name = '__READ%d' % self.count
+                    local = ir.Local([name], [call])
+                    self.replace(stmt, fields,
+                                 NodeReplacer(call, ir.Name(name)))
+                    self.extracted.append((local, stmt))
+                    code.append(local)
+                else:
+                    new_calls.append(call)
+
+                available[key] = ReadEntry(
+                    name, reads, commands.read_keys(call.command, call.args),
+                    any(isinstance(node, ir.Index) or
+                        (isinstance(node, ir.UnOp) and node.op == '#')
+                        for node in ir.walk(call)))
+
+        # Later reads in the same statement can use the new variables
+        self.replace(stmt, fields, ReadReplacer(available, new_calls))
+
+        return code
+
+    def visit_block(self, block, available):
+        body = []
+        for stmt in block.body:
+            if isinstance(stmt, (ir.Local, ir.Assign, ir.CallStmt,
+                                 ir.Return)):
+                body.extend(self.process(stmt, stmt._fields, available))
+
+                # Repeating a read without using the result does nothing
+                if isinstance(stmt, ir.CallStmt) and \
+                        isinstance(stmt.call, ir.Name):
+                    continue
+            elif isinstance(stmt, ir.If):
+                body.extend(self.process(stmt, ('test',), available))
+                self.invalidate(available, [stmt])
+                self.visit_block(stmt.body, available.copy())
+                self.visit_block(stmt.orelse, available.copy())
+            elif isinstance(stmt, (ir.NumericFor, ir.GenericFor)):
+                fields = [field for field in stmt._fields if field != 'body']
+                body.extend(self.process(stmt, fields, available))
+
+                # Later iterations see writes from earlier ones
+                self.invalidate(available, [stmt])
+                self.visit_block(stmt.body, available.copy())
+            elif isinstance(stmt, ir.While):
+                self.invalidate(available, [stmt])
+                self.process(stmt, ('test',), available, extract=False)
+                self.visit_block(stmt.body, available.copy())
+            elif isinstance(stmt, (ir.Repeat, ir.Do)):
+                self.invalidate(available, [stmt])
+                self.visit_block(stmt.body, available.copy())
+            elif not isinstance(stmt, ir.Break):
+                available.clear()
+
+            body.append(stmt)
+
+        block.body[:] = body
+        return block
+
+    def run(self, block):
+        # Functions may be called anywhere so nothing is known on entry
+        functions = [node for node in ir.walk(block)
+                     if isinstance(node, ir.Function)]
+        self.visit_block(block, collections.OrderedDict())
+        for func in functions:
+            self.visit_block(func.body, collections.OrderedDict())
+
+        # Put back reads stored in variables which were never reused
+        reads = ir.name_reads(block)
+        for local, stmt in self.extracted:
+            name = local.names[0]
+            if reads[name] == 1:
+                local.names = []
+                self.replace(stmt, stmt._fields,
+                             NameReplacer(name, local.values[0]))
+
+        return RemovedLocalFilter().visit(block)
+
+
+class RemovedLocalFilter(ir.NodeTransformer):
+    """Drop declarations which no longer have any names"""
+
+    def visit_Local(self, node):
+        # Functions assigned to locals may also contain declarations
+        node = self.generic_visit(node)
+        return node if node.names else None
+
+
+def eliminate_repeated_reads(block):
+    """Reuse the results of repeated Redis reads with no write between"""
+
+    # Avoid reusing the names of variables from earlier runs
+    count = max([int(name[len('__READ'):])
+                 for name in ir.name_writes(block)
+                 if re.match(r'^__READ[0-9]+$', name)] + [0])
+
+    return RepeatedReadEliminator(block, count).run(block)
+
+
+#: Reads of a single key and the commands which read many at once
+BATCHED_COMMANDS = {'get': 'mget', 'hget': 'hmget'}
+
+
+class ReadBatcher(EffectAnalysis):
+    """Replace reads made in each iteration of a loop with a single
+    command which reads all the values before the loop starts
+
+    Loops over lists of keys reading each with GET use MGET and loops
+    reading fields of the same hash with HGET use HMGET. Values are
+    read in chunks to avoid exceeding the limits of Lua's unpack. Reads
+    are only batched when they happen in every iteration, the loop makes
+    no writes, and the values used to build each key do not change.
+    Keys missing from the reply to MGET are read again with GET so a key
+    holding another type still raises an error.
+    """
+
+    def __init__(self, block, count=0):
+        super(ReadBatcher, self).__init__(block)
+        self.private = private_tables(block)
+        self.count = count
+
+    def visit(self, block):
+        for node in list(ir.walk(block)):
+            if isinstance(node, ir.Block):
+                self.visit_Block(node)
+
+        return block
+
+    def visit_Block(self, node):
+        body = []
+        for stmt in node.body:
+            if isinstance(stmt, ir.GenericFor):
+                # The break flag must stay directly before the loop
+                flag = break_flag(body[-1]) if body else None
+                if flag is not None:
+                    prev = body.pop()
+
+                body.extend(self.batch(stmt, flag))
+                if flag is not None:
+                    body.append(prev)
+
+            body.append(stmt)
+
+        node.body[:] = body
+
+    def batch(self, loop, flag):
+        """Rewrite the reads in a loop and produce the code to read
+        their values in batches before the loop"""
+
+        if len(loop.names) != 2 or len(loop.exprs) != 1 or \
+                not isinstance(loop.exprs[0], ir.Call) or \
+                library_function(loop.exprs[0].func) != 'ipairs' or \
+                len(loop.exprs[0].args) != 1 or \
+                not isinstance(loop.exprs[0].args[0], ir.Name):
+            return []
+
+        # Only loops with no writes always read the same values
+        keys, mutates = self.effects([loop.body])
+        if keys is None or keys:
+            return []
+
+        # Tables which may be shared could be the list under another name
+        values = loop.exprs[0].args[0]
+        index, var = loop.names
+        written = set(ir.name_writes(loop.body))
+        if values.id in written or \
+                (index != '_' and index in written) or \
+                (mutates and not self.mutated_tables([loop.body])
+                 .issubset(self.private)) or \
+                (mutates and any(root_name(node) == values.id
+                                 for node in ir.walk(loop.body)
+                                 if isinstance(node, ir.Index))):
+            return []
+
+        # Find reads in every iteration whose keys depend only on the
+        # loop variable and variables which are not changed by the loop
+        calls = collections.OrderedDict()
+        for expr in always_evaluated(loop.body, flag):
+            if expr is None:
+                break
+
+            for call in unconditional_redis_calls(expr):
+                batch_args = self.batch_args(call, var, written, mutates)
+                if batch_args is not None:
+                    calls.setdefault(call.render(), (batch_args, []))[1] \
+                        .append(call)
+
+        if len(calls) == 0:
+            return []
+
+        if index == '_':
+            self.count += 1
+            index = '__BATCH_INDEX%d' % self.count
+            loop.names[0] = index
+
+        code = []
+        for (command, key, arg), batch_calls in calls.values():
+            self.count += 1
+            batch = ir.Name('__BATCH%d' % self.count)
+            code.append(ir.Local([batch.id], [ir.Table()]))
+            code.append(ir.GenericFor(
+                [index, var], copy.deepcopy(loop.exprs),
+                ir.Block([ir.Assign([ir.Index(copy.deepcopy(batch),
+                                              ir.Name(index))], [arg])])))
+            code.append(ir.Assign([copy.deepcopy(batch)], [
+                ir.Call('__BATCH_READ', [ir.Const(command), key,
+                                         copy.deepcopy(batch)])]))
+
+            for call in batch_calls:
+                loop.body = NodeReplacer(call, ir.Index(
+                    copy.deepcopy(batch), ir.Name(index))).visit(loop.body)
+
+        return code
+
+    def batch_args(self, call, var, written, mutates):
+        """Get the batched command, the fixed key, and the value which
+        changes in each iteration for a read or None"""
+
+        if call.command not in BATCHED_COMMANDS or \
+                not all(ir.is_pure(arg) for arg in call.args):
+            return None
+
+        for arg in call.args:
+            reads = set(name for name, count in ir.name_reads(arg).items()
+                        if count > 0)
+            if reads & written or \
+                    (mutates and any(isinstance(node, (ir.Index, ir.UnOp))
+                                     for node in ir.walk(arg))):
+                return None
+
+        def varies(arg):
+            return ir.name_reads(arg)[var] > 0
+
+        if call.command == 'get' and len(call.args) == 1 and \
+                varies(call.args[0]):
+            return 'mget', ir.Const(None), copy.deepcopy(call.args[0])
+        elif call.command == 'hget' and len(call.args) == 2 and \
+                not varies(call.args[0]) and varies(call.args[1]):
+            # The hash is the same in every iteration
+            return 'hmget', copy.deepcopy(call.args[0]), \
+                copy.deepcopy(call.args[1])
+
+        return None
+
+
+def batch_reads(block):
+    """Read keys used in every iteration of a loop with one command"""
+
+    # Avoid reusing the names of variables from earlier runs
+    count = max([int(re.sub(r'[^0-9]', '', name))
+                 for name in ir.name_writes(block)
+                 if re.match(r'^__BATCH(_INDEX)?[0-9]+$', name)] + [0])
+
+    batcher = ReadBatcher(block, count)
+    block = batcher.visit(block)
+
+    # Define the function used to read values after the header if needed
+    if batcher.count > count and \
+            not any(isinstance(stmt, ir.RawStmt) and
+                    stmt.code == BATCHED_READ_CODE for stmt in block.body):
+        start = 0
+        while start < len(block.body) and \
+                isinstance(block.body[start], ir.RawStmt):
+            start += 1
+        block.body.insert(start, ir.RawStmt(BATCHED_READ_CODE))
+
+    return block
+
+
+def variadic_command(command):
+    """Get the command used to write repeated arguments"""
+
+    return commands.VARIADIC_EQUIVALENTS.get(command, command)
+
+
+class WriteCoalescer(EffectAnalysis):
+    """Merge writes of the same command to the same key into one call
+    with all the arguments (e.g. SADD with many members)
+
+    Only writes whose replies are not used are merged. A later write is
+    moved up to an earlier one as long as nothing in between may raise
+    an error (so a failing script makes the same writes), uses the keys
+    it writes or changes the values of its arguments.
+    """
+
+    def __init__(self, block):
+        super(WriteCoalescer, self).__init__(block)
+
+        # Pipelines whose results are never used
+        used = set()
+        unused = set()
+        for node in ir.walk(block):
+            if isinstance(node, ir.Call) and \
+                    library_function(node.func) == '__PIPE_GET':
+                used.add(node.args[0].render())
+            elif isinstance(node, ir.CallStmt) and \
+                    isinstance(node.call, ir.Call) and \
+                    library_function(node.call.func) == '__PIPE_GET':
+                unused.add(node.call.args[0].render())
+        self.unused_pipelines = unused - used
+
+        # Calls with arguments merged from other writes
+        self.merged = set()
+
+    def write(self, stmt):
+        """Get the call made by a write which can be merged or None"""
+
+        if not isinstance(stmt, ir.CallStmt):
+            return None
+
+        call = stmt.call
+        if isinstance(call, ir.Call) and \
+                library_function(call.func) == '__PIPE_ADD' and \
+                len(call.args) == 2 and \
+                call.args[0].render() in self.unused_pipelines:
+            call = call.args[1]
+
+        if not isinstance(call, ir.RedisCall) or \
+                call.command not in commands.VARIADIC_WRITE_COMMANDS:
+            return None
+
+        fixed, group = commands.VARIADIC_WRITE_COMMANDS[call.command]
+        if len(call.args) <= fixed or (len(call.args) - fixed) % group:
+            return None
+
+        # Avoid writes which may contain options
+        if group > 1 and len(call.args) != fixed + group and \
+                call not in self.merged:
+            return None
+
+        return call
+
+    def can_merge(self, first, second, between):
+        """Check if a write can be moved up to be merged with another"""
+
+        fixed, _ = commands.VARIADIC_WRITE_COMMANDS[first.command]
+        if variadic_command(second.command) != \
+                variadic_command(first.command) or \
+                any(arg1.render() != arg2.render() for arg1, arg2
+                    in zip(first.args[:fixed], second.args[:fixed])) or \
+                not all(ir.is_pure(arg) for arg in second.args):
+            return False
+
+        # Arguments are now evaluated earlier
+        keys, mutates = self.effects(between)
+        names = set()
+        for stmt in between:
+            names.update(ir.name_writes(stmt))
+        for arg in second.args:
+            if any(ir.name_reads(arg)[name] > 0 for name in names) or \
+                    (mutates and any(isinstance(node, (ir.Index, ir.UnOp))
+                                     for node in ir.walk(arg))):
+                return False
+
+        # Nothing in between may see the value written
+        accessed = self.accessed_keys(between)
+        if accessed is None:
+            return False
+        written = commands.written_keys(second.command, second.args)
+        return not any(keys_may_alias(key1, key2)
+                       for key1 in accessed for key2 in written)
+
+    def visit(self, block):
+        for node in list(ir.walk(block)):
+            if isinstance(node, ir.Block):
+                self.visit_Block(node)
+
+        return block
+
+    def visit_Block(self, node):
+        body = []
+        for stmt in node.body:
+            body.append(stmt)
+            second = self.write(stmt)
+            if second is None:
+                continue
+
+            # Find the closest earlier write this can be merged with
+            for i in range(len(body) - 2, -1, -1):
+                if may_exit(body[i]) or self.accessed_keys([body[i]]) is None:
+                    break
+
+                first = self.write(body[i])
+                if first is not None and \
+                        self.can_merge(first, second, body[i + 1:-1]):
+                    fixed, _ = commands.VARIADIC_WRITE_COMMANDS[
+                        first.command]
+                    first.command = variadic_command(first.command)
+                    first.args.extend(second.args[fixed:])
+                    self.merged.add(first)
+                    body.pop()
+                    break
+
+                # The write would be made even if this fails
+                if may_raise(body[i]):
+                    break
+
+        node.body[:] = body
+
+
+def coalesce_writes(block):
+    """Merge repeated writes to the same key into a single command"""
+
+    return WriteCoalescer(block).visit(block)
+
+
+#: Loops whose bodies may run many times
+LOOP_NODES = (ir.NumericFor, ir.GenericFor, ir.While, ir.Repeat)
+
+#: Library tables whose functions are cached in local variables
+LOCALIZED_LIBRARIES = ('cmsgpack', 'math', 'redis', 'string', 'table')
+
+#: Global functions which are cached in local variables
+LOCALIZED_FUNCTIONS = ('ipairs', 'pairs', 'tonumber', 'tostring', 'type',
+                       'unpack')
+
+#: Functions which are passed tables without keeping references to them
+TABLE_READING_FUNCTIONS = ('__REPLY_DICT', '__REPLY_LIST', '__RETVAL',
+                           '__STREAM', 'cmsgpack.pack', 'ipairs',
+                           'table.concat', 'unpack')
+
+
+def concat_operands(expr):
+    """Get the list of values joined by a chain of concatenations"""
+
+    if isinstance(expr, ir.BinOp) and expr.op == '..':
+        return concat_operands(expr.left) + concat_operands(expr.right)
+    else:
+        return [expr]
+
+
+class ConcatFlattener(ir.NodeTransformer):
+    """Rewrite concatenations nested to the left such as (a .. b) .. c
+    as a single chain which Lua joins without intermediate strings"""
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        if node.op != '..':
+            return node
+
+        operands = concat_operands(node)
+        expr = operands.pop()
+        while operands:
+            expr = ir.BinOp('..', operands.pop(), expr)
+        return expr
+
+
+def never_nil(expr):
+    """Check if an expression always has a value other than nil"""
+
+    if isinstance(expr, ir.Const):
+        return expr.value is not None
+    elif isinstance(expr, (ir.Table, ir.Function, ir.RedisCall, ir.UnOp)):
+        return True
+    elif isinstance(expr, ir.BinOp):
+        if expr.op == 'and':
+            return never_nil(expr.left) and never_nil(expr.right)
+        elif expr.op == 'or':
+            return never_nil(expr.right)
+        else:
+            return True
+    elif isinstance(expr, ir.Paren):
+        return never_nil(expr.expr)
+    elif isinstance(expr, ir.Call):
+        return library_function(expr.func) in \
+            SINGLE_VALUE_FUNCTIONS - set(['tonumber'])
+    else:
+        return False
+
+
+def modifies_tables(expr):
+    """Check if evaluating an expression may modify a Lua table"""
+
+    for node in ir.walk(expr):
+        if isinstance(node, (ir.Raw, ir.Function)) or \
+                (isinstance(node, ir.Call) and
+                 not isinstance(node, ir.RedisCall) and
+                 library_function(node.func) not in PURE_LIBRARY_FUNCTIONS and
+                 not ir.is_pure(node)):
+            return True
+
+    return False
+
+
+def appended_value(stmt, name=None):
+    """Get the value added to the end of a table by a statement (and
+    optionally only for the given table) or None"""
+
+    if isinstance(stmt, ir.CallStmt) and isinstance(stmt.call, ir.Call) and \
+            library_function(stmt.call.func) == 'table.insert' and \
+            len(stmt.call.args) == 2 and \
+            not modifies_tables(stmt.call.args[1]) and \
+            (name is None or (isinstance(stmt.call.args[0], ir.Name) and
+                              stmt.call.args[0].id == name)):
+        return stmt.call.args[1]
+    else:
+        return None
+
+
+def walk_parents(node):
+    """Yield each node contained in a node along with its parent"""
+
+    todo = collections.deque([(node, None)])
+    while todo:
+        node, parent = todo.popleft()
+        todo.extend((child, node) for child in ir.iter_child_nodes(node))
+        yield node, parent
+
+
+def contained_use(parent, name):
+    """Check if a use of a table variable can't make the table visible
+    through another variable"""
+
+    if isinstance(parent, ir.Index):
+        return parent.obj is name
+    elif isinstance(parent, ir.UnOp):
+        return parent.op == '#'
+    elif isinstance(parent, ir.Assign):
+        return any(target is name for target in parent.targets)
+    elif isinstance(parent, ir.Call):
+        func = library_function(parent.func)
+        if func == 'table.insert':
+            return parent.args[0] is name and \
+                not any(arg is name for arg in parent.args[1:])
+        return func in TABLE_READING_FUNCTIONS
+    else:
+        return False
+
+
+def private_tables(block):
+    """Find variables which only hold tables created by the script which
+    are never shared with other variables or functions"""
+
+    tables = collections.Counter()
+    for node in ir.walk(block):
+        if isinstance(node, ir.Local):
+            if len(node.values) == 0:
+                tables.update(node.names)
+            else:
+                tables.update(name for name, value
+                              in zip(node.names, node.values)
+                              if isinstance(value, ir.Table))
+        elif isinstance(node, ir.Assign):
+            tables.update(target.id for target, value
+                          in zip(node.targets, node.values)
+                          if isinstance(target, ir.Name) and
+                          isinstance(value, ir.Table))
+
+    writes = ir.name_writes(block)
+    private = set(name for name, count in tables.items()
+                  if writes[name] == count)
+
+    parents = dict((id(node), parent) for node, parent in walk_parents(block))
+    for node in ir.walk(block):
+        if not isinstance(node, ir.Name) or node.id not in private:
+            continue
+
+        # Tables may be nested in values passed to functions which
+        # only read them (e.g. when returning several values)
+        use = node
+        parent = parents[id(node)]
+        while isinstance(parent, (ir.Table, ir.Pair)):
+            use = parent
+            parent = parents[id(parent)]
+
+        if use is not node and not (isinstance(parent, ir.Call) and
+                                    library_function(parent.func) in
+                                    TABLE_READING_FUNCTIONS):
+            private.discard(node.id)
+        elif not contained_use(parent, use):
+            private.discard(node.id)
+
+    return private
+
+
+def created_tables(stmt):
+    """Get the variables a statement always assigns a new table"""
+
+    if isinstance(stmt, ir.Local):
+        return set(name for name, value in zip(stmt.names, stmt.values)
+                   if isinstance(value, ir.Table))
+    elif isinstance(stmt, ir.Assign):
+        return set(target.id for target, value
+                   in zip(stmt.targets, stmt.values)
+                   if isinstance(target, ir.Name) and
+                   isinstance(value, ir.Table))
+    else:
+        return set()
+
+
+class AppendCounter(object):
+    """Track the length of tables appended to in loops in a local
+    variable instead of finding the length for each append
+
+    This only applies to tables which are created by the script, are
+    only changed by appending values which can't be nil, and are never
+    visible through another variable. A nil value would leave a hole
+    in the table which table.insert does not.
+    """
+
+    def __init__(self, block, count):
+        self.private = private_tables(block)
+        self.count = count
+
+    def counted(self, loop, name):
+        """Check if the length of a table can be counted in a loop"""
+
+        parents = dict((id(node), parent)
+                       for node, parent in walk_parents(loop))
+
+        appended = False
+        for node in ir.walk(loop):
+            if isinstance(node, ir.Function) and \
+                    ir.name_reads(node)[name] > 0:
+                return False
+            elif not isinstance(node, ir.Name) or node.id != name:
+                continue
+
+            parent = parents[id(node)]
+            grandparent = parents.get(id(parent))
+            if isinstance(parent, ir.Index) and parent.obj is node:
+                # Values may be read but not changed
+                if isinstance(grandparent, ir.Assign) and \
+                        any(target is parent
+                            for target in grandparent.targets):
+                    return False
+            elif isinstance(parent, ir.Call) and parent.args[0] is node and \
+                    isinstance(grandparent, ir.CallStmt) and \
+                    appended_value(grandparent, name) is not None and \
+                    never_nil(appended_value(grandparent, name)):
+                appended = True
+            else:
+                return False
+
+        return appended
+
+    def count_appends(self, loop, name):
+        """Replace appends to a table in a loop using a length counter"""
+
+        self.count += 1
+        length = '__LEN%d' % self.count
+
+        for node in ir.walk(loop):
+            if isinstance(node, ir.Block):
+                body = []
+                for stmt in node.body:
+                    value = appended_value(stmt, name)
+                    if value is None:
+                        body.append(stmt)
+                        continue
+
+                    body.append(ir.Assign([ir.Name(length)], [
+                        ir.BinOp('+', ir.Name(length), ir.Const(1))]))
+                    body.append(ir.Assign([ir.Index(ir.Name(name),
+                                                    ir.Name(length))],
+                                          [value]))
+                node.body[:] = body
+
+        return ir.Local([length], [ir.UnOp('#', ir.Name(name))])
+
+    def visit_Block(self, node, created):
+        """Count appends in loops in a block given the tables which were
+        created before the block runs"""
+
+        body = []
+        for stmt in node.body:
+            if isinstance(stmt, LOOP_NODES):
+                for name in sorted(created & self.private):
+                    if self.counted(stmt, name):
+                        body.append(self.count_appends(stmt, name))
+            body.append(stmt)
+
+            for field in stmt._fields:
+                value = getattr(stmt, field)
+                if isinstance(value, ir.Block):
+                    self.visit_Block(value, created)
+
+            # Nothing is known about tables when functions are called
+            todo = [child for child in ir.iter_child_nodes(stmt)
+                    if not isinstance(child, ir.Block)]
+            while todo:
+                child = todo.pop()
+                if isinstance(child, ir.Function):
+                    self.visit_Block(child.body, set())
+                else:
+                    todo.extend(ir.iter_child_nodes(child))
+
+            created = created | created_tables(stmt)
+
+        node.body[:] = body
+
+    def visit(self, block):
+        self.visit_Block(block, set())
+        return block
+
+
+class AppendRewriter(ir.NodeTransformer):
+    """Add values to the end of tables without calling table.insert"""
+
+    def visit_CallStmt(self, node):
+        value = appended_value(node)
+        table = node.call.args[0] if value is not None else None
+        if table is None or not ir.is_pure(table):
+            return self.generic_visit(node)
+
+        length = ir.UnOp('#', copy.deepcopy(table))
+        return ir.Assign([ir.Index(table, ir.BinOp('+', length,
+                                                   ir.Const(1)))], [value])
+
+
+def localized_name(name):
+    """Get the local variable used to cache a global (e.g. redis.call)"""
+
+    return '__' + name.replace('.', '_').upper()
+
+
+def localized_global(node):
+    """Get the name of a global which can be cached used by a node"""
+
+    if isinstance(node, ir.RedisCall):
+        return 'redis.call'
+    elif isinstance(node, ir.Index) and isinstance(node.obj, ir.Name) and \
+            node.obj.id in LOCALIZED_LIBRARIES:
+        return library_function(node)
+    elif isinstance(node, ir.Name) and node.id in LOCALIZED_FUNCTIONS:
+        return node.id
+    else:
+        return None
+
+
+class GlobalLocalizer(ir.NodeTransformer):
+    """Replace uses of globals with local variables caching them"""
+
+    def __init__(self, names):
+        self.names = names
+
+    def visit_RedisCall(self, node):
+        node = self.generic_visit(node)
+        if 'redis.call' not in self.names:
+            return node
+
+        return ir.Call(ir.Name(localized_name('redis.call')),
+                       [ir.Const(node.command)] + node.args)
+
+    def visit_Index(self, node):
+        if localized_global(node) in self.names:
+            return ir.Name(localized_name(localized_global(node)))
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if localized_global(node) in self.names:
+            return ir.Name(localized_name(node.id))
+        return node
+
+
+def localize_globals(block):
+    """Cache library functions used in loops in local variables"""
+
+    # Globals may be shadowed by variables in the script
+    shadowed = set()
+    for stmt in block.body:
+        if not isinstance(stmt, ir.RawStmt):
+            shadowed.update(ir.name_writes(stmt))
+    used = set(ir.name_writes(block)) | set(ir.name_reads(block))
+
+    names = set()
+    for node in ir.walk(block):
+        if isinstance(node, LOOP_NODES):
+            for child in ir.walk(node):
+                name = localized_global(child)
+                if name is not None and \
+                        name.split('.')[0] not in shadowed and \
+                        localized_name(name) not in used:
+                    names.add(name)
+
+    if len(names) == 0:
+        return block
+
+    block = GlobalLocalizer(names).visit(block)
+
+    # Define the locals after the header
+    names = sorted(names)
+    start = 0
+    while start < len(block.body) and \
+            isinstance(block.body[start], ir.RawStmt):
+        start += 1
+    block.body.insert(start, ir.Local(
+        [localized_name(name) for name in names],
+        [ir.Index(ir.Name(name.split('.')[0]), ir.Const(name.split('.')[1]))
+         if '.' in name else ir.Name(name) for name in names]))
+
+    return block
+
+
+def micro_optimize(block):
+    """Apply small rewrites which make Lua code run faster
+
+    Concatenations are joined into a single chain, tables appended to in
+    loops have their lengths tracked in local variables and other appends
+    avoid calling table.insert, and library functions used in loops are
+    cached in local variables. This should run after all other passes
+    since the result no longer uses redis.call directly.
+    """
+
+    block = ConcatFlattener().visit(block)
+
+    # Avoid reusing the names of variables from earlier runs
+    count = max([int(name[5:]) for name in ir.name_writes(block)
+                 if re.match(r'^__LEN[0-9]+$', name)] + [0])
+    block = AppendCounter(block, count).visit(block)
+    block = AppendRewriter().visit(block)
+
+    return localize_globals(block)
+
+
+def only_reads(block):
+    """Check if code can only read data from Redis
+
+    This must be checked before running passes which may hide the
+    commands being run (e.g. by caching redis.call in a local).
+    """
+
+    for node in ir.walk(block):
+        if isinstance(node, ir.RedisCall):
+            if node.command not in commands.READ_COMMANDS:
+                return False
+        elif isinstance(node, (ir.Raw, ir.RawStmt)):
+            if 'redis' in ir.raw_names(node.code):
+                return False
+        elif isinstance(node, ir.Index) and \
+                library_function(node) in ('redis.call', 'redis.pcall'):
+            # The command is not known
+            return False
+
+    return True
+
+
+#: Optimization passes which can be run on generated code in order
+PASSES = collections.OrderedDict([
+    ('propagate_copies', propagate_copies),
+    ('fold_constants', fold_constants),
+    ('eliminate_repeated_reads', eliminate_repeated_reads),
+    ('batch_reads', batch_reads),
+    ('hoist_invariants', hoist_invariants),
+    ('eliminate_dead_code', eliminate_dead_code),
+    ('coalesce_writes', coalesce_writes),
+    ('remove_unused_locals', remove_unused_locals),
+    ('micro_optimize', micro_optimize),
+])
+
+#: Passes which are only run when requested
+OPTIONAL_PASSES = ('micro_optimize',)
+
+#: The passes run on generated code unless others are specified
+DEFAULT_PASSES = [name for name in PASSES if name not in OPTIONAL_PASSES]
+
+
+class PassManager(object):
+    """Run a sequence of optimization passes over generated code
+
+    Passes are given by name or as functions which take a block of code
+    and return the optimized block. The time taken by each pass and the
+    size of the code before and after it runs are added to `stats`.
+    """
+
+    def __init__(self, passes=None):
+        if passes is None:
+            passes = DEFAULT_PASSES
+
+        self.passes = []
+        for opt_pass in passes:
+            if callable(opt_pass):
+                self.passes.append((opt_pass.__name__, opt_pass))
+            elif opt_pass in PASSES:
+                self.passes.append((opt_pass, PASSES[opt_pass]))
+            else:
+                raise ValueError('Unknown optimization pass %s' % opt_pass)
+
+        self.stats = collections.OrderedDict(
+            (name, collections.Counter()) for name, _ in self.passes)
+
+    def run(self, block):
+        """Optimize a block of code with each pass in turn"""
+
+        size = len(block.render())
+        for name, opt_pass in self.passes:
+            start = time.time()
+            block = opt_pass(block)
+            elapsed = time.time() - start
+
+            new_size = len(block.render())
+            stats = self.stats[name]
+            stats['runs'] += 1
+            stats['time'] += elapsed
+            stats['size_before'] += size
+            stats['size_after'] += new_size
+            size = new_size
+
+        return block
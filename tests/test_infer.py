@@ -0,0 +1,70 @@
+import ast
+
+from locomotor import infer
+
+
+def infer_types(code, arg_types=None, redis_objs=(), hints=None):
+    nodes = ast.parse(code).body
+    return infer.TypeInference(nodes, arg_types, redis_objs, hints=hints)
+
+def test_literals():
+    types = infer_types('a = 1\nb = "foo"\nc = [1]\nd = {}\ne = (1, 2)')
+    assert types.name_type('a') == infer.NUMBER
+    assert types.name_type('b') == infer.STRING
+    assert types.name_type('c') == infer.LIST
+    assert types.name_type('d') == infer.DICT
+    assert types.name_type('e') == infer.LIST
+
+def test_unknown():
+    types = infer_types('a = foo')
+    assert types.name_type('a') == infer.ANY
+    assert types.name_type('b') == infer.ANY
+
+def test_conflict():
+    types = infer_types('a = []\nif x:\n    a = {}')
+    assert types.name_type('a') == infer.ANY
+
+def test_args():
+    types = infer_types('a = d\nb = self.FOO', {'d': infer.DICT,
+                                                'self.FOO': infer.LIST})
+    assert types.name_type('a') == infer.DICT
+    assert types.name_type('b') == infer.LIST
+
+def test_append():
+    types = infer_types('a = self.foo()\nfor i in x:\n    a.append(i)')
+    assert types.name_type('a') == infer.LIST
+
+def test_propagate():
+    types = infer_types('b = a + c\na = 1\nfor i in range(3):\n    d = i')
+    assert types.name_type('a') == infer.NUMBER
+    assert types.name_type('b') == infer.NUMBER
+    assert types.name_type('d') == infer.NUMBER
+
+def test_redis_replies():
+    client = ast.Name(id='client', ctx=ast.Load())
+    types = infer_types('a = client.lrange("foo", 0, -1)\n'
+                        'b = client.incr("foo")\n'
+                        'c = client.get("foo")\n'
+                        'd = client.srandmember("foo")\n'
+                        'e = client.srandmember("foo", 3)\n'
+                        'f = other.lrange("foo", 0, -1)',
+                        redis_objs=[client])
+    assert types.name_type('a') == infer.LIST
+    assert types.name_type('b') == infer.NUMBER
+    assert types.name_type('c') == infer.STRING
+    assert types.name_type('d') == infer.STRING
+    assert types.name_type('e') == infer.LIST
+    assert types.name_type('f') == infer.ANY
+
+def test_add():
+    types = infer_types('a = b + 1\nc = "foo" + d\ne = f + g')
+    assert types.name_type('a') == infer.NUMBER
+    assert types.name_type('c') == infer.STRING
+    assert types.name_type('e') == infer.ANY
+
+def test_hints():
+    types = infer_types('a = foo\nb = a + c', hints={'a': infer.NUMBER})
+    assert types.name_type('a') == infer.NUMBER
+    assert types.name_type('b') == infer.NUMBER
+    assert infer.hint_type(int) == infer.NUMBER
+    assert infer.hint_type(str) == infer.STRING
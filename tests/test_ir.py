@@ -0,0 +1,56 @@
+from locomotor import ir
+
+
+def test_precedence():
+    expr = ir.BinOp('*', ir.BinOp('+', ir.Name('a'), ir.Name('b')),
+                    ir.Name('c'))
+    assert expr.render() == '(a + b) * c'
+
+    expr = ir.BinOp('-', ir.Name('a'), ir.BinOp('-', ir.Name('b'),
+                                                 ir.Name('c')))
+    assert expr.render() == 'a - (b - c)'
+
+    expr = ir.BinOp('..', ir.Name('a'), ir.BinOp('..', ir.Name('b'),
+                                                  ir.Name('c')))
+    assert expr.render() == 'a .. b .. c'
+
+def test_unary_minus():
+    expr = ir.UnOp('-', ir.UnOp('-', ir.Name('a')))
+    assert expr.render() == '-(-a)'
+    assert ir.UnOp('-', ir.Const(-1)).render() == '-(-1)'
+
+def test_constants():
+    assert ir.Const(None).render() == 'nil'
+    assert ir.Const(True).render() == 'true'
+    assert ir.Const(1.5).render() == '1.5'
+    assert ir.Const("it's").render() == "'it\\'s'"
+
+def test_index():
+    assert ir.Index(ir.Name('t'), ir.Const('a')).render() == 't.a'
+    assert ir.Index(ir.Name('t'), ir.Const('end')).render() == "t['end']"
+    assert ir.Index(ir.Name('t'), ir.Const(1)).render() == 't[1]'
+
+def test_early_return():
+    block = ir.Block([ir.Return([ir.Const(1)]),
+                      ir.CallStmt(ir.Call('f'))])
+    assert block.render() == 'do return 1; end\nf();\n'
+
+def test_reads_writes():
+    block = ir.Block([ir.Local(['a'], [ir.Const(1)]),
+                      ir.Assign([ir.Name('b')], [ir.Name('a')]),
+                      ir.Assign([ir.Index(ir.Name('c'), ir.Const(1))],
+                                [ir.Const(2)])])
+    reads = ir.name_reads(block)
+    writes = ir.name_writes(block)
+    assert reads['a'] == 1
+    assert reads['b'] == 0
+    assert reads['c'] == 1
+    assert writes['a'] == 1
+    assert writes['b'] == 1
+    assert writes['c'] == 0
+
+def test_pure():
+    assert ir.is_pure(ir.BinOp('+', ir.Name('a'), ir.Const(1)))
+    assert ir.is_pure(ir.Call('tonumber', [ir.Name('a')]))
+    assert not ir.is_pure(ir.Call('f', [ir.Name('a')]))
+    assert not ir.is_pure(ir.RedisCall('get', [ir.Const('a')]))
@@ -0,0 +1,428 @@
+import pytest
+
+from locomotor import ir
+from locomotor import passes
+
+
+def test_fold_arithmetic():
+    block = ir.Block([ir.Return([ir.BinOp('*', ir.Const(2), ir.BinOp(
+        '+', ir.Const(3), ir.Const(4)))])])
+    assert passes.fold_constants(block).render() == 'return 14;\n'
+
+def test_fold_concat():
+    expr = ir.BinOp('..', ir.Const('KEY.'), ir.Const(1))
+    block = passes.fold_constants(ir.Block([ir.Return([expr])]))
+    assert block.render() == "return 'KEY.1';\n"
+
+def test_fold_division_by_zero():
+    expr = ir.BinOp('/', ir.Const(1), ir.Const(0))
+    block = passes.fold_constants(ir.Block([ir.Return([expr])]))
+    assert block.render() == 'return 1 / 0;\n'
+
+def test_fold_equality():
+    expr = ir.BinOp('==', ir.Const(1), ir.Const(True))
+    block = passes.fold_constants(ir.Block([ir.Return([expr])]))
+    assert block.render() == 'return false;\n'
+
+def test_dead_branch():
+    block = ir.Block([ir.If(ir.Const(False),
+                            ir.Block([ir.CallStmt(ir.Call('f'))]),
+                            ir.Block([ir.CallStmt(ir.Call('g'))]))])
+    assert passes.eliminate_dead_code(block).render() == 'g();\n'
+
+def test_unreachable():
+    block = ir.Block([ir.Return([ir.Const(1)]),
+                      ir.CallStmt(ir.Call('f'))])
+    assert passes.eliminate_dead_code(block).render() == 'return 1;\n'
+
+def test_empty_loop():
+    block = ir.Block([ir.NumericFor('i', ir.Const(1), ir.Const(0),
+                                    ir.Const(1), ir.Block([
+                                        ir.CallStmt(ir.Call('f'))]))])
+    assert passes.eliminate_dead_code(block).render() == ''
+
+def test_propagate_copies():
+    block = ir.Block([
+        ir.Local(['a', 'b']),
+        ir.Assign([ir.Name('a')], [ir.Const('x')]),
+        ir.Assign([ir.Name('b')], [ir.Name('a')]),
+        ir.Return([ir.Name('b')])])
+    block = passes.propagate_copies(block)
+    assert block.body[-1].render() == "return 'x';\n"
+
+def test_propagate_reassigned():
+    block = ir.Block([
+        ir.Local(['a'], [ir.Const(1)]),
+        ir.Assign([ir.Name('a')], [ir.Const(2)]),
+        ir.Return([ir.Name('a')])])
+    block = passes.propagate_copies(block)
+    assert block.body[-1].render() == 'return a;\n'
+
+def test_unused_locals():
+    block = ir.Block([
+        ir.Local(['a', 'b']),
+        ir.Assign([ir.Name('a')], [ir.Const(1)]),
+        ir.Assign([ir.Name('b')], [ir.Call('f')]),
+        ir.Return([ir.Const(1)])])
+    block = passes.remove_unused_locals(block)
+    assert block.render() == 'f();\nreturn 1;\n'
+
+def test_unused_raw():
+    block = ir.Block([ir.Local(['a'], [ir.Const(1)]),
+                      ir.RawStmt('return a')])
+    block = passes.remove_unused_locals(block)
+    assert block.render() == 'local a = 1;\nreturn a\n'
+
+def test_pass_manager():
+    manager = passes.PassManager()
+    block = ir.Block([
+        ir.Local(['a'], [ir.Const(2)]),
+        ir.If(ir.BinOp('>', ir.Name('a'), ir.Const(1)),
+              ir.Block([ir.Return([ir.Name('a')])]))])
+    assert manager.run(block).render() == 'return 2;\n'
+
+    stats = manager.stats['fold_constants']
+    assert stats['runs'] == 1
+    assert stats['size_after'] <= stats['size_before']
+
+def test_pass_selection():
+    manager = passes.PassManager(['fold_constants'])
+    assert list(manager.stats) == ['fold_constants']
+
+    with pytest.raises(ValueError):
+        passes.PassManager(['foo'])
+
+def loop_over(name, body):
+    return ir.GenericFor(['_', 'k'], [ir.Call('ipairs', [ir.Name(name)])],
+                         ir.Block(body))
+
+def test_hoist_invariant():
+    key = ir.BinOp('..', ir.Name('prefix'), ir.Const(':'))
+    block = ir.Block([loop_over('keys', [ir.CallStmt(ir.RedisCall(
+        'get', [ir.BinOp('..', key, ir.Name('k'))]))])])
+    block = passes.hoist_invariants(block)
+    assert block.render() == \
+        "if keys[1] ~= nil then\n" \
+        "  local __INVARIANT1 = prefix .. ':';\n" \
+        "  for _, k in ipairs(keys) do\n" \
+        "    redis.call('get', __INVARIANT1 .. k);\n" \
+        "  end\n" \
+        "end\n"
+
+def test_hoist_redis_call():
+    call = ir.RedisCall('get', [ir.Name('key')])
+    block = ir.Block([loop_over('keys', [
+        ir.Assign([ir.Name('x')], [ir.BinOp('..', call, ir.Name('k'))])])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def test_hoist_assigned():
+    block = ir.Block([loop_over('keys', [
+        ir.Assign([ir.Name('x')], [ir.BinOp('..', ir.Name('x'),
+                                            ir.Name('y'))])])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def test_hoist_conditional():
+    value = ir.Index(ir.Name('t'), ir.Const('a'))
+    block = ir.Block([loop_over('keys', [
+        ir.If(ir.Name('t'), ir.Block([
+            ir.CallStmt(ir.RedisCall('get', [value]))]))])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def test_hoist_mutated_table():
+    value = ir.Index(ir.Name('t'), ir.Const('a'))
+    insert = ir.Index(ir.Name('table'), ir.Const('insert'))
+    block = ir.Block([loop_over('keys', [
+        ir.CallStmt(ir.RedisCall('get', [value])),
+        ir.CallStmt(ir.Call(insert, [ir.Name('t'), ir.Name('k')]))])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def test_hoist_shared_table():
+    # x is another name for t so t[1] changes in each iteration
+    first = ir.Index(ir.Name('t'), ir.Const(1))
+    block = ir.Block([
+        ir.Local(['t'], [ir.Table([ir.Const(0)])]),
+        ir.Local(['d'], [ir.Table([ir.Pair(ir.Const('k'), ir.Name('t'))])]),
+        loop_over('keys', [
+            ir.Assign([ir.Name('x')], [ir.Index(ir.Name('d'), ir.Const('k'))]),
+            ir.Assign([ir.Index(ir.Name('x'), ir.Const(1))], [ir.Name('k')]),
+            ir.CallStmt(ir.RedisCall('get', [first]))])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def test_hoist_private_table():
+    first = ir.Index(ir.Name('t'), ir.Const(1))
+    block = ir.Block([
+        ir.Local(['out'], [ir.Table()]),
+        loop_over('keys', [
+            ir.Assign([ir.Index(ir.Name('out'), ir.Name('k'))], [
+                ir.RedisCall('get', [first])])]),
+        ir.Return([ir.Call('__RETVAL', [ir.Name('out'), ir.Const(True)])])])
+    assert 'local __INVARIANT1 = t[1];' in \
+        passes.hoist_invariants(block).render()
+
+def test_hoist_after_write():
+    # The concatenation fails if s is nil so the first SET must happen
+    key = ir.BinOp('..', ir.Name('p'), ir.Name('s'))
+    block = ir.Block([loop_over('keys', [
+        ir.CallStmt(ir.RedisCall('set', [ir.Name('k'), ir.Const(1)])),
+        ir.CallStmt(ir.RedisCall('set', [key, ir.Name('k')]))])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def test_hoist_before_write():
+    key = ir.BinOp('..', ir.Name('p'), ir.Name('s'))
+    block = ir.Block([loop_over('keys', [
+        ir.Assign([ir.Name('x')], [ir.BinOp('+', ir.Name('x'), ir.RedisCall(
+            'incr', [ir.BinOp('..', key, ir.Name('k'))]))]),
+        ir.CallStmt(ir.RedisCall('set', [key, ir.Name('k')]))])])
+    block = passes.hoist_invariants(block)
+    assert block.render().count('__INVARIANT1') == 3
+
+def test_hoist_fresh_table():
+    block = ir.Block([loop_over('keys', [
+        ir.Assign([ir.Name('x')], [ir.Table()])])])
+    assert 'INVARIANT' not in passes.hoist_invariants(block).render()
+
+def get(key):
+    return ir.RedisCall('get', [key])
+
+def test_repeated_read():
+    key = ir.BinOp('..', ir.Const('user:'), ir.Name('id'))
+    block = ir.Block([
+        ir.Local(['a'], [get(key)]),
+        ir.Local(['b'], [ir.BinOp('..', get(key), ir.Const('x'))]),
+        ir.Return([ir.Name('b')])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render() == \
+        "local a = redis.call('get', 'user:' .. id);\n" \
+        "local b = a .. 'x';\n" \
+        "return b;\n"
+
+def test_repeated_read_new_variable():
+    block = ir.Block([
+        ir.Local(['a'], [ir.Call('tonumber', [get(ir.Const('k'))])]),
+        ir.Return([get(ir.Const('k'))])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render() == \
+        "local __READ1 = redis.call('get', 'k');\n" \
+        "local a = tonumber(__READ1);\n" \
+        "return __READ1;\n"
+
+def test_single_read():
+    block = ir.Block([ir.CallStmt(ir.Call('f', [get(ir.Const('k'))]))])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render() == "f(redis.call('get', 'k'));\n"
+
+def test_single_read_in_function():
+    body = ir.Block([
+        ir.Local(['a'], [ir.Call('tonumber', [get(ir.Const('k'))])]),
+        ir.Return([ir.Name('a')])])
+    block = ir.Block([ir.Local(['g'], [ir.Function([], body)])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render() == \
+        "local g = function()\n" \
+        "  local a = tonumber(redis.call('get', 'k'));\n" \
+        "  return a;\n" \
+        "end;\n"
+
+def test_read_after_write():
+    block = ir.Block([
+        ir.Local(['a'], [get(ir.Name('key'))]),
+        ir.CallStmt(ir.RedisCall('set', [ir.Name('other'), ir.Const(1)])),
+        ir.Return([get(ir.Name('key'))])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render().count('redis.call') == 3
+
+def test_read_after_distinct_write():
+    key = ir.BinOp('..', ir.Const('user:'), ir.Name('id'))
+    other = ir.BinOp('..', ir.Const('post:'), ir.Name('id'))
+    block = ir.Block([
+        ir.Local(['a'], [get(key)]),
+        ir.CallStmt(ir.RedisCall('set', [other, ir.Const(1)])),
+        ir.Return([get(key)])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.body[-1].render() == 'return a;\n'
+
+def test_read_key_reassigned():
+    block = ir.Block([
+        ir.Local(['a'], [get(ir.Name('key'))]),
+        ir.Assign([ir.Name('key')], [ir.Const('k')]),
+        ir.Return([get(ir.Name('key'))])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.body[-1].render() == "return redis.call('get', key);\n"
+
+def test_read_in_loop():
+    block = ir.Block([
+        ir.Local(['a'], [get(ir.Const('k'))]),
+        loop_over('keys', [
+            ir.CallStmt(ir.Call('f', [get(ir.Const('k'))])),
+            ir.CallStmt(ir.RedisCall('incr', [ir.Name('k')]))])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render().count("redis.call('get', 'k')") == 2
+
+def test_read_table_modified():
+    members = ir.RedisCall('smembers', [ir.Const('s')])
+    insert = ir.Index(ir.Name('table'), ir.Const('insert'))
+    block = ir.Block([
+        ir.Local(['a'], [members]),
+        ir.CallStmt(ir.Call(insert, [ir.Name('a'), ir.Const(1)])),
+        ir.Return([ir.RedisCall('smembers', [ir.Const('s')])])])
+    block = passes.eliminate_repeated_reads(block)
+    assert block.render().count('smembers') == 2
+
+def test_keys_may_alias():
+    user = ir.BinOp('..', ir.Const('user:'), ir.Name('id'))
+    assert passes.keys_may_alias(user, ir.Name('key'))
+    assert passes.keys_may_alias(user, ir.Const('user:1'))
+    assert not passes.keys_may_alias(user, ir.Const('post:1'))
+    assert not passes.keys_may_alias(ir.Const('a'), ir.Const('b'))
+
+def test_batch_get():
+    key = ir.BinOp('..', ir.Const('item:'), ir.Name('k'))
+    insert = ir.Index(ir.Name('table'), ir.Const('insert'))
+    block = ir.Block([
+        ir.Local(['items'], [ir.Table()]),
+        loop_over('keys', [ir.CallStmt(ir.Call(
+            insert, [ir.Name('items'), ir.RedisCall('get', [key])]))])])
+    code = passes.batch_reads(block).render()
+    assert "__BATCH2[__BATCH_INDEX1] = 'item:' .. k;" in code
+    assert "__BATCH2 = __BATCH_READ('mget', nil, __BATCH2);" in code
+    assert 'table.insert(items, __BATCH2[__BATCH_INDEX1]);' in code
+    assert "redis.call('get'" not in \
+        code.replace(passes.BATCHED_READ_CODE, '')
+
+def test_batch_shared_table():
+    # other is another name for keys so the loop changes the keys it reads
+    block = ir.Block([
+        ir.Local(['other'], [ir.Name('keys')]),
+        ir.Local(['out'], [ir.Table()]),
+        loop_over('keys', [
+            insert(ir.Name('out'), get(ir.Name('k'))),
+            ir.Assign([ir.Index(ir.Name('other'), ir.Const(2))],
+                      [ir.Const('z')])])])
+    assert 'BATCH' not in passes.batch_reads(block).render()
+
+def test_batch_hget():
+    block = ir.Block([loop_over('keys', [ir.Assign([ir.Name('x')], [
+        ir.RedisCall('hget', [ir.Name('h'), ir.Name('k')])])])])
+    code = passes.batch_reads(block).render()
+    assert "__BATCH_READ('hmget', h, __BATCH2)" in code
+
+def test_batch_different_hashes():
+    block = ir.Block([loop_over('keys', [ir.Assign([ir.Name('x')], [
+        ir.RedisCall('hget', [ir.Name('k'), ir.Const('name')])])])])
+    assert 'BATCH' not in passes.batch_reads(block).render()
+
+def test_batch_write():
+    block = ir.Block([loop_over('keys', [
+        ir.Assign([ir.Name('x')], [ir.RedisCall('get', [ir.Name('k')])]),
+        ir.CallStmt(ir.RedisCall('set', [ir.Name('k'), ir.Const(1)]))])])
+    assert 'BATCH' not in passes.batch_reads(block).render()
+
+def test_batch_conditional():
+    block = ir.Block([loop_over('keys', [
+        ir.If(ir.Name('x'), ir.Block([ir.Assign([ir.Name('x')], [
+            ir.RedisCall('get', [ir.Name('k')])])]))])])
+    assert 'BATCH' not in passes.batch_reads(block).render()
+
+def test_coalesce_sadd():
+    block = ir.Block([
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('a')])),
+        ir.Local(['x'], [ir.Const(1)]),
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('b')]))])
+    assert passes.coalesce_writes(block).render() == \
+        "redis.call('sadd', 's', a, b);\n" \
+        "local x = 1;\n"
+
+def test_coalesce_hset():
+    block = ir.Block([ir.CallStmt(ir.RedisCall('hset', [
+        ir.Name('h'), ir.Const('f%d' % i), ir.Const(i)])) for i in range(3)])
+    assert passes.coalesce_writes(block).render() == \
+        "redis.call('hmset', h, 'f0', 0, 'f1', 1, 'f2', 2);\n"
+
+def test_coalesce_read_between():
+    block = ir.Block([
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('a')])),
+        ir.Local(['x'], [ir.RedisCall('scard', [ir.Name('key')])]),
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('b')]))])
+    assert passes.coalesce_writes(block).render().count('sadd') == 2
+
+def test_coalesce_error_between():
+    block = ir.Block([
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('a')])),
+        ir.CallStmt(ir.RedisCall('set', [ir.Const('t'), ir.Const(1)])),
+        ir.Local(['x'], [ir.BinOp('+', ir.Name('y'), ir.Const(1))]),
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('b')]))])
+    assert passes.coalesce_writes(block).render().count('sadd') == 2
+
+def test_coalesce_argument_changed():
+    block = ir.Block([
+        ir.CallStmt(ir.RedisCall('del', [ir.Name('a')])),
+        ir.Assign([ir.Name('a')], [ir.Const('b')]),
+        ir.CallStmt(ir.RedisCall('del', [ir.Name('a')]))])
+    assert passes.coalesce_writes(block).render().count('del') == 2
+
+def test_coalesce_used_reply():
+    block = ir.Block([
+        ir.CallStmt(ir.RedisCall('sadd', [ir.Const('s'), ir.Name('a')])),
+        ir.Local(['x'], [ir.RedisCall('sadd', [ir.Const('s'), ir.Name('b')])])])
+    assert passes.coalesce_writes(block).render().count('sadd') == 2
+
+def insert(table, value):
+    return ir.CallStmt(ir.Call(ir.Index(ir.Name('table'),
+                                        ir.Const('insert')), [table, value]))
+
+def test_micro_flatten_concat():
+    expr = ir.BinOp('..', ir.BinOp('..', ir.Name('a'), ir.Name('b')),
+                    ir.Name('c'))
+    block = passes.micro_optimize(ir.Block([ir.Return([expr])]))
+    assert block.render() == 'return a .. b .. c;\n'
+
+def test_micro_append_counter():
+    block = ir.Block([
+        ir.Local(['t'], [ir.Table()]),
+        ir.GenericFor(['_', 'k'], [ir.Name('keys')], ir.Block([
+            insert(ir.Name('t'), ir.RedisCall('get', [ir.Name('k')]))])),
+        ir.Return([ir.Call('__RETVAL', [ir.Name('t')])])])
+    code = passes.micro_optimize(block).render()
+    assert 'local __LEN1 = #t;' in code
+    assert "t[__LEN1] = __REDIS_CALL('get', k);" in code
+    assert 'local __REDIS_CALL = redis.call;' in code
+
+def test_micro_append_nil():
+    block = ir.Block([
+        ir.Local(['t'], [ir.Table()]),
+        ir.GenericFor(['_', 'k'], [ir.Name('keys')], ir.Block([
+            insert(ir.Name('t'), ir.Name('k'))])),
+        ir.Return([ir.Call('__RETVAL', [ir.Name('t')])])])
+    code = passes.micro_optimize(block).render()
+    assert '__LEN' not in code and 't[#t + 1] = k;' in code
+
+def test_micro_append_shared_table():
+    block = ir.Block([
+        ir.Local(['t'], [ir.Table()]),
+        ir.Local(['u'], [ir.Name('t')]),
+        ir.GenericFor(['_', 'k'], [ir.Name('keys')], ir.Block([
+            insert(ir.Name('t'), ir.Const(1)),
+            insert(ir.Name('u'), ir.Const(2))]))])
+    assert '__LEN' not in passes.micro_optimize(block).render()
+
+def test_micro_shadowed_global():
+    block = ir.Block([
+        ir.Local(['tostring'], [ir.Function(['x'], ir.Block([
+            ir.Return([ir.Name('x')])]))]),
+        ir.GenericFor(['_', 'k'], [ir.Name('keys')], ir.Block([
+            ir.CallStmt(ir.Call('tostring', [ir.Name('k')]))]))])
+    assert '__TOSTRING' not in passes.micro_optimize(block).render()
+
+def test_micro_optional():
+    assert 'micro_optimize' in passes.PASSES
+    assert 'micro_optimize' not in passes.DEFAULT_PASSES
+
+def test_only_reads():
+    read = ir.Block([ir.Return([ir.RedisCall('get', [ir.Name('k')])])])
+    write = ir.Block([ir.CallStmt(ir.RedisCall('set', [ir.Name('k'),
+                                                       ir.Const(1)]))])
+    dynamic = ir.Block([ir.CallStmt(ir.Call(ir.Index(
+        ir.Name('redis'), ir.Const('call')), [ir.Name('c')]))])
+    assert passes.only_reads(read)
+    assert not passes.only_reads(write)
+    assert not passes.only_reads(dynamic)
@@ -1,10 +1,14 @@
 import ast
+import copy
 import datetime
 import imp
 import pytest
 import time
 
-from locomotor import redis_server
+from locomotor import CrossSlotException, HashRing, ReplicaSet, \
+    ScriptRegistry, minify_lua, redis_server
+from locomotor.passes import DEFAULT_PASSES
+from redis.exceptions import ResponseError
 
 @pytest.fixture(scope='session')
 def redis(request):
@@ -43,6 +47,121 @@ def test_add_link(redis):
     assert add_link(redis, 'bar') == 2
     assert add_link.__name__ == 'add_link'
 
+def test_script_flush(redis):
+    @redis_server(redis_objs=['client'])
+    def flushed(client):
+        return 3
+
+    assert flushed(redis) == 3
+    redis.script_flush()
+    assert flushed(redis) == 3
+
+def test_map(redis):
+    @redis_server(redis_objs=['client'])
+    def double(client, value):
+        return value * 2
+
+    assert double.map([redis] * 3, [1, 2, 3]) == [2, 4, 6]
+    assert double.starmap([]) == []
+
+def test_map_method(redis):
+    class Foo:
+        FACTOR = 3
+
+        @redis_server(redis_objs=['client'])
+        def scale(self, client, value):
+            return value * self.FACTOR
+
+    assert Foo().scale.starmap([(redis, 1), (redis, 2)]) == [3, 6]
+
+def test_method_stub(redis):
+    class Foo:
+        def __init__(self, factor):
+            self.factor = factor
+
+        @redis_server(redis_objs=['client'])
+        def scale(self, client, value):
+            return value * self.factor
+
+    foo = Foo(3)
+    assert foo.scale(redis, 1) == 3
+    assert foo.scale(redis, 2) == 6
+    assert foo.scale.map([redis], [4]) == [12]
+
+    # Nothing is stored on the instance so copies use their own values
+    assert 'scale' not in vars(foo)
+    other = copy.copy(foo)
+    other.factor = 4
+    assert other.scale(redis, 1) == 4
+    assert foo.scale(redis, 1) == 3
+
+def test_map_error(redis):
+    @redis_server(redis_objs=['client'])
+    def list_len(client, key):
+        return client.llen(key)
+
+    redis.set('map_str', 'foo')
+    redis.rpush('map_list', 'foo')
+
+    results = list_len.starmap([(redis, 'map_list'), (redis, 'map_str')])
+    assert results[0] == 1
+    assert isinstance(results[1], ResponseError)
+
+def test_vectorized(redis):
+    @redis_server(redis_objs=['client'])
+    def lookup(client, d, k):
+        return d[k]
+
+    assert lookup.starmap([(redis, {'a': 1}, 'a'), (redis, {'b': 2}, 'b')],
+                          vectorize=True) == [1, 2]
+
+def test_vectorized_error(redis):
+    @redis_server(redis_objs=['client'])
+    def list_len(client, key):
+        return client.llen(key)
+
+    redis.set('vector_str', 'foo')
+    redis.rpush('vector_list', 'foo')
+
+    results = list_len.map([redis] * 2, ['vector_list', 'vector_str'],
+                           vectorize=True)
+    assert results[0] == 1
+    assert isinstance(results[1], ResponseError)
+
+def test_vectorized_read(redis):
+    @redis_server(redis_objs=['client'])
+    def get_value(client, key):
+        return client.get(key)
+
+    redis.set('vector_read:1', 'a')
+    redis.set('vector_read:2', 'b')
+    assert get_value.map([redis] * 2, ['vector_read:1', 'vector_read:2'],
+                         vectorize=True) == ['a', 'b']
+
+def test_read_only_packed_args(redis):
+    @redis_server(redis_objs=['client'])
+    def first(client, keys):
+        return client.get(keys[0])
+
+    @redis_server(redis_objs=['client'])
+    def get_default(client, key, default):
+        value = client.get(key)
+        if value == None:
+            value = default
+        return value
+
+    # Servers without EVALSHA_RO are found before it is tried since the
+    # error echoes the packed arguments
+    ScriptRegistry.NO_READ_ONLY.clear()
+    ScriptRegistry.CHECKED_READ_ONLY.clear()
+    redis.set('read_only:key', 'value')
+    assert first(redis, ['read_only:key']) == 'value'
+    assert get_default(redis, 'read_only:key', None) == 'value'
+
+    version = redis.info('server')['redis_version']
+    assert (ScriptRegistry.server_id(redis) in
+            ScriptRegistry.NO_READ_ONLY) == (int(version.split('.')[0]) < 7)
+
 def test_increx(redis):
     class Foo:
         KEY_EXISTS = 1
@@ -67,6 +186,112 @@ def test_type(redis):
     assert redis_server(return_value, redis_objs=redis_objs)(redis, 2.71828) \
             == 2.71828
 
+def test_polymorphic(redis):
+    @redis_server(redis_objs=['client'])
+    def identity(client, value):
+        return value
+
+    assert identity(redis, 3) == 3
+    assert identity(redis, 'foo') == 'foo'
+    assert identity(redis, [1, 2]) == [1, 2]
+    assert identity(redis, 4) == 4
+    assert identity.stats['variants'] == 3
+
+def test_variant_limit(redis):
+    @redis_server(redis_objs=['client'])
+    def identity(client, value):
+        return value
+
+    identity.max_variants = 1
+    assert identity(redis, 3) == 3
+    assert identity(redis, 'foo') == 'foo'
+    assert identity(redis, 3) == 3
+    assert identity.stats['evictions'] == 2
+
+def test_encoded_args(redis):
+    @redis_server(redis_objs=['client'])
+    def combine(client, missing, items, counts, name):
+        if missing is None:
+            return name + str(len(items) + counts['a'])
+
+    items = list(range(1000))
+    assert combine(redis, None, items, {'a': 1}, 'foo') == 'foo1001'
+    assert combine(redis, None, [1], {'a': 2}, 'bar') == 'bar3'
+    assert combine.stats['variants'] == 1
+    assert items == list(range(1000))
+
+    # Constants are packed on each call so changes to them are seen
+    class Fields(object):
+        NAMES = ['a', 'b']
+
+        @redis_server(redis_objs=['client'])
+        def count(self, client):
+            return len(self.NAMES)
+
+    fields = Fields()
+    assert fields.count(redis) == 2
+    assert fields.count(redis) == 2
+    fields.NAMES.append('c')
+    assert fields.count(redis) == 3
+    fields.NAMES = ['d']
+    assert fields.count(redis) == 1
+
+def test_is_none(redis):
+    @redis_server(redis_objs=['client'])
+    def describe(client, key):
+        value = client.get(key)
+        if value is None:
+            return 'missing'
+        elif value is not None:
+            return 'found'
+
+    redis.delete('is_none:key')
+    assert describe(redis, 'is_none:key') == 'missing'
+    redis.set('is_none:key', 'value')
+    assert describe(redis, 'is_none:key') == 'found'
+
+def test_native_replies(redis):
+    @redis_server(redis_objs=['client'])
+    def get_list(client, key):
+        return client.lrange(key, 0, -1)
+
+    @redis_server(redis_objs=['client'])
+    def divide(client, m, n):
+        return m / n
+
+    @redis_server(redis_objs=['client'], native_replies=False)
+    def length(client, key):
+        return client.llen(key)
+
+    redis.rpush('native:list', 'a', 'b')
+    assert get_list(redis, 'native:list') == ['a', 'b']
+    assert get_list.reply_type == 'list'
+
+    # Values which don't fit in a native reply are still packed
+    assert divide(redis, 12, 4) == 3
+    assert divide(redis, 5.0, 2) == 2.5
+    assert divide.reply_type == 'number'
+
+    assert length(redis, 'native:list') == 2
+    assert length.reply_type is None
+
+def test_stream(redis):
+    @redis_server(redis_objs=['client'], stream_size=10)
+    def members(client, key):
+        return client.lrange(key, 0, -1)
+
+    redis.rpush('stream:list', *range(2500))
+    items = members(redis, 'stream:list')
+    assert not isinstance(items, list)
+    assert list(items) == [str(i) for i in range(2500)]
+    assert members.read_only is False
+
+    # The stored list is removed once all the items are read
+    assert redis.keys('locomotor-stream:*') == []
+
+    with pytest.raises(ValueError):
+        members.starmap([(redis, 'stream:list')], vectorize=True)
+
 def test_loop(redis):
     @redis_server(redis_objs=['client'])
     def loop(client):
@@ -143,6 +368,19 @@ def test_dict_literal(redis):
 
     assert foo(redis) == 1
 
+def test_static_index(redis):
+    @redis_server(redis_objs=['client'])
+    def totals(client):
+        totals = []
+        for i in range(3):
+            totals.append(0)
+        for i in range(3):
+            totals[i] += i
+        return totals
+
+    assert '__DICT' not in str(totals.body)
+    assert totals(redis) == [0, 1, 2]
+
 def test_execute(redis):
     @redis_server(redis_objs=['client'])
     def pipe(client, key1, key2):
@@ -285,6 +523,155 @@ def test_multiply(redis):
 
     assert multiply(redis, 3, 4) == 12
 
+def test_add_numbers(redis):
+    @redis_server(redis_objs=['client'])
+    def add(client, m, n):
+        return m + n
+
+    assert add(redis, 2, 3) == 5
+    assert add(redis, 'foo', 'bar') == 'foobar'
+
+def test_add_replies(redis):
+    @redis_server(redis_objs=['client'])
+    def add_replies(client):
+        return client.incr('add_counter') + client.incr('add_counter')
+
+    assert add_replies(redis) == 3
+
+def test_type_hints(redis):
+    @redis_server(redis_objs=['client'], type_hints={'total': int})
+    def hinted(client, key):
+        total = client.get(key)
+        return total + 1
+
+    redis.set('hinted', 2)
+    assert hinted(redis, 'hinted') == 3
+
+def test_passes(redis):
+    @redis_server(redis_objs=['client'])
+    def optimized(client, key):
+        prefix = 'prefix:'
+        if len(prefix) > 0:
+            return prefix + key
+
+    @redis_server(redis_objs=['client'], passes=[])
+    def unoptimized(client, key):
+        prefix = 'prefix:'
+        if len(prefix) > 0:
+            return prefix + key
+
+    assert optimized(redis, 'a') == 'prefix:a'
+    assert unoptimized(redis, 'a') == 'prefix:a'
+
+    stats = optimized.pass_manager.stats
+    assert stats['fold_constants']['runs'] == 1
+    assert stats['remove_unused_locals']['size_after'] < \
+        stats['propagate_copies']['size_before']
+
+def test_loop_invariant(redis):
+    class Invariant(object):
+        PREFIX = 'invariant:'
+
+        def key(self, name):
+            return self.PREFIX + name
+
+        @redis_server(redis_objs=['client'])
+        def incr_all(self, client, names, suffix):
+            total = 0
+            for name in names:
+                total += client.incr(self.key(suffix) + ':' + name)
+            return total
+
+    assert Invariant().incr_all(redis, ['a', 'b'], 'x') == 2
+    assert Invariant().incr_all(redis, [], 'x') == 0
+    assert redis.get('invariant:x:b') == '1'
+
+def test_loop_invariant_alias(redis):
+    @redis_server(redis_objs=['client'])
+    def alias(client):
+        t = [0, 0]
+        d = {'k': t}
+        total = 0
+        for i in range(3):
+            x = d['k']
+            x[0] = i
+            total += t[0]
+        return total
+
+    assert alias(redis) == 3
+
+def test_repeated_read(redis):
+    @redis_server(redis_objs=['client'])
+    def read_twice(client, key):
+        first = client.get(key)
+        client.set(key + ':other', 'b')
+        second = client.get(key)
+        client.set(key, 'c')
+        return first + second + client.get(key)
+
+    redis.set('repeated', 'a')
+    assert read_twice(redis, 'repeated') == 'aac'
+
+def test_batch_reads(redis):
+    @redis_server(redis_objs=['client'])
+    def get_all(client, ids):
+        values = []
+        for id in ids:
+            values.append(client.get('batch:' + id))
+        return values
+
+    # Enough keys that they must be read in multiple chunks
+    ids = [str(i) for i in range(2500)]
+    pipe = redis.pipeline()
+    for id in ids:
+        pipe.set('batch:' + id, id)
+    pipe.execute()
+
+    assert get_all(redis, ids) == ids
+    assert get_all(redis, []) == []
+
+    # Batched reads still fail on keys holding other types
+    redis.sadd('batch:set', 'x')
+    with pytest.raises(ResponseError):
+        get_all(redis, ['1', 'set'])
+
+def test_batch_reads_alias(redis):
+    @redis_server(redis_objs=['client'])
+    def get_all(client, ids):
+        other = ids
+        out = []
+        for k in ids:
+            out.append(client.get('alias:' + k))
+            other[1] = 'z'
+        return out
+
+    redis.mset({'alias:a': '1', 'alias:b': '2', 'alias:z': 'Z'})
+    assert get_all(redis, ['a', 'b']) == ['1', 'Z']
+
+def test_coalesce_writes(redis):
+    @redis_server(redis_objs=['client'])
+    def add_user(client, name, email):
+        client.hset('coalesce:' + name, 'name', name)
+        client.sadd('coalesce:names', name)
+        client.hset('coalesce:' + name, 'email', email)
+        client.sadd('coalesce:names', email)
+        return client.scard('coalesce:names')
+
+    assert add_user(redis, 'foo', 'foo@example.com') == 2
+    assert redis.hgetall('coalesce:foo') == {'name': 'foo',
+                                             'email': 'foo@example.com'}
+
+def test_coalesce_writes_error(redis):
+    @redis_server(redis_objs=['client'])
+    def add_both(client, first, second):
+        client.sadd('coalesce:set', first)
+        client.incr('coalesce:set')
+        client.sadd('coalesce:set', second)
+
+    with pytest.raises(ResponseError):
+        add_both(redis, 'a', 'b')
+    assert redis.smembers('coalesce:set') == set(['a'])
+
 def test_divide(redis):
     @redis_server(redis_objs=['client'])
     def divide(client, m, n):
@@ -313,6 +700,38 @@ def test_and(redis):
 
     assert not bool_and(redis)
 
+def test_or_value(redis):
+    @redis_server(redis_objs=['client'])
+    def or_value(client, key):
+        return client.get(key) or 'default'
+
+    redis.set('or:empty', '')
+    redis.set('or:full', 'value')
+    assert or_value(redis, 'or:empty') == 'default'
+    assert or_value(redis, 'or:missing') == 'default'
+    assert or_value(redis, 'or:full') == 'value'
+
+def test_and_short_circuit(redis):
+    @redis_server(redis_objs=['client'])
+    def and_short_circuit(client, flag):
+        return flag and client.incr('and:counter')
+
+    assert and_short_circuit(redis, 0) == 0
+    assert redis.get('and:counter') is None
+    assert and_short_circuit(redis, 1) == 1
+
+def test_inline_truth(redis):
+    @redis_server(redis_objs=['client'])
+    def inline_truth(client, a, b):
+        if (a > 1 or b > 1) and not client.exists('truth:key'):
+            return 1
+        return 0
+
+    assert inline_truth(redis, 2, 0) == 1
+    script_id = list(inline_truth.variants.values())[0]
+    code = ScriptRegistry.SCRIPTS[script_id].script
+    assert '__BOOL' not in code and '__OR' not in code
+
 def test_partial(redis, capfd):
     @redis_server(redis_objs=['client'], minlineno=3, maxlineno=3)
     def partial(client):
@@ -382,6 +801,303 @@ def test_break(redis):
 
     assert brk(redis) == True
 
+def test_break_continue(redis):
+    @redis_server(redis_objs=['client'])
+    def odd_sum(client, limit):
+        total = 0
+        for i in range(100):
+            if i % 2 == 0:
+                continue
+            if i > limit:
+                break
+            total += i
+
+        return total
+
+    assert odd_sum(redis, 6) == 9
+    assert odd_sum(redis, 100) == 2500
+
+def test_loop_scaffolding(redis):
+    @redis_server(redis_objs=['client'])
+    def total(client, values):
+        result = 0
+        for value in values:
+            result += value
+        return result
+
+    assert total(redis, [1, 2, 3]) == 6
+    script_id = list(total.variants.values())[0]
+    code = ScriptRegistry.SCRIPTS[script_id].script
+    assert '__BREAK' not in code and 'repeat' not in code
+
+def test_micro_optimize(redis):
+    @redis_server(redis_objs=['client'],
+                  passes=DEFAULT_PASSES + ['micro_optimize'])
+    def increment_all(client, keys):
+        values = []
+        for key in keys:
+            values.append(client.incr('micro:' + key + ':count'))
+        return values
+
+    assert increment_all(redis, ['a', 'b', 'a']) == [1, 1, 2]
+    script_id = list(increment_all.variants.values())[0]
+    code = ScriptRegistry.SCRIPTS[script_id].script
+    assert 'table.insert' not in code and '__REDIS_CALL' in code
+
+def test_script_helpers(redis):
+    @redis_server(redis_objs=['client'])
+    def identity_number(client, value):
+        return value
+
+    assert identity_number(redis, 3) == 3
+    script_id = list(identity_number.variants.values())[0]
+    code = ScriptRegistry.SCRIPTS[script_id].script
+    assert '__RETVAL' in code
+    assert '__ADD' not in code and '__PIPE_GET' not in code
+    assert not any(line.startswith(' ') for line in code.splitlines())
+    assert identity_number.stats['script_bytes'] == len(code)
+
+def test_minify_lua():
+    code = "local x = '--' -- Comment\n\n-- Line\n  return x\n"
+    assert minify_lua(code) == "local x = '--'\nreturn x\n"
+
+def test_function_library(redis):
+    version = redis.info()['redis_version']
+    if int(version.split('.')[0]) < 7:
+        pytest.skip('Function libraries require Redis 7')
+
+    @redis_server(redis_objs=['client'], library='locomotor_test')
+    def library_get(client, key):
+        return client.get(key)
+
+    @redis_server(redis_objs=['client'], library='locomotor_test')
+    def library_set(client, key, value):
+        client.set(key, value)
+
+    library_set(redis, 'library:key', 'value')
+    assert library_get(redis, 'library:key') == 'value'
+
+    get_function = ScriptRegistry.SCRIPTS[
+        list(library_get.variants.values())[0]]
+    set_function = ScriptRegistry.SCRIPTS[
+        list(library_set.variants.values())[0]]
+    assert get_function.read_only and not set_function.read_only
+    assert get_function.library is set_function.library
+    assert get_function.code.count('local __RETVAL') == 1
+
+    # Libraries loaded by another process are used as they are
+    server = ScriptRegistry.server_id(redis)
+    ScriptRegistry.LOADED[server].clear()
+    ScriptRegistry.load_script(redis.execute_command, server, get_function)
+    library_set(redis, 'library:key', 'other')
+    assert library_get(redis, 'library:key') == 'other'
+
+    # Functions are reloaded if their library is removed
+    redis.execute_command('FUNCTION', 'DELETE', get_function.name)
+    assert library_get(redis, 'library:key') == 'value'
+
+def test_read_only(redis):
+    @redis_server(redis_objs=['client'])
+    def read_only_get(client, key):
+        return client.get(key)
+
+    @redis_server(redis_objs=['client'])
+    def read_write_incr(client, key):
+        return client.incr(key)
+
+    redis.set('read_only:key', 'value')
+    assert read_only_get(redis, 'read_only:key') == 'value'
+    assert read_write_incr(redis, 'read_only:counter') == 1
+
+    assert ScriptRegistry.SCRIPTS[
+        list(read_only_get.variants.values())[0]].read_only
+    assert not ScriptRegistry.SCRIPTS[
+        list(read_write_incr.variants.values())[0]].read_only
+
+def test_replicas(redis):
+    import redis as redis_module
+    replicas = ReplicaSet([redis_module.StrictRedis()], strategy='latency')
+
+    @redis_server(redis_objs=['client'], replicas=replicas)
+    def replica_get(client, key):
+        return client.get(key)
+
+    redis.set('replica:key', 'value')
+    assert replica_get(redis, 'replica:key') == 'value'
+    assert replicas.latencies[0] > 0
+
+def test_replica_strategies():
+    replicas = ReplicaSet(['a', 'b', 'c'])
+    assert [replicas.choose() for _ in range(4)] == ['a', 'b', 'c', 'a']
+
+    replicas = ReplicaSet(['a', 'b'], strategy='latency')
+    replicas.record('a', 0.5)
+    assert replicas.choose() == 'b'
+    replicas.record('b', 1.0)
+    assert replicas.choose() == 'a'
+
+    with pytest.raises(ValueError):
+        ReplicaSet(['a'], strategy='random')
+
+def test_cluster_keys(redis):
+    @redis_server(redis_objs=['client'], cluster=True)
+    def cluster_keys(client, user, count):
+        client.set('{user:' + user + '}:name', user)
+        for i in range(count):
+            client.incr('{user:%s}:visits' % user)
+        return client.get('{user:' + user + '}:name')
+
+    assert cluster_keys(redis, 'bob', 2) == 'bob'
+    assert redis.get('{user:bob}:visits') == '2'
+
+    script_id = list(cluster_keys.variants.values())[0]
+    code = ScriptRegistry.SCRIPTS[script_id].script
+    assert 'KEYS[1]' in code
+    assert cluster_keys.script_keys(['bob', 2])[0] == '{user:bob}:name'
+
+def test_cluster_tagged_keys(redis):
+    @redis_server(redis_objs=['client'], cluster=True)
+    def cluster_tagged_keys(client, user, count):
+        for i in range(count):
+            client.set('{user:' + user + '}:item:' + str(i), i)
+
+    cluster_tagged_keys(redis, 'alice', 2)
+    assert redis.get('{user:alice}:item:1') == '1'
+    assert cluster_tagged_keys.script_keys(['alice', 2]) == ['{user:alice}']
+
+def test_cross_slot():
+    with pytest.raises(CrossSlotException):
+        @redis_server(redis_objs=['client'], cluster=True)
+        def cross_slot(client, count):
+            for i in range(count):
+                client.incr('counter:' + str(i))
+
+    with pytest.raises(CrossSlotException):
+        @redis_server(redis_objs=['client'], cluster=True)
+        def different_tags(client, user):
+            client.get('{user:' + user + '}')
+            client.get('{admin}')
+
+def test_hash_ring():
+    import redis as redis_module
+    clients = [redis_module.StrictRedis(db=db) for db in range(4)]
+    ring = HashRing(clients)
+
+    # Keys are spread over all shards but tagged keys stay together
+    assert set(ring('key:%d' % i) for i in range(100)) == set(clients)
+    assert ring('{user:1}:name') is ring('{user:1}:visits')
+    assert ring('{user:1}:name') is ring('user:1')
+
+    # Removing a shard only moves the keys it held
+    smaller = HashRing(clients[:3])
+    for i in range(100):
+        if ring('key:%d' % i) is not clients[3]:
+            assert smaller('key:%d' % i) is ring('key:%d' % i)
+
+    with pytest.raises(ValueError):
+        HashRing([])
+
+def test_shards(redis):
+    import redis as redis_module
+    clients = [redis, redis_module.StrictRedis(db=1)]
+    ring = HashRing(clients)
+
+    @redis_server(redis_objs=['client'], shards=ring)
+    def sharded_incr(client, user):
+        return client.incr('{user:' + user + '}:visits')
+
+    users = ['user%d' % i for i in range(20)]
+    assert sharded_incr(redis, users[0]) == 1
+    assert sharded_incr.map([redis] * len(users), users) == [2] + [1] * 19
+    for user in users:
+        key = '{user:' + user + '}:visits'
+        assert ring(key).get(key) is not None
+    assert set(ring('{user:' + user + '}') for user in users) == \
+        set(clients)
+    clients[1].flushdb()
+
+def test_split_servers(redis):
+    import redis as redis_module
+
+    # Clients for the same server by different addresses look like
+    # clients for different servers
+    other = redis_module.StrictRedis(host='127.0.0.1')
+
+    @redis_server(redis_objs=['rdr', 'wtr'])
+    def split_servers(rdr, wtr, key):
+        value = rdr.get(key)
+        wtr.set(key + ':copy', value)
+        suffix = rdr.get(key + ':suffix')
+        return value + suffix
+
+    redis.set('split:key', 'value')
+    redis.set('split:key:suffix', '!')
+    assert split_servers(redis, redis, 'split:key') == 'value!'
+    assert split_servers.splits == {}
+
+    redis.delete('split:key:copy')
+    assert split_servers(redis, other, 'split:key') == 'value!'
+    assert redis.get('split:key:copy') == 'value'
+    fragments = list(split_servers.splits.values())[0]
+    assert [fragment.client_name for fragment in fragments] == \
+        ['rdr', 'wtr', 'rdr']
+    assert fragments[0].exports == ['value']
+
+def test_deferred(redis):
+    @redis_server(redis_objs=['client'], deferred=True)
+    def deferred_incr(client, key):
+        return client.incr(key)
+
+    for _ in range(2):
+        pipe = redis.pipeline()
+        pipe.set('deferred:key', 5)
+        result = deferred_incr(pipe, 'deferred:key')
+        pipe.get('deferred:key')
+
+        assert not result.done()
+        assert pipe.execute() == [True, 6, '6']
+        assert result.result() == 6
+
+    # Scripts flushed after they were loaded are run after the pipeline
+    redis.script_flush()
+    pipe = redis.pipeline(transaction=False)
+    result = deferred_incr(pipe, 'deferred:key')
+    pipe.incr('deferred:key')
+    assert pipe.execute() == [8, 7]
+    assert result.result() == 8
+
+    # Without a pipeline the script runs immediately
+    assert deferred_incr(redis, 'deferred:key') == 9
+
+    # Resetting the pipeline drops the queued script along with it
+    pipe = redis.pipeline()
+    deferred_incr(pipe, 'deferred:key')
+    pipe.reset()
+    pipe.incr('deferred:key')
+    assert pipe.execute() == [10]
+
+    with pytest.raises(KeyError):
+        with redis.pipeline() as pipe:
+            deferred_incr(pipe, 'deferred:key')
+            raise KeyError
+    assert 'execute' not in vars(pipe)
+
+    # Scripts missing in a transaction fail rather than run outside it
+    redis.script_flush()
+    pipe = redis.pipeline()
+    result = deferred_incr(pipe, 'deferred:key')
+    pipe.incr('deferred:key')
+    with pytest.raises(ResponseError):
+        pipe.execute()
+    assert redis.get('deferred:key') == '11'
+    with pytest.raises(ResponseError):
+        result.result()
+
+    # and the script is loaded again the next time it is queued
+    pipe = redis.pipeline()
+    result = deferred_incr(pipe, 'deferred:key')
+    assert pipe.execute() == [12]
+
 def test_pipe(redis):
     @redis_server(redis_objs=['client'])
     def pipe(client):